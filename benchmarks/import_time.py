@@ -0,0 +1,95 @@
+"""
+Measures the cold start cost of elasticsearch_query in short-lived processes (e.g. cron jobs and CLI checks).
+
+Each step is run in a fresh Python process, the fake Elasticsearch used by unit tests (test/fake_elasticsearch.py)
+answers the count request, so no cluster is needed:
+
+PYTHONPATH=.:test python benchmarks/import_time.py --runs 10
+
+One JSON line is printed per step with the median of runs of:
+
+* time: the time (in seconds) spent in the step's code (importing the module, creating an instance, ...)
+* process_time: the wall time (in seconds) of the whole process, including the interpreter start-up
+* modules: the number of modules imported by the process
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from statistics import median
+
+from fake_elasticsearch import FakeElasticsearch
+
+STEPS = OrderedDict([
+    ('import', 'import elasticsearch_query'),
+    ('instance', 'import elasticsearch_query\n'
+                 'elasticsearch_query.ElasticsearchQuery(es_host={host!r})'),
+    ('count', 'import elasticsearch_query\n'
+              'elasticsearch_query.ElasticsearchQuery(es_host={host!r}).count("*")'),
+])
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+{code}
+print(json.dumps({{"time": time.perf_counter() - start, "modules": len(sys.modules)}}))
+'''
+
+
+def measure(code):
+    """
+    :type code str
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT.format(code=code)], env=os.environ)
+
+    res = json.loads(output.decode('utf-8'))
+    res['process_time'] = time.perf_counter() - start
+
+    return res
+
+
+def run(step, host, runs):
+    """
+    :type step str
+    :type host str
+    :type runs int
+    :rtype: dict
+    """
+    code = STEPS[step].format(host=host)
+
+    # the first run compiles the module (when bytecode is not cached yet)
+    measure(code)
+    results = [measure(code) for _ in range(runs)]
+
+    return {
+        'step': step,
+        'runs': runs,
+        'time': round(median(result['time'] for result in results), 4),
+        'process_time': round(median(result['process_time'] for result in results), 4),
+        'modules': results[0]['modules'],
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--steps', default=','.join(STEPS))
+    args = parser.parse_args()
+
+    with FakeElasticsearch(documents=[{'foo': 'bar'}]) as server:
+        for step in args.steps.split(','):
+            res = run(step, server.host, args.runs)
+            res.update(python=platform.python_version())
+
+            print(json.dumps(res, sort_keys=True), flush=True)
+
+
+if __name__ == '__main__':
+    main()
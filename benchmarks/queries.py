@@ -0,0 +1,207 @@
+"""
+Measures the client-side performance of ElasticsearchQuery methods against a local fake Elasticsearch.
+
+No Elasticsearch cluster is needed - synthetic log documents are served by the HTTP stand-in used by unit tests
+(test/fake_elasticsearch.py) that is run in a separate process, so that only the client's memory usage is measured:
+
+PYTHONPATH=.:test python benchmarks/queries.py --documents 100000 --batch-sizes 500,1000,5000 --latency 0.005
+
+One JSON line is printed per method and batch size with the median of runs of:
+
+* rows_per_sec: rows returned per second (by methods that return rows)
+* requests_per_sec: queries made per second (by count and get_aggregations)
+* wall_time: the time (in seconds) it took to get all the rows (or the result)
+* ttfr: time to first row (in seconds) when using the iter_* generator version of the method
+* peak_memory: peak memory (in bytes) allocated while getting the rows (as reported by tracemalloc, in a separate run)
+"""
+import json
+import multiprocessing
+import platform
+import time
+import tracemalloc
+
+from argparse import ArgumentParser
+from statistics import median
+
+from elasticsearch_query import ElasticsearchQuery
+from fake_elasticsearch import FakeElasticsearch
+
+METHODS = ('get_rows', 'query_by_string', 'count', 'get_aggregations', 'query_by_sql')
+
+# methods that return rows are run for every batch size, the rest only once
+ROWS_METHODS = ('get_rows', 'query_by_string', 'query_by_sql')
+
+SQL = 'SELECT host, time FROM "logstash-bench"'
+
+
+def get_documents(count):
+    """
+    :type count int
+    :rtype: list[dict]
+    """
+    timestamp = ElasticsearchQuery.format_timestamp(int(time.time()) - 60)
+
+    return [
+        {
+            '@timestamp': timestamp,
+            '@message': 'GET /wiki/Page_{} HTTP/1.1'.format(idx % 5000),
+            'host': 'app{}.prod'.format(idx % 20),
+            'time': idx % 1000,
+        }
+        for idx in range(count)
+    ]
+
+
+def serve(documents, latency, hosts, stop):
+    """
+    Run the fake Elasticsearch until the stop event is set
+
+    :type documents int
+    :type latency float
+    :type hosts multiprocessing.Queue
+    :type stop multiprocessing.Event
+    """
+    with FakeElasticsearch(documents=get_documents(documents), latency=latency) as server:
+        hosts.put(server.host)
+        stop.wait()
+
+
+def get_callables(es_query, method, batch_size, documents):
+    """
+    Returns the callable that returns all the rows and the one that yields them (or None)
+
+    :type es_query ElasticsearchQuery
+    :type method str
+    :type batch_size int
+    :type documents int
+    :rtype: tuple[callable, callable]
+    """
+    if method == 'get_rows':
+        return (lambda: es_query.get_rows(match={'host': 'prod'}, limit=documents),
+                lambda: es_query.iter_rows(match={'host': 'prod'}, limit=documents))
+
+    if method == 'query_by_string':
+        return (lambda: es_query.query_by_string('*', fields=['host', 'time'], limit=documents),
+                lambda: es_query.iter_query_by_string('*', fields=['host', 'time'], limit=documents))
+
+    if method == 'query_by_sql':
+        return (lambda: es_query.query_by_sql(SQL, fetch_size=batch_size),
+                lambda: es_query.iter_query_by_sql(SQL, fetch_size=batch_size))
+
+    if method == 'count':
+        return lambda: es_query.count('*'), None
+
+    return lambda: es_query.get_aggregations('*', group_by='host', stats_field='time'), None
+
+
+def measure(func, iter_func):
+    """
+    :type func callable
+    :type iter_func callable or None
+    :rtype: dict
+    """
+    ttfr = None
+
+    if iter_func is not None:
+        start = time.time()
+        rows = iter_func()
+        next(rows)
+        ttfr = time.time() - start
+        rows.close()
+
+    start = time.time()
+    res = func()
+    wall_time = time.time() - start
+
+    return {
+        'rows': len(res) if isinstance(res, list) else None,
+        'wall_time': wall_time,
+        'ttfr': ttfr,
+    }
+
+
+def measure_memory(func):
+    """
+    A separate run is made as tracing memory allocations slows the code down
+
+    :type func callable
+    :rtype: int
+    """
+    tracemalloc.start()
+
+    try:
+        func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak_memory
+
+
+def run(es_host, method, batch_size, documents, runs):
+    """
+    :type es_host str
+    :type method str
+    :type batch_size int or None
+    :type documents int
+    :type runs int
+    :rtype: dict
+    """
+    es_query = ElasticsearchQuery(es_host=es_host, index_prefix='logstash-bench', period=3600,
+                                  batch_size=batch_size or 1000)
+    func, iter_func = get_callables(es_query, method, batch_size, documents)
+
+    results = [measure(func, iter_func) for _ in range(runs)]
+    wall_time = median(result['wall_time'] for result in results)
+
+    res = {
+        'method': method,
+        'batch_size': batch_size,
+        'runs': runs,
+        'wall_time': round(wall_time, 4),
+        'ttfr': round(median(result['ttfr'] for result in results), 4) if iter_func else None,
+        'peak_memory': measure_memory(func),
+    }
+
+    # count and get_aggregations make a single request, their rate is not comparable with rows per second
+    if method in ROWS_METHODS:
+        res.update(rows=results[0]['rows'], rows_per_sec=round(results[0]['rows'] / wall_time, 1))
+    else:
+        res.update(requests_per_sec=round(1 / wall_time, 1))
+
+    return res
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--documents', type=int, default=50000)
+    parser.add_argument('--batch-sizes', default='500,1000,5000')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before each response is sent')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--methods', default=','.join(METHODS))
+    args = parser.parse_args()
+
+    hosts = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+
+    server = multiprocessing.Process(target=serve, args=(args.documents, args.latency, hosts, stop))
+    server.start()
+
+    try:
+        es_host = hosts.get(timeout=60)
+
+        for method in args.methods.split(','):
+            batch_sizes = args.batch_sizes.split(',') if method in ROWS_METHODS else [None]
+
+            for batch_size in batch_sizes:
+                res = run(es_host, method, int(batch_size) if batch_size else None, args.documents, args.runs)
+                res.update(documents=args.documents, latency=args.latency, python=platform.python_version())
+
+                print(json.dumps(res, sort_keys=True), flush=True)
+    finally:
+        stop.set()
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
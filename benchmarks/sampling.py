@@ -0,0 +1,122 @@
+"""
+Compares the server-side cost of sampling methods supported by ElasticsearchQuery.
+
+It needs a local Elasticsearch instance to run against (e.g. the one used by integration tests):
+
+ES_TEST_HOST=127.0.0.1 python benchmarks/sampling.py --documents 200000 --runs 20
+
+Synthetic log documents are indexed into the "bench-sampling" index (with the "sampling_hash" field set at the ingest
+time), then every method is run against it. One JSON line with the median "took" (server-side) and wall time
+(client-side) of the query is printed per method.
+"""
+import json
+import time
+
+from argparse import ArgumentParser
+from os import getenv
+from statistics import median
+from zlib import crc32
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+
+from elasticsearch_query import ElasticsearchQuery, SamplingOptions
+
+INDEX_NAME = 'bench-sampling'
+METHODS = ('script', 'random_score', 'hash_field')
+
+
+class BenchElasticsearchQuery(ElasticsearchQuery):
+    """
+    Queries a single index with no date suffix
+    """
+    @staticmethod
+    def format_index(prefix, timestamp, sep='-'):
+        return prefix
+
+
+def set_up_index(es_host, documents):
+    """
+    :type es_host str
+    :type documents int
+    """
+    es = Elasticsearch(hosts=es_host)
+
+    if es.indices.exists(INDEX_NAME):
+        es.indices.delete(INDEX_NAME)
+
+    es.indices.create(INDEX_NAME, body={'mappings': {'log': {'properties': {'sampling_hash': {'type': 'byte'}}}}})
+
+    timestamp = ElasticsearchQuery.format_timestamp(int(time.time()) - 60)
+
+    def get_actions():
+        for idx in range(documents):
+            doc_id = 'doc-{}'.format(idx)
+
+            yield {
+                '_index': INDEX_NAME,
+                '_type': 'log',
+                '_id': doc_id,
+                '_source': {
+                    '@timestamp': timestamp,
+                    'host': 'app{}.prod'.format(idx % 20),
+                    'time': idx % 1000,
+                    'sampling_hash': crc32(doc_id.encode('utf-8')) % 100,
+                }
+            }
+
+    bulk(es, get_actions(), chunk_size=5000, refresh='wait_for')
+
+
+def run(es_host, method, sampling, runs):
+    """
+    :type es_host str
+    :type method str
+    :type sampling int
+    :type runs int
+    :rtype: dict
+    """
+    es_query = BenchElasticsearchQuery(
+        es_host=es_host, index_prefix=INDEX_NAME, period=3600,
+        sampling_options=SamplingOptions(method, 'sampling_hash' if method == 'hash_field' else None))
+
+    body = es_query._get_search_body({'query_string': {'query': '*'}}, sampling=sampling)
+
+    took, wall, hits = [], [], 0
+
+    for _ in range(runs):
+        start = time.time()
+        resp = es_query._es.search(index=es_query._index, body=body, size=0, request_cache='false')
+
+        wall.append((time.time() - start) * 1000)
+        took.append(resp['took'])
+        hits = resp['hits']['total']
+
+    return {
+        'method': method,
+        'sampling': sampling,
+        'runs': runs,
+        'hits': hits,
+        'took_ms': median(took),
+        'wall_ms': round(median(wall), 2),
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default=getenv('ES_TEST_HOST', '127.0.0.1'))
+    parser.add_argument('--documents', type=int, default=100000)
+    parser.add_argument('--sampling', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--skip-setup', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_setup:
+        set_up_index(args.host, args.documents)
+
+    for method in METHODS:
+        print(json.dumps(run(args.host, method, args.sampling, args.runs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,358 +3,302 @@ Run queries against Kibana's Elasticsearch that gets logs from Logstash.
 @see http://elasticsearch-py.readthedocs.org/en/master/
 """
 import json
-import logging
+import threading
 import time
 
-from datetime import datetime
-from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from dateutil import tz
+from elasticsearch_query_aggregations import AggregationsMixin, RollingWindow
+from elasticsearch_query_base import BaseElasticsearchQuery
+from elasticsearch_query_common import elasticsearch, ElasticsearchQueryError, IncompleteResultsError, \
+    ClientOptions, PaginationOptions, SamplingOptions, ResultsCache, LRUCache, DiskCache, Checkpoint, FileCheckpoint, \
+    ColumnarResult, OrjsonSerializer, UjsonSerializer, QueryStats, _InstrumentedSerializer
+from elasticsearch_query_pagination import PaginationMixin
+from elasticsearch_query_search import SearchMixin
 
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import scan
+__all__ = [
+    'ElasticsearchQuery', 'ElasticsearchQueryError', 'IncompleteResultsError', 'ClientOptions', 'PaginationOptions',
+    'SamplingOptions', 'ResultsCache', 'LRUCache', 'DiskCache', 'Checkpoint', 'FileCheckpoint', 'ColumnarResult',
+    'OrjsonSerializer', 'UjsonSerializer', 'QueryStats', 'RollingWindow',
+]
 
 
-class ElasticsearchQueryError(Exception):
+class ElasticsearchQuery(SearchMixin, PaginationMixin, AggregationsMixin, BaseElasticsearchQuery):
     """
-    Error that can be raised by ElasticsearchQuery class
+    Elasticsearch client
     """
-    pass
+    # the shortest time window partition (in seconds)
+    MIN_PARTITION_SIZE = 60
 
+    # (hosts, client options) -> Elasticsearch client shared by instances
+    _clients = {}
+    _clients_lock = threading.Lock()
 
-class ElasticsearchQuery(object):
-    """
-    Elasticsearch client
-    """
-    # give 5 seconds for all log messages to reach logstash and be stored in elasticsearch
-    SHORT_DELAY = 5
+    @property
+    def _es(self):
+        """
+        The client is created on the first use, so that creating an instance is cheap
+
+        :rtype: Elasticsearch
+        """
+        if self._client is None:
+            self._client = self._get_client(self._options.es_host, self._options.read_timeout, self._options.client)
 
-    # seconds in 24h used to get the es index for yesterday
-    DAY = 86400
+        return self._client
 
-    """ Interface for querying Elasticsearch storage """
-    def __init__(
-            self, es_host, since=None, period=900,
-            read_timeout=10, index_prefix='logstash-other', index_sep='-', batch_size=1000):
+    @staticmethod
+    def _create_client(es_host, read_timeout, serializer, maxsize=10, http_compress=False):
         """
         :type es_host str
-        :type since int
-        :type period int
         :type read_timeout int
-        :type index_prefix str
-        :type index_sep str
-        :type batch_size int
-
-        :arg es_host: Elasticsearch host(s) that should be used for querying
-        :arg since: UNIX timestamp data should be fetched since
-        :arg period: period (in seconds) before now() to be used when since is empty(defaults to last 15 minutes)
-        :arg read_timeout: customize Elasticsearch read timeout (defaults to 10 s)
-        :arg index_prefix name of the Elasticsearch index (defaults to 'logstash-other')
-        :arg batch_size size of the batch sent in every requests of the ELK scroll API (defaults to 1000)
+        :type serializer JSONSerializer
+        :type maxsize int
+        :type http_compress bool
+        :rtype: Elasticsearch
         """
-        self._es = Elasticsearch(hosts=es_host, timeout=read_timeout)
-        self._batch_size = batch_size
+        return elasticsearch.Elasticsearch(hosts=es_host, timeout=read_timeout, serializer=serializer,
+                                           maxsize=maxsize, http_compress=http_compress)
 
-        self._logger = logging.getLogger(self.__class__.__name__)
+    def _get_client(self, es_host, read_timeout, client_options):
+        """
+        Returns the client shared by all instances with the same hosts and client options,
+        so that connections are kept alive and reused by them
+
+        :type es_host str
+        :type read_timeout int
+        :type client_options ClientOptions
+        :rtype: Elasticsearch
+        """
+        if not client_options.share_client:
+            return self._create_client(es_host, read_timeout, self._create_serializer(client_options.serializer),
+                                       client_options.maxsize, client_options.http_compress)
 
-        # if no timestamp provided, fallback to now() in UTC
-        now = int(time.time())
+        serializer = client_options.serializer
 
-        if since is None:
-            since = now - period
-        else:
-            since += 1
-            self._logger.info("Using provided %s timestamp as since (%d seconds ago)", since, now - since)
+        # the key holds a reference to the serializer instance, so that its id is never reused by another one
+        key = (
+            json.dumps(es_host, sort_keys=True), read_timeout, client_options.maxsize, client_options.http_compress,
+            serializer, self._options.stats_callback is not None,
+        )
 
-        self._since = since
-        self._to = now - self.SHORT_DELAY  # give logs some time to reach Logstash
+        try:
+            hash(key)
+        except TypeError:
+            # serializers that can not be hashed are not shared
+            return self._create_client(es_host, read_timeout, self._create_serializer(serializer),
+                                       client_options.maxsize, client_options.http_compress)
 
-        # Elasticsearch index to query
-        # from today and yesterday
-        self._index = ','.join([
-            self.format_index(prefix=index_prefix, timestamp=now-self.DAY, sep=index_sep),
-            self.format_index(prefix=index_prefix, timestamp=now, sep=index_sep),
-        ])
+        with self._clients_lock:
+            if key not in self._clients:
+                self._clients[key] = self._create_client(es_host, read_timeout, self._create_serializer(serializer),
+                                                         client_options.maxsize, client_options.http_compress)
 
-        self._logger.info("Using %s indices", self._index)
-        self._logger.info("Querying for messages from between %s and %s",
-                          self.format_timestamp(self._since), self.format_timestamp(self._to))
+            return self._clients[key]
 
-    @staticmethod
-    def format_index(prefix, timestamp, sep='-'):
+    @classmethod
+    def close_shared_clients(cls):
         """
-        :type prefix str
-        :type timestamp int
-        :type sep str
-        :rtype: str
+        Close connections of all shared clients (e.g. in a forked process), new ones will be created when needed
         """
-        tz_info = tz.tzutc()
+        with cls._clients_lock:
+            for client in cls._clients.values():
+                client.transport.close()
 
-        # ex. logstash-other-2017.05.09
-        return "{prefix}{sep}{date}".format(
-            prefix=prefix, sep=sep, date=datetime.fromtimestamp(timestamp, tz=tz_info).strftime('%Y.%m.%d'))
+            cls._clients.clear()
 
-    @staticmethod
-    def format_timestamp(timestamp):
+    @property
+    def _index(self):
         """
-        Format the UTC timestamp for Elasticsearch
-        eg. 2014-07-09T08:37:18.000Z
+        Comma-separated list of indices to query
 
-        @see https://docs.python.org/2/library/time.html#time.strftime
-
-        :type timestamp int
         :rtype: str
         """
-        tz_info = tz.tzutc()
-        return datetime.fromtimestamp(timestamp, tz=tz_info).strftime("%Y-%m-%dT%H:%M:%S.000Z")
-
-    def _get_timestamp_filer(self):
-        return {
-            "range": {
-                "@timestamp": {
-                    "gte": self.format_timestamp(self._since),
-                    "lte": self.format_timestamp(self._to)
-                }
-            }
-        }
-
-    def _search(self, query, fields=None, limit=50000, sampling=None):
-        """
-        Perform the search and return raw rows
+        indices = self._indices
 
-        :type query object
-        :type fields list[str] or None
-        :type limit int
-        :type sampling int or None
+        if self._options.check_indices:
+            # fall back to all indices when none exists, Elasticsearch will report a missing index then
+            indices = [index for index in indices if self._index_exists(index)] or indices
 
-        :arg sampling: Percentage of results to be returned (0,100)
+        return ','.join(indices)
 
-        :rtype: list
+    def _index_exists(self, index):
         """
-        body = {
-            "query": {
-                "bool": {
-                    "must": [
-                        query
-                    ]
-                }
-            }
-        }
+        Checks if a given index exists, the result is cached for INDICES_CACHE_TTL seconds
 
-        # @see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-source-filtering.html
-        if fields:
-            body['_source'] = {
-                "includes": fields
-            }
-
-        # add @timestamp range
-        # @see http://stackoverflow.com/questions/40996266/elasticsearch-5-1-unknown-key-for-a-start-object-in-filters
-        # @see https://discuss.elastic.co/t/elasticsearch-watcher-error-for-range-query/70347/2
-        body['query']['bool']['must'].append(self._get_timestamp_filer())
-
-        # sample the results if needed
-        if sampling is not None:
-            body['query']['bool']['must'].append({
-                'script': {
-                    'script': {
-                        'lang': 'painless',
-                        'source': "Math.abs(doc['_id'].value.hashCode()) % 100 < params.sampling",
-                        'params': {
-                            'sampling': sampling
-                        }
-                    }
-                }
-            })
-
-        self._logger.debug("Running {} query (limit set to {:d})".format(json.dumps(body), body.get('size', 0)))
-
-        # use Scroll API to be able to fetch more than 10k results and prevent "search_phase_execution_exception":
-        # "Result window is too large, from + size must be less than or equal to: [10000] but was [500000].
-        # See the scroll api for a more efficient way to request large data sets."
-        #
-        # @see http://elasticsearch-py.readthedocs.io/en/master/helpers.html#scan
-        rows = scan(
-            client=self._es,
-            clear_scroll=False,  # True causes "403 Forbidden: You don't have access to this resource"
-            index=self._index,
-            query=body,
-            sort=["_doc"],  # return the next batch of results from every shard that still has results to return.
-            size=self._batch_size,  # batch size
-        )
+        :type index str
+        :rtype: bool
+        """
+        exists = self._get_cached_index_exists(index)
 
-        # get only requested amount of entries and cast them to a list
-        rows = islice(rows, 0, limit)
-        rows = [entry['_source'] for entry in rows]  # get data
+        if exists is None:
+            exists = self._es.indices.exists(index=index)
+            self._set_cached_index_exists(index, exists)
 
-        self._logger.info("{:d} rows returned".format(len(rows)))
-        return rows
+        return exists
 
-    def get_rows(self, match, fields=None, limit=10, sampling=None):
+    def _get_partitions(self):
         """
-        Returns raw rows that matches given query
+        Split the time window into sub-ranges, each one is queried using a copy of this instance.
+        The partition size depends on the window length and the number of partitions, but partitions
+        are at most a day long and then aligned to midnight, so that each one queries a single daily index.
+
+        Returns an empty list when the time window is not partitioned.
 
-        :arg match: query to be run against Kibana log messages (ex. {"@message": "Foo Bar DB queries"})
-        :type fields list[str] or None
-        :arg limit: the number of results (defaults to 10)
-        :type sampling int or None
-        :arg sampling: Percentage of results to be returned (0,100)
+        :rtype: list[ElasticsearchQuery]
         """
-        query = {
-            "match": match,
-        }
+        if self._options.pagination.partitions <= 1:
+            return []
 
-        return self._search(query, fields, limit, sampling)
+        size = -(-(self._to - self._since) // self._options.pagination.partitions)  # rounded up
+        size = min(max(size, self.MIN_PARTITION_SIZE), self.DAY)
 
-    def query_by_string(self, query, fields=None, limit=10, sampling=None):
-        """
-        Returns raw rows that matches the given query string
+        boundaries = [self._since]
 
-        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
-        :type fields list[str] or None
-        :arg limit: the number of results (defaults to 10)
-        :type sampling int or None
-        :arg sampling: Percentage of results to be returned (0,100)
-        """
-        query = {
-            "query_string": {
-                "query": query,
-            }
-        }
+        while True:
+            end = boundaries[-1] + size if size < self.DAY else (boundaries[-1] // self.DAY + 1) * self.DAY
 
-        return self._search(query, fields, limit, sampling)
+            if end >= self._to:
+                break
 
-    def count(self, query):
-        """
-        Returns number of matching entries
+            boundaries.append(end)
 
-        :type query str
-        :rtype: int
-        """
-        body = {
-            "query": {
-                "bool": {
-                    "must": [{
-                        "query_string": {
-                            "query": query,
-                        }
-                    }]
-                }
-            }
-        }
+        if len(boundaries) == 1:
+            return []
 
-        body['query']['bool']['must'].append(self._get_timestamp_filer())
+        import copy  # pylint: disable=import-outside-toplevel
 
-        return self._es.count(index=self._index, body=body).get('count')
+        partitions = []
+        self._es  # pylint: disable=pointless-statement  # partitions share the client, create it now
 
-    def query_by_sql(self, sql):
-        """
-        Returns entries matching given SQL query
+        for idx, since in enumerate(boundaries):
+            # pylint: disable=protected-access
+            partition = copy.copy(self)
+            partition._options = self._options._replace(
+                pagination=self._options.pagination._replace(partitions=1),
+                to_exclusive=idx < len(boundaries) - 1,
+            )
+            partition._set_time_window(since, boundaries[idx + 1] if idx < len(boundaries) - 1 else self._to)
 
-        :type sql str
-        :rtype: list[dict]
-        """
-        # https://www.elastic.co/guide/en/elasticsearch/reference/current/sql-rest.html
-        # https://www.elastic.co/guide/en/elasticsearch/reference/current/sql-syntax-select.html
-        body = {'query': sql}
+            partitions.append(partition)
 
-        resp = self._es.transport.perform_request('POST', '/_xpack/sql', params={'format': 'json'}, body=body)
+        return partitions
 
-        # build key-value dictionary for each row to match results returned by query_by_string
-        columns = [column['name'] for column in resp.get('columns')]
+    def _get_cache_key(self, method, body, **kwargs):
+        """
+        Canonical hash of the request
 
-        return [dict(zip(columns, row)) for row in resp.get('rows')]
+        :type method str
+        :type body dict
+        :rtype: str
+        """
+        import hashlib  # pylint: disable=import-outside-toplevel
+
+        client = self._options.client.client
+
+        request = {
+            # results of different clusters must never be mixed (e.g. by FederatedQuery sharing the cache)
+            'hosts': self._options.es_host if client is None else client.transport.hosts,
+            'method': method,
+            'body': body,
+            'indices': self._indices,
+            'window': [self._since, self._to],
+            'kwargs': kwargs,
+        }
 
-    def get_to_timestamp(self):
-        """ Return the upper time boundary to returned data """
-        return self._to
+        return hashlib.sha1(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
-    def get_aggregations(self, query, group_by, stats_field, percents=(50, 95, 99, 99.9), size=100):
+    def _cached(self, fetch, method, body, **kwargs):
         """
-        Returns aggregations (rows count + percentile stats) for a given query
+        Returns the cached result of a given request or calls fetch and caches its result.
+        Requests are cached only for time windows with an explicit end (the "to" argument)
+        that ended more than SHORT_DELAY ago.
+
+        :type fetch callable
+        :type method str
+        :type body dict
+        :rtype: object
+        """
+        if self._options.cache is None or not self._options.cacheable or \
+                self._to >= int(time.time()) - self.SHORT_DELAY:
+            return fetch()
 
-        This is basically the same as the following pseudo-SQL query:
-        SELECT PERCENTILE(stats_field, 75) FROM query GROUP BY group_by LIMIT size
+        key = self._get_cache_key(method, body, **kwargs)
+        value = self._options.cache.get(key)
 
-        https://www.elastic.co/guide/en/elasticsearch/reference/5.5/search-aggregations-bucket-terms-aggregation.html
-        https://www.elastic.co/guide/en/elasticsearch/reference/5.5/search-aggregations-metrics-percentile-aggregation.html
+        if value is None:
+            value = fetch()
+            self._options.cache.set(key, value)
+        else:
+            self._logger.debug("Got %s results from cache (key: %s)", method, key)
 
-        Please note that group_by should be provided by a "keyword" field:
+        return value
 
-        Fielddata is disabled on text fields by default. Set fielddata=true on [@context.caller] in order to load
-        fielddata in memory by uninverting the inverted index. Note that this can however use significant memory.\
-        Alternatively use a keyword field instead.
+    @contextmanager
+    def _query_stats(self, method, body=None):
+        """
+        Yields QueryStats instance (or None when stats are not collected) and passes it
+        to stats_callback when the query is completed
 
-        :type query str
-        :type group_by str
-        :type stats_field str
-        :type percents tuple[int]
-        :type size int
-        :rtype: dict
+        :type method str
+        :type body dict or None
         """
-        body = {
-            "query": {
-                "bool": {
-                    "must": [{
-                        "query_string": {
-                            "query": query,
-                        },
-                    }]
-                },
-            },
-            "aggregations": {
-                "group_by_agg": {
-                    "terms": {
-                        "field": group_by,
-                        "size": size,  # how many term buckets should be returned out of the overall terms list
-                    },
-                    "aggregations": {
-                        "field_stats": {
-                            "percentiles": {
-                                "field": stats_field,
-                                "percents": percents
-                            }
-                        }
-                    }
-                }
-            }
-        }
+        if self._options.stats_callback is None:
+            yield None
+            return
+
+        stats = QueryStats(method, self._index, body)
+
+        try:
+            yield stats
+        except Exception as ex:
+            stats.error = ex
+            raise
+        finally:
+            stats.finish()
+
+            try:
+                self._options.stats_callback(stats)
+            except Exception:  # pylint: disable=broad-except
+                self._logger.exception("stats_callback failed")
+
+    def _record_response(self, stats, resp):
+        """
+        :type stats QueryStats or None
+        :type resp dict
+        """
+        if stats is None:
+            return
 
-        # add @timestamp range
-        body['query']['bool']['must'].append(self._get_timestamp_filer())
+        # only serializers of clients created by ElasticsearchQuery measure responses
+        serializer = self._es.transport.serializer
 
-        self._logger.info("Getting aggregations for %s field when grouped by %s", group_by, stats_field)
+        if isinstance(serializer, _InstrumentedSerializer):
+            stats.add_response(resp, *serializer.pop_stats())
+        else:
+            stats.add_response(resp)
 
-        res = self._es.search(
-            body=body,
-            index=self._index,
-            size=0,  # we don need any rows from the index, stats is all we need here
-        )
+    def count(self, query):
+        """
+        Returns number of matching entries
 
-        # print(json.dumps(res, indent=True))
+        :type query str
+        :rtype: int
+        """
+        partitions = self._get_partitions()
 
-        aggs = {}
+        if partitions:
+            # partitions' counts are cached separately
+            with ThreadPoolExecutor(max_workers=self._options.pagination.partitions) as executor:
+                return sum(executor.map(lambda part: part.count(query), partitions))
 
-        """
-        bucket = {
-            "field_stats": {
-                "values": {
-                    "95.0": 20.99858477419025,
-                    "99.0": 67.0506954238478,
-                    "50.0": 1.0,
-                    "99.9": 146.3865495436944
-                }
-            },
-            "key": "Wikia\\Service\\Gateway\\ConsulUrlProvider:getUrl",
-            "doc_count": 8912859
-        }
-        """
+        body = self._get_count_body(query)
 
-        for bucket in res['aggregations']['group_by_agg']['buckets']:
-            entry = {
-                "count": bucket['doc_count']
-            }
-            entry.update(bucket['field_stats']['values'])
+        def fetch():
+            with self._query_stats('count', body) as stats:
+                resp = self._es.count(index=self._index, body=body, filter_path=self._get_filter_path('count'))
+                self._record_response(stats, resp)
 
-            aggs[bucket['key']] = entry
+                return resp.get('count')
 
-        return aggs
+        return self._cached(fetch, 'count', body)
@@ -0,0 +1,649 @@
+"""
+Counting and aggregating rows for ElasticsearchQuery - multi search requests, aggregations, histograms
+and the rolling window built on top of them.
+"""
+import json
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch_query_common import elasticsearch, ElasticsearchQueryError
+
+
+class AggregationsBodyMixin(object):  # pylint: disable=too-few-public-methods
+    """
+    Builds aggregation requests and reads their responses, shared by ElasticsearchQuery and AsyncElasticsearchQuery
+    """
+    def _add_timestamp_filter(self, body):
+        """
+        :type body dict
+        :rtype: dict
+        """
+        body = dict(body)
+
+        body['query'] = {
+            "bool": {
+                "must": [
+                    body.get('query', {"match_all": {}}),
+                    self._get_timestamp_filer(),
+                ]
+            }
+        }
+
+        return body
+
+    def _get_total_hits_body(self, query):
+        """
+        :type query str
+        :rtype: dict
+        """
+        body = self._get_count_body(query)
+        body['size'] = 0  # we need just the number of hits
+        body['track_total_hits'] = True
+
+        return body
+
+    @staticmethod
+    def _get_total_hits(resp):
+        """
+        :type resp dict
+        :rtype: int
+        """
+        total = resp['hits']['total']
+
+        # Elasticsearch 7.x returns {"value": 123, "relation": "eq"}
+        return total['value'] if isinstance(total, dict) else total
+
+    @classmethod
+    def _get_counts(cls, responses):
+        """
+        :type responses list[dict|ElasticsearchQueryError]
+        :rtype: list[int|ElasticsearchQueryError]
+        """
+        return [
+            resp if isinstance(resp, ElasticsearchQueryError) else cls._get_total_hits(resp)
+            for resp in responses
+        ]
+
+    @staticmethod
+    def _get_msearch_lines(bodies):
+        """
+        :type bodies list[dict]
+        :rtype: list[dict]
+        """
+        lines = []
+        for body in bodies:
+            lines.append({})  # use the index provided in the request URL
+            lines.append(body)
+
+        return lines
+
+    @staticmethod
+    def _get_msearch_results(responses):
+        """
+        :type responses list[dict]
+        :rtype: list[dict|ElasticsearchQueryError]
+        """
+        return [
+            ElasticsearchQueryError(json.dumps(resp['error'])) if 'error' in resp else resp
+            for resp in responses
+        ]
+
+    def _get_aggregations_body(self, query, group_by, stats_field, percents, size):
+        """
+        Build the body of the aggregations request
+
+        :type query str
+        :type group_by str
+        :type stats_field str
+        :type percents tuple[int]
+        :type size int
+        :rtype: dict
+        """
+        body = self._get_count_body(query)  # query string and the time window
+
+        body['aggregations'] = {
+            "group_by_agg": {
+                "terms": {
+                    "field": group_by,
+                    "size": size,  # how many term buckets should be returned out of the overall terms list
+                },
+                "aggregations": {
+                    "field_stats": {
+                        "percentiles": {
+                            "field": stats_field,
+                            "percents": percents
+                        }
+                    }
+                }
+            }
+        }
+
+        return body
+
+    @staticmethod
+    def _get_aggregations_from_response(res):
+        """
+        :type res dict
+        :rtype: dict
+        """
+        aggs = {}
+
+        """
+        bucket = {
+            "field_stats": {
+                "values": {
+                    "95.0": 20.99858477419025,
+                    "99.0": 67.0506954238478,
+                    "50.0": 1.0,
+                    "99.9": 146.3865495436944
+                }
+            },
+            "key": "Wikia\\Service\\Gateway\\ConsulUrlProvider:getUrl",
+            "doc_count": 8912859
+        }
+        """
+
+        for bucket in res['aggregations']['group_by_agg']['buckets']:
+            entry = {
+                "count": bucket['doc_count']
+            }
+            entry.update(bucket['field_stats']['values'])
+
+            aggs[bucket['key']] = entry
+
+        return aggs
+
+    def _get_aggregations_page_body(self, query, fields, stats_field, percents, page_size):
+        """
+        Build the body of the composite aggregation request
+
+        :type query str
+        :type fields list[str]
+        :type stats_field str
+        :type percents tuple[int]
+        :type page_size int
+        :rtype: dict
+        """
+        body = self._get_count_body(query)  # query string and the time window
+        body['size'] = 0
+
+        body['aggregations'] = {
+            "group_by_agg": {
+                "composite": {
+                    "size": page_size,
+                    "sources": [{field: {"terms": {"field": field}}} for field in fields],
+                },
+                "aggregations": {
+                    "field_stats": {
+                        "percentiles": {
+                            "field": stats_field,
+                            "percents": percents
+                        }
+                    }
+                }
+            }
+        }
+
+        return body
+
+    @staticmethod
+    def _get_aggregations_page(res, body, fields, page_size):
+        """
+        Returns (key, count, percentiles) tuples of the composite aggregation page
+        and the body of the request for the next page (None after the last page)
+
+        :type res dict
+        :type body dict
+        :type fields list[str]
+        :type page_size int
+        :rtype: tuple[list[tuple], dict or None]
+        """
+        res = res['aggregations']['group_by_agg']
+        buckets = res['buckets']
+
+        groups = [
+            (
+                bucket['key'][fields[0]] if len(fields) == 1 else tuple(bucket['key'][field] for field in fields),
+                bucket['doc_count'],
+                bucket['field_stats']['values'],
+            )
+            for bucket in buckets
+        ]
+
+        if len(buckets) < page_size:
+            return groups, None
+
+        # after_key is returned since Elasticsearch 6.3
+        body['aggregations']['group_by_agg']['composite']['after'] = res.get('after_key', buckets[-1]['key'])
+        return groups, body
+
+    def _get_histogram_body(self, query, interval, stats_field, percents, group_by, size):
+        """
+        Build the body of the date histogram request
+
+        :type query str
+        :type interval int or str
+        :type stats_field str or None
+        :type percents tuple[int]
+        :type group_by str or None
+        :type size int
+        :rtype: dict
+        """
+        histogram = {
+            "date_histogram": {
+                "field": "@timestamp",
+                "interval": '{}s'.format(interval) if isinstance(interval, int) else interval,
+                "min_doc_count": 0,
+                # return empty buckets for the whole time window
+                "extended_bounds": {
+                    "min": self._since * 1000,
+                    "max": self._to * 1000,
+                },
+            }
+        }
+
+        if stats_field is not None:
+            histogram['aggregations'] = {
+                "field_stats": {
+                    "percentiles": {
+                        "field": stats_field,
+                        "percents": percents
+                    }
+                }
+            }
+
+        body = self._get_count_body(query)  # query string and the time window
+        body['size'] = 0
+
+        if group_by is not None:
+            body['aggregations'] = {
+                "group_by_agg": {
+                    "terms": {
+                        "field": group_by,
+                        "size": size,
+                    },
+                    "aggregations": {
+                        "histogram": histogram
+                    }
+                }
+            }
+        else:
+            body['aggregations'] = {
+                "histogram": histogram
+            }
+
+        return body
+
+    @classmethod
+    def _get_histogram_from_response(cls, res, stats_field, group_by):
+        """
+        :type res dict
+        :type stats_field str or None
+        :type group_by str or None
+        :rtype: dict
+        """
+        res = res['aggregations']
+
+        if group_by is None:
+            return cls._get_histogram_from_buckets(res['histogram']['buckets'], stats_field)
+
+        return dict(
+            (bucket['key'], cls._get_histogram_from_buckets(bucket['histogram']['buckets'], stats_field))
+            for bucket in res['group_by_agg']['buckets']
+        )
+
+    @staticmethod
+    def _get_histogram_from_buckets(buckets, stats_field):
+        """
+        :type buckets list[dict]
+        :type stats_field str or None
+        :rtype: dict
+        """
+        res = {
+            "timestamps": [bucket['key'] // 1000 for bucket in buckets],
+            "counts": [bucket['doc_count'] for bucket in buckets],
+        }
+
+        if stats_field is not None:
+            for bucket in buckets:
+                for percent, value in bucket['field_stats']['values'].items():
+                    res.setdefault(percent, []).append(value)
+
+        return res
+
+
+class AggregationsMixin(AggregationsBodyMixin):
+    """
+    Returns counts and stats of rows matching queries, mixed into ElasticsearchQuery
+    """
+    def count_many(self, queries, chunk_size=100, concurrency=1):
+        """
+        Returns number of matching entries for each of given queries using a single Multi Search API request
+        (per chunk of queries).
+
+        Failed queries do not fail the whole batch, ElasticsearchQueryError instance is returned for them instead.
+
+        :type queries list[str]
+        :type chunk_size int
+        :type concurrency int
+        :rtype: list[int|ElasticsearchQueryError]
+        """
+        bodies = [self._get_total_hits_body(query) for query in queries]
+
+        return self._get_counts(self._msearch(bodies, chunk_size, concurrency))
+
+    def search_many(self, bodies, chunk_size=100, concurrency=1):
+        """
+        Runs given search requests (e.g. with aggregations) using a single Multi Search API request
+        (per chunk of requests) and returns raw responses. The time window filter is added to each request.
+
+        Failed requests do not fail the whole batch, ElasticsearchQueryError instance is returned for them instead.
+
+        :type bodies list[dict]
+        :type chunk_size int
+        :type concurrency int
+        :rtype: list[dict|ElasticsearchQueryError]
+        """
+        bodies = [self._add_timestamp_filter(body) for body in bodies]
+
+        return self._msearch(bodies, chunk_size, concurrency)
+
+    def _msearch(self, bodies, chunk_size, concurrency):
+        """
+        @see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-multi-search.html
+
+        :type bodies list[dict]
+        :type chunk_size int
+        :type concurrency int
+        :rtype: list[dict|ElasticsearchQueryError]
+        """
+        chunks = [bodies[idx:idx + chunk_size] for idx in range(0, len(bodies), chunk_size)]
+
+        def run(chunk):
+            try:
+                responses = self._es.msearch(body=self._get_msearch_lines(chunk), index=self._index)['responses']
+            except elasticsearch.TransportError as ex:
+                self._logger.error("Multi search request failed: %s", ex)
+                return [ElasticsearchQueryError(str(ex))] * len(chunk)
+
+            return self._get_msearch_results(responses)
+
+        self._logger.info("Running %d queries in %d multi search requests", len(bodies), len(chunks))
+
+        if concurrency > 1 and len(chunks) > 1:
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+
+            try:
+                results = list(executor.map(run, chunks))
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            results = [run(chunk) for chunk in chunks]
+
+        return [resp for chunk in results for resp in chunk]
+
+    def get_aggregations(self, query, group_by, stats_field, percents=(50, 95, 99, 99.9), size=100):
+        """
+        Returns aggregations (rows count + percentile stats) for a given query
+
+        This is basically the same as the following pseudo-SQL query:
+        SELECT PERCENTILE(stats_field, 75) FROM query GROUP BY group_by LIMIT size
+
+        https://www.elastic.co/guide/en/elasticsearch/reference/5.5/search-aggregations-bucket-terms-aggregation.html
+        https://www.elastic.co/guide/en/elasticsearch/reference/5.5/search-aggregations-metrics-percentile-aggregation.html
+
+        Please note that group_by should be provided by a "keyword" field:
+
+        Fielddata is disabled on text fields by default. Set fielddata=true on [@context.caller] in order to load
+        fielddata in memory by uninverting the inverted index. Note that this can however use significant memory.\
+        Alternatively use a keyword field instead.
+
+        :type query str
+        :type group_by str
+        :type stats_field str
+        :type percents tuple[int]
+        :type size int
+        :rtype: dict
+        """
+        body = self._get_aggregations_body(query, group_by, stats_field, percents, size)
+
+        self._logger.info("Getting aggregations for %s field when grouped by %s", group_by, stats_field)
+
+        def fetch():
+            with self._query_stats('aggregations', body) as stats:
+                res = self._es.search(
+                    body=body,
+                    index=self._index,
+                    size=0,  # we don need any rows from the index, stats is all we need here
+                    filter_path=self._get_filter_path('aggregations'),
+                )
+                self._record_response(stats, res)
+
+                # print(json.dumps(res, indent=True))
+
+                return self._get_aggregations_from_response(res)
+
+        return self._cached(fetch, 'aggregations', body)
+
+    def iter_aggregations(self, query, group_by, stats_field, percents=(50, 95, 99, 99.9), page_size=100):
+        """
+        Yields (key, count, percentiles) tuples for all groups, fetched page by page
+        using the composite aggregation - memory usage is bound by the page size.
+
+        https://www.elastic.co/guide/en/elasticsearch/reference/6.5/search-aggregations-bucket-composite-aggregation.html
+
+        :type query str
+        :arg group_by: a "keyword" field or a list of them, key is a tuple of values for the latter
+        :type group_by str or list[str]
+        :type stats_field str
+        :type percents tuple[int]
+        :type page_size int
+        :rtype: tuple[object, int, dict]
+        """
+        fields = [group_by] if isinstance(group_by, str) else list(group_by)
+        body = self._get_aggregations_page_body(query, fields, stats_field, percents, page_size)
+
+        self._logger.info("Getting paged aggregations for %s field when grouped by %s", stats_field, group_by)
+
+        with self._query_stats('aggregations', body) as stats:
+            while body is not None:
+                res = self._es.search(body=body, index=self._index, filter_path=self._get_filter_path('aggregations'))
+                self._record_response(stats, res)
+
+                groups, body = self._get_aggregations_page(res, body, fields, page_size)
+
+                for group in groups:
+                    yield group
+
+    def get_histogram(self, query, interval, stats_field=None, percents=(50, 95, 99, 99.9), group_by=None, size=100):
+        """
+        Returns time-ordered arrays of rows count (+ optionally percentile stats) per time interval for a given query
+
+        {
+            "timestamps": [1546300800, 1546300860, ...],  # the beginning of the interval (UNIX timestamp)
+            "counts": [12, 34, ...],
+            "50.0": [20.0, 21.5, ...],  # only when stats_field is provided
+            ...
+        }
+
+        When group_by is provided a dict with the above for each term bucket is returned.
+
+        https://www.elastic.co/guide/en/elasticsearch/reference/6.5/search-aggregations-bucket-datehistogram-aggregation.html
+
+        :type query str
+        :arg interval: interval in seconds or as Elasticsearch time unit (e.g. "1m", "1h")
+        :type interval int or str
+        :type stats_field str or None
+        :type percents tuple[int]
+        :arg group_by: a "keyword" field to group results by
+        :type group_by str or None
+        :type size int
+        :rtype: dict
+        """
+        body = self._get_histogram_body(query, interval, stats_field, percents, group_by, size)
+
+        self._logger.info("Getting %s histogram for %s query", interval, query)
+
+        def fetch():
+            with self._query_stats('histogram', body) as stats:
+                res = self._es.search(body=body, index=self._index, filter_path=self._get_filter_path('aggregations'))
+                self._record_response(stats, res)
+
+                return self._get_histogram_from_response(res, stats_field, group_by)
+
+        return self._cached(fetch, 'histogram', body)
+
+class RollingWindow(object):
+    """
+    Rows count (+ optionally percentile stats) for a given query in the sliding time window (e.g. the last 15 minutes).
+
+    The window is split into buckets (one minute long by default) that are kept in memory. Each call queries only
+    the buckets that are new or not settled yet (i.e. end within SHORT_DELAY from now), using a single date histogram
+    request. Buckets that are out of the window are evicted.
+
+    rolling = RollingWindow(ElasticsearchQuery(es_host='es.prod'), query='@message:"^PHP Fatal"', window=900)
+    rolling.count()  # call it every minute
+    """
+    def __init__(self, es_query, query, window=900, bucket=60, stats_field=None, percents=(50, 95, 99, 99.9),
+                 group_by=None, size=100):
+        """
+        :type es_query ElasticsearchQuery
+        :type query str
+        :type window int
+        :type bucket int
+        :type stats_field str or None
+        :type percents tuple[int]
+        :type group_by str or None
+        :type size int
+
+        :arg es_query: the instance used for querying, its copy with the time window moved is queried
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :arg window: the length of the window (in seconds), it's rounded to whole buckets
+        :arg bucket: the length of the bucket (in seconds)
+        :arg group_by: a "keyword" field to group results by
+        """
+        import copy  # pylint: disable=import-outside-toplevel
+
+        # the time window of the copy is moved, the caller's instance is left intact
+        self._es_query = copy.copy(es_query)
+        self._window = window
+
+        # get_histogram arguments
+        self._histogram = {
+            'query': query,
+            'interval': bucket,
+            'stats_field': stats_field,
+            'percents': percents,
+            'group_by': group_by,
+            'size': size,
+        }
+
+        # the beginning of the bucket -> {group key: {"count": 123, "50.0": 12.3, ...}}
+        self._buckets = {}
+        self._settled = set()
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _update(self):
+        """
+        Query for the buckets that are new or not settled yet, evict the ones that are out of the window
+        """
+        to = int(time.time()) - self._es_query.SHORT_DELAY
+        bucket = self._histogram['interval']
+
+        # the first bucket that starts within the window
+        start = -(-(to - self._window) // bucket) * bucket
+
+        for timestamp in [timestamp for timestamp in self._buckets if timestamp < start]:
+            del self._buckets[timestamp]
+            self._settled.discard(timestamp)
+
+        missing = [
+            timestamp for timestamp in range(start, to + 1, bucket)
+            if timestamp not in self._settled
+        ]
+
+        if not missing:
+            return
+
+        self._logger.info("Querying for %d buckets since %s",
+                          len(missing), self._es_query.format_timestamp(missing[0]))
+
+        # pylint: disable=protected-access
+        self._es_query._set_time_window(since=missing[0], to=to)
+
+        res = self._es_query.get_histogram(**self._histogram)
+
+        histograms = res.items() if self._histogram['group_by'] is not None else [(None, res)]
+
+        for timestamp in missing:
+            self._buckets[timestamp] = {}
+
+        for key, histogram in histograms:
+            for idx, timestamp in enumerate(histogram['timestamps']):
+                if timestamp not in self._buckets or not histogram['counts'][idx]:
+                    continue
+
+                entry = {'count': histogram['counts'][idx]}
+
+                if self._histogram['stats_field'] is not None:
+                    for percent in histogram:
+                        if percent not in ('timestamps', 'counts'):
+                            entry[percent] = histogram[percent][idx]
+
+                self._buckets[timestamp][key] = entry
+
+        for timestamp in missing:
+            if timestamp + bucket <= to:
+                self._settled.add(timestamp)
+
+    def get(self):
+        """
+        Returns rows count (+ percentile stats) in the window, grouped by a given field when group_by is provided
+
+        Percentiles are approximated with the average of buckets' percentiles weighted by their rows count
+        (buckets with no percentile value are skipped).
+
+        :rtype: dict
+        """
+        self._update()
+
+        totals = {}
+
+        # group key -> {percent: rows count of buckets with a value of this percentile}
+        weights = {}
+
+        for groups in self._buckets.values():
+            for key, entry in groups.items():
+                total = totals.setdefault(key, {'count': 0})
+                total['count'] += entry['count']
+
+                for percent, value in entry.items():
+                    if percent != 'count' and value is not None:
+                        total[percent] = total.get(percent, 0) + value * entry['count']
+                        weights.setdefault(key, {})[percent] = weights.get(key, {}).get(percent, 0) + entry['count']
+
+        for key, total in totals.items():
+            for percent in total:
+                if percent != 'count':
+                    total[percent] /= float(weights[key][percent])
+
+        if self._histogram['group_by'] is None:
+            return totals.get(None, {'count': 0})
+
+        return totals
+
+    def count(self):
+        """
+        Returns rows count in the window
+
+        :rtype: int
+        """
+        res = self.get()
+
+        if self._histogram['group_by'] is None:
+            return res['count']
+
+        return sum(entry['count'] for entry in res.values())
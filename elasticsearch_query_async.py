@@ -0,0 +1,706 @@
+"""
+asyncio-native flavour of ElasticsearchQuery. Requires Python 3.6+ and aiohttp.
+
+@see https://docs.aiohttp.org/en/stable/client.html
+"""
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, ConnectionTimeout, \
+    HTTP_EXCEPTIONS, SerializationError, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+from elasticsearch_query_aggregations import AggregationsBodyMixin
+from elasticsearch_query_base import BaseElasticsearchQuery
+from elasticsearch_query_common import ElasticsearchQueryError, ColumnarResult, IncompleteResultsError
+from elasticsearch_query_pagination import PaginationPolicyMixin
+from elasticsearch_query_search import SearchBodyMixin
+
+
+class AsyncTransport(object):
+    """
+    Non-blocking HTTP transport for Elasticsearch REST API. A single instance (and its connection pool)
+    can be shared by many AsyncElasticsearchQuery instances.
+    """
+    DEFAULT_PORT = 9200
+
+    def __init__(self, hosts, timeout=10, maxsize=100, serializer=None):
+        """
+        :type hosts str or list[str]
+        :type timeout int
+        :type maxsize int
+        :type serializer JSONSerializer or None
+
+        :arg hosts: Elasticsearch host(s) that should be used for querying
+        :arg timeout: read timeout (in seconds)
+        :arg maxsize: the maximum number of connections kept open in the pool
+        :arg serializer: encodes requests and decodes responses bodies (defaults to JSONSerializer)
+        """
+        self._hosts = self._normalize_hosts(hosts)
+        self._timeout = timeout
+        self._maxsize = maxsize
+        self._serializer = serializer or JSONSerializer()
+
+        self._host_idx = 0
+        self._session = None
+
+    @classmethod
+    def _normalize_hosts(cls, hosts):
+        """
+        :type hosts str or list[str]
+        :rtype: list[str]
+        """
+        if isinstance(hosts, str):
+            hosts = hosts.split(',')
+
+        res = []
+        for host in hosts:
+            host = host.strip().rstrip('/')
+
+            if '://' not in host:
+                host = 'http://' + host
+
+            # add the default port when none is provided
+            if host.count(':') == 1:
+                host += ':{}'.format(cls.DEFAULT_PORT)
+
+            res.append(host)
+
+        return res
+
+    def _get_session(self):
+        """
+        The session needs to be created within the event loop, hence it's done lazily
+
+        :rtype: aiohttp.ClientSession
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._maxsize),
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+            )
+
+        return self._session
+
+    def _get_host(self):
+        """
+        Round-robin over the hosts
+
+        :rtype: str
+        """
+        host = self._hosts[self._host_idx % len(self._hosts)]
+        self._host_idx += 1
+        return host
+
+    async def _request(self, method, path, params=None, body=None):
+        """
+        :type method str
+        :type path str
+        :type params dict or None
+        :arg body: the request body, a list is sent as newline-delimited JSON (e.g. for the Multi Search API)
+        :type body dict or list or None
+        :rtype: tuple[int, str]
+        """
+        url = self._get_host() + path
+        params = {key: str(value) for key, value in (params or {}).items()}
+
+        if isinstance(body, list):
+            data = ''.join(self._serializer.dumps(line) + '\n' for line in body)
+            content_type = 'application/x-ndjson'
+        else:
+            data = self._serializer.dumps(body) if body is not None else None
+            content_type = 'application/json'
+
+        try:
+            async with self._get_session().request(
+                    method, url, params=params, data=data, headers={'Content-Type': content_type}) as resp:
+                return resp.status, (await resp.text() if method != 'HEAD' else '')
+        except asyncio.TimeoutError as ex:
+            raise ConnectionTimeout('TIMEOUT', str(ex), ex)
+        except aiohttp.ClientError as ex:
+            raise ESConnectionError('N/A', str(ex), ex)
+
+    async def perform_request(self, method, path, params=None, body=None, ignore=()):
+        """
+        :type method str
+        :type path str
+        :type params dict or None
+        :type body dict or list or None
+        :type ignore tuple[int]
+        :rtype: dict
+        """
+        status, raw = await self._request(method, path, params, body)
+
+        try:
+            payload = self._serializer.loads(raw) if raw else {}
+        except SerializationError:
+            payload = raw
+
+        if not 200 <= status < 300 and status not in ignore:
+            error = payload.get('error', payload) if isinstance(payload, dict) else payload
+            if isinstance(error, dict):
+                error = error.get('type', error)
+
+            raise HTTP_EXCEPTIONS.get(status, TransportError)(status, error, payload)
+
+        return payload
+
+    async def exists(self, path):
+        """
+        :type path str
+        :rtype: bool
+        """
+        status, _ = await self._request('HEAD', path)
+        return 200 <= status < 300
+
+    async def close(self):
+        """
+        Close the session and its connections
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncElasticsearchQuery(SearchBodyMixin, AggregationsBodyMixin, PaginationPolicyMixin, BaseElasticsearchQuery):
+    """
+    asyncio-native Elasticsearch client. It builds the same requests as ElasticsearchQuery (and shares
+    the time window logic with it), but all methods are coroutines (or asynchronous generators).
+
+    async with AsyncElasticsearchQuery(es_host='es.prod', index_prefix='logstash-my-app') as es_query:
+        await es_query.count(query='@message:"^PHP Fatal"')
+    """
+    def __init__(self, es_host, *args, transport=None, **kwargs):
+        """
+        Takes the same arguments as ElasticsearchQuery, ValueError is raised for options that are not supported:
+        cache, stats_callback, time partitions, sliced scrolls, search_after pagination (and point in time),
+        docvalues projection and the client that is not AsyncTransport.
+
+        :type transport AsyncTransport or None
+        :arg transport: share the connection pool between many instances (es_host and read_timeout are ignored then)
+        """
+        super(AsyncElasticsearchQuery, self).__init__(es_host, *args, **kwargs)
+
+        pagination = self._options.pagination
+
+        unsupported = [
+            ('cache', self._options.cache is not None),
+            ('stats_callback', self._options.stats_callback is not None),
+            ('pagination_options.partitions > 1', pagination.partitions > 1),
+            ('pagination_options.parallelism > 1', pagination.parallelism > 1),
+            ("pagination_options.method='{}'".format(pagination.method), pagination.method != 'scroll'),
+            ('pagination_options.point_in_time', pagination.point_in_time),
+            ("pagination_options.projection='{}'".format(pagination.projection), pagination.projection != 'source'),
+        ]
+
+        for option, is_set in unsupported:
+            if is_set:
+                raise ValueError('{} is not supported by AsyncElasticsearchQuery'.format(option))
+
+        if self._client is not None and not isinstance(self._client, AsyncTransport):
+            raise ValueError('client_options.client needs to be AsyncTransport, got {}'.format(
+                self._client.__class__.__name__))
+
+        if transport is not None:
+            self._client = transport
+
+        # the transport created by this instance is closed by it
+        self._owns_transport = self._client is None
+
+    @property
+    def _es(self):
+        """
+        The transport is created on the first use (unless the existing one is provided)
+
+        :rtype: AsyncTransport
+        """
+        if self._client is None:
+            client_options = self._options.client
+
+            self._client = AsyncTransport(
+                hosts=self._options.es_host, timeout=self._options.read_timeout, maxsize=client_options.maxsize,
+                serializer=self._create_serializer(client_options.serializer))
+
+        return self._client
+
+    async def close(self):
+        """
+        Close the connection pool (unless it's shared one)
+        """
+        if self._owns_transport and self._client is not None:
+            await self._client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _get_index(self):
+        """
+        Comma-separated list of indices to query
+
+        :rtype: str
+        """
+        indices = self._indices
+
+        if self._options.check_indices:
+            existing = []
+
+            for index in indices:
+                exists = self._get_cached_index_exists(index)
+
+                if exists is None:
+                    exists = await self._es.exists('/' + index)
+                    self._set_cached_index_exists(index, exists)
+
+                if exists:
+                    existing.append(index)
+
+            # fall back to all indices when none exists, Elasticsearch will report a missing index then
+            indices = existing or indices
+
+        return ','.join(indices)
+
+    async def _with_retries(self, request, retry_on=None):
+        """
+        Await the request, retry it with an exponential backoff when a transient error occurs.
+        IncompleteResultsError is raised when retries do not help.
+
+        :arg request: returns the awaitable request
+        :type request callable
+        :arg retry_on: tells which errors are worth retrying (defaults to the transient ones)
+        :type retry_on callable or None
+        :rtype: dict
+        """
+        attempt = 0
+
+        while True:
+            try:
+                return await request()
+            except TransportError as ex:
+                attempt += 1
+                await asyncio.sleep(self._get_retry_delay(ex, attempt, retry_on))
+
+    @staticmethod
+    def _is_unprocessed_error(ex):
+        """
+        Tells whether the request surely was not processed - it was rejected (429 Too Many Requests)
+        or the connection could not be established.
+
+        :type ex TransportError
+        :rtype: bool
+        """
+        if ex.status_code == 429:
+            return True
+
+        # AsyncTransport wraps aiohttp errors, ClientConnectorError is raised when connecting fails
+        return isinstance(ex, ESConnectionError) and isinstance(ex.info, aiohttp.ClientConnectorError)
+
+    async def _search_once(self, body, limit, sampling):
+        """
+        Yield a single page of hits using a plain search request, no scroll context is created.
+        Used when the limit fits in a single page.
+
+        :type body dict
+        :type limit int
+        :type sampling int or None
+        :rtype: list[list[dict]]
+        """
+        body = self._get_single_page_body(body, limit, sampling)
+        path = '/{}/_search'.format(await self._get_index())
+
+        resp = await self._with_retries(lambda: self._es.perform_request(
+            'POST', path, params={'filter_path': self._get_filter_path(self.SEARCH_FILTER_PATH)}, body=body))
+        self._check_shards(resp)
+
+        hits = self._get_hits(resp)
+
+        if hits:
+            yield hits
+
+    async def _scroll(self, body):
+        """
+        Yield pages of hits using the Scroll API. The scroll context is cleared
+        when the generator is exhausted, fails or is closed by the consumer.
+
+        Scroll requests are retried only when they were surely not processed by Elasticsearch (it could have
+        moved the scroll forward otherwise), IncompleteResultsError is raised when the scroll can not be continued.
+
+        :type body dict
+        :rtype: list[list[dict]]
+        """
+        body = dict(body)
+        body['sort'] = ["_doc"]
+
+        filter_path = self._get_filter_path(self.SCROLL_FILTER_PATH)
+        path = '/{}/_search'.format(await self._get_index())
+
+        resp = await self._with_retries(lambda: self._es.perform_request(
+            'POST', path,
+            params={'scroll': self.SCROLL_TIMEOUT, 'size': self._options.batch_size, 'filter_path': filter_path},
+            body=body))
+        scroll_id = resp.get('_scroll_id')
+
+        try:
+            while True:
+                self._check_shards(resp)
+                hits = self._get_hits(resp)
+
+                if not hits:
+                    break
+
+                yield hits
+
+                if scroll_id is None:
+                    break
+
+                resp = await self._get_scroll_page(scroll_id, filter_path)
+                scroll_id = resp.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id is not None:
+                await self._clear_scroll(scroll_id)
+
+    async def _get_scroll_page(self, scroll_id, filter_path):
+        """
+        Request the next page of the scroll. Only the requests that were not processed are retried.
+
+        :type scroll_id str
+        :type filter_path str
+        :rtype: dict
+        """
+        try:
+            return await self._with_retries(lambda: self._es.perform_request(
+                'POST', '/_search/scroll', params={'filter_path': filter_path},
+                body={'scroll': self.SCROLL_TIMEOUT, 'scroll_id': scroll_id}), retry_on=self._is_unprocessed_error)
+        except TransportError as ex:
+            raise IncompleteResultsError('Scroll failed: {}'.format(ex))
+
+    async def _clear_scroll(self, scroll_id):
+        """
+        Release the scroll context on the cluster (some clusters respond with 403 Forbidden here,
+        the context will then simply expire after SCROLL_TIMEOUT)
+
+        :type scroll_id str
+        """
+        await self._es.perform_request('DELETE', '/_search/scroll', body={'scroll_id': [scroll_id]}, ignore=(403, 404))
+
+    async def _iter_search(self, query, fields=None, limit=50000, sampling=None, pages=False):
+        """
+        Perform the search and yield raw rows as soon as each page is received
+
+        :type query object
+        :type fields list[str] or None
+        :type limit int
+        :type sampling int or None
+        :type pages bool
+        :rtype: list[dict]
+        """
+        body = self._get_search_body(query, fields, sampling)
+
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("Running %s query (limit set to %d)", json.dumps(body), limit)
+
+        # no scroll context is needed when the limit fits in a single page
+        scroll = self._search_once(body, limit, sampling) if limit <= self._options.batch_size else self._scroll(body)
+        remaining = limit
+
+        try:
+            async for hits in scroll:
+                page = [self._get_row(entry) for entry in hits[:remaining]]
+                remaining -= len(page)
+
+                if pages:
+                    yield page
+                else:
+                    for row in page:
+                        yield row
+
+                if remaining <= 0:
+                    break
+        finally:
+            # release the scroll context now instead of waiting for the generator to be garbage collected
+            await scroll.aclose()
+
+    async def _search(self, query, fields=None, limit=50000, sampling=None, columnar=False):
+        """
+        Perform the search and return raw rows, rows fetched before a failure are kept in IncompleteResultsError
+
+        :type query object
+        :type fields list[str] or None
+        :type limit int
+        :type sampling int or None
+        :type columnar bool
+        :rtype: list or ColumnarResult
+        """
+        rows = ColumnarResult(fields) if columnar else []
+
+        try:
+            async for page in self._iter_search(query, fields, limit, sampling, pages=True):
+                if columnar:
+                    rows.add_rows(page)
+                else:
+                    rows.extend(page)
+        except IncompleteResultsError as ex:
+            ex.rows = rows
+            raise
+
+        self._logger.info("{:d} rows returned".format(len(rows)))
+        return rows
+
+    async def get_rows(self, match, fields=None, limit=10, sampling=None, columnar=False):
+        """
+        Returns raw rows that matches given query
+
+        :arg match: query to be run against Kibana log messages (ex. {"@message": "Foo Bar DB queries"})
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type columnar bool
+        :arg columnar: return ColumnarResult instead of the list of rows
+        """
+        return await self._search({"match": match}, fields, limit, sampling, columnar)
+
+    def iter_rows(self, match, fields=None, limit=10, sampling=None, pages=False):
+        """
+        Asynchronously yields raw rows that matches given query as they're fetched from Elasticsearch
+
+        :arg match: query to be run against Kibana log messages (ex. {"@message": "Foo Bar DB queries"})
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type pages bool
+        :arg pages: yield lists of rows (one per page of hits) instead of single rows
+        """
+        return self._iter_search({"match": match}, fields, limit, sampling, pages)
+
+    async def query_by_string(self, query, fields=None, limit=10, sampling=None, columnar=False):
+        """
+        Returns raw rows that matches the given query string
+
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type columnar bool
+        :arg columnar: return ColumnarResult instead of the list of rows
+        """
+        return await self._search({"query_string": {"query": query}}, fields, limit, sampling, columnar)
+
+    def iter_query_by_string(self, query, fields=None, limit=10, sampling=None, pages=False):
+        """
+        Asynchronously yields raw rows that matches the given query string as they're fetched from Elasticsearch
+
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type pages bool
+        :arg pages: yield lists of rows (one per page of hits) instead of single rows
+        """
+        return self._iter_search({"query_string": {"query": query}}, fields, limit, sampling, pages)
+
+    async def count(self, query):
+        """
+        Returns number of matching entries
+
+        :type query str
+        :rtype: int
+        """
+        resp = await self._es.perform_request(
+            'POST', '/{}/_count'.format(await self._get_index()),
+            params={'filter_path': self._get_filter_path('count')}, body=self._get_count_body(query))
+
+        return resp.get('count')
+
+    async def iter_query_by_sql(self, sql, fetch_size=1000):
+        """
+        Asynchronously yields entries matching given SQL query, the next page of results is fetched when needed
+
+        :type sql str
+        :type fetch_size int
+        :rtype: list[dict]
+        """
+        pages = self._iter_sql_pages(sql, fetch_size)
+
+        try:
+            async for columns, rows in pages:
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            await pages.aclose()
+
+    async def _iter_sql_pages(self, sql, fetch_size):
+        """
+        Yields (columns, rows) tuple for each page of SQL query results
+
+        :type sql str
+        :type fetch_size int
+        :rtype: tuple[list[str], list[list]]
+        """
+        resp = await self._es.perform_request(
+            'POST', '/_xpack/sql', params={'format': 'json'}, body={'query': sql, 'fetch_size': fetch_size})
+
+        columns = [column['name'] for column in resp.get('columns')]
+        cursor = resp.get('cursor')
+
+        try:
+            while True:
+                yield columns, resp.get('rows', [])
+
+                if not cursor:
+                    break
+
+                resp = await self._es.perform_request(
+                    'POST', '/_xpack/sql', params={'format': 'json'}, body={'cursor': cursor})
+                cursor = resp.get('cursor')
+        finally:
+            if cursor:
+                await self._es.perform_request('POST', '/_xpack/sql/close', body={'cursor': cursor})
+
+    async def query_by_sql(self, sql, fetch_size=1000, result_format='dicts'):
+        """
+        Returns entries matching given SQL query
+
+        :type sql str
+        :type fetch_size int
+        :type result_format str
+        :rtype: list[dict] or tuple[list[str], list[tuple]] or OrderedDict
+        """
+        if result_format not in ('dicts', 'tuples', 'columns'):
+            raise ElasticsearchQueryError('Unsupported SQL result format: {}'.format(result_format))
+
+        pages = [page async for page in self._iter_sql_pages(sql, fetch_size)]
+
+        return self._get_sql_result(pages, result_format)
+
+    async def get_aggregations(self, query, group_by, stats_field, percents=(50, 95, 99, 99.9), size=100):
+        """
+        Returns aggregations (rows count + percentile stats) for a given query
+
+        :type query str
+        :type group_by str
+        :type stats_field str
+        :type percents tuple[int]
+        :type size int
+        :rtype: dict
+        """
+        body = self._get_aggregations_body(query, group_by, stats_field, percents, size)
+
+        self._logger.info("Getting aggregations for %s field when grouped by %s", group_by, stats_field)
+
+        res = await self._es.perform_request(
+            'POST', '/{}/_search'.format(await self._get_index()),
+            params={'size': 0, 'filter_path': self._get_filter_path('aggregations')}, body=body)
+
+        return self._get_aggregations_from_response(res)
+
+    async def _msearch(self, bodies, chunk_size, concurrency):
+        """
+        Runs chunks of requests using the Multi Search API, up to concurrency chunks at once
+
+        :type bodies list[dict]
+        :type chunk_size int
+        :type concurrency int
+        :rtype: list[dict|ElasticsearchQueryError]
+        """
+        chunks = [bodies[idx:idx + chunk_size] for idx in range(0, len(bodies), chunk_size)]
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        path = '/{}/_msearch'.format(await self._get_index())
+
+        async def run(chunk):
+            async with semaphore:
+                try:
+                    resp = await self._es.perform_request('POST', path, body=self._get_msearch_lines(chunk))
+                except TransportError as ex:
+                    self._logger.error("Multi search request failed: %s", ex)
+                    return [ElasticsearchQueryError(str(ex))] * len(chunk)
+
+            return self._get_msearch_results(resp['responses'])
+
+        self._logger.info("Running %d queries in %d multi search requests", len(bodies), len(chunks))
+
+        results = await asyncio.gather(*[run(chunk) for chunk in chunks])
+
+        return [resp for chunk in results for resp in chunk]
+
+    async def count_many(self, queries, chunk_size=100, concurrency=1):
+        """
+        Returns number of matching entries for each of given queries using a single Multi Search API request
+        (per chunk of queries)
+
+        :type queries list[str]
+        :type chunk_size int
+        :type concurrency int
+        :rtype: list[int|ElasticsearchQueryError]
+        """
+        bodies = [self._get_total_hits_body(query) for query in queries]
+
+        return self._get_counts(await self._msearch(bodies, chunk_size, concurrency))
+
+    async def search_many(self, bodies, chunk_size=100, concurrency=1):
+        """
+        Runs given search requests using a single Multi Search API request (per chunk of requests)
+        and returns raw responses
+
+        :type bodies list[dict]
+        :type chunk_size int
+        :type concurrency int
+        :rtype: list[dict|ElasticsearchQueryError]
+        """
+        bodies = [self._add_timestamp_filter(body) for body in bodies]
+
+        return await self._msearch(bodies, chunk_size, concurrency)
+
+    async def get_histogram(self, query, interval, stats_field=None, percents=(50, 95, 99, 99.9), group_by=None,
+                            size=100):
+        """
+        Returns time-ordered arrays of rows count (+ optionally percentile stats) per time interval for a given query
+
+        :type query str
+        :type interval int or str
+        :type stats_field str or None
+        :type percents tuple[int]
+        :type group_by str or None
+        :type size int
+        :rtype: dict
+        """
+        body = self._get_histogram_body(query, interval, stats_field, percents, group_by, size)
+
+        self._logger.info("Getting %s histogram for %s query", interval, query)
+
+        res = await self._es.perform_request(
+            'POST', '/{}/_search'.format(await self._get_index()),
+            params={'filter_path': self._get_filter_path('aggregations')}, body=body)
+
+        return self._get_histogram_from_response(res, stats_field, group_by)
+
+    async def iter_aggregations(self, query, group_by, stats_field, percents=(50, 95, 99, 99.9), page_size=100):
+        """
+        Asynchronously yields (key, count, percentiles) tuples for all groups, fetched page by page
+
+        :type query str
+        :type group_by str or list[str]
+        :type stats_field str
+        :type percents tuple[int]
+        :type page_size int
+        :rtype: tuple[object, int, dict]
+        """
+        fields = [group_by] if isinstance(group_by, str) else list(group_by)
+        body = self._get_aggregations_page_body(query, fields, stats_field, percents, page_size)
+        path = '/{}/_search'.format(await self._get_index())
+
+        while body is not None:
+            res = await self._es.perform_request(
+                'POST', path, params={'filter_path': self._get_filter_path('aggregations')}, body=body)
+            groups, body = self._get_aggregations_page(res, body, fields, page_size)
+
+            for group in groups:
+                yield group
@@ -0,0 +1,375 @@
+"""
+The base of ElasticsearchQuery and AsyncElasticsearchQuery - their options, the time window
+and the indices it spans, JSON serializers and the bodies of count requests.
+"""
+import functools
+import logging
+import threading
+import time
+import warnings
+
+from collections import OrderedDict, namedtuple
+
+from elasticsearch_query_common import ElasticsearchQueryError, ClientOptions, PaginationOptions, SamplingOptions, \
+    OrjsonSerializer, UjsonSerializer, _create_json_serializer, _InstrumentedSerializer
+
+# options of ElasticsearchQuery instance, partitions of its time window get copies with some of them changed
+_QueryOptions = namedtuple('_QueryOptions', [
+    'es_host', 'read_timeout', 'index_prefix', 'index_sep', 'check_indices', 'batch_size', 'cache', 'stats_callback',
+    'pagination', 'sampling', 'client', 'to_exclusive', 'cacheable',
+])
+
+# the constructor's keyword arguments of the previous versions -> (the options argument, its field)
+_FLAT_OPTIONS = {
+    'parallelism': ('pagination_options', 'parallelism'),
+    'partitions': ('pagination_options', 'partitions'),
+    'ordered_partitions': ('pagination_options', 'ordered_partitions'),
+    'pagination': ('pagination_options', 'method'),
+    'point_in_time': ('pagination_options', 'point_in_time'),
+    'max_retries': ('pagination_options', 'max_retries'),
+    'retry_backoff': ('pagination_options', 'retry_backoff'),
+    'projection': ('pagination_options', 'projection'),
+    'sampling_method': ('sampling_options', 'method'),
+    'sampling_field': ('sampling_options', 'field'),
+    'client': ('client_options', 'client'),
+    'serializer': ('client_options', 'serializer'),
+    'maxsize': ('client_options', 'maxsize'),
+    'http_compress': ('client_options', 'http_compress'),
+    'share_client': ('client_options', 'share_client'),
+}
+
+_OPTIONS_CLASSES = {
+    'pagination_options': PaginationOptions,
+    'sampling_options': SamplingOptions,
+    'client_options': ClientOptions,
+}
+
+
+def _accepts_flat_options(init):
+    """
+    Lets the constructor be called with the options passed as separate keyword arguments (as the previous
+    versions were), they are moved to PaginationOptions, SamplingOptions and ClientOptions
+
+    :type init callable
+    :rtype: callable
+    """
+    @functools.wraps(init)
+    def wrapper(self, *args, **kwargs):
+        flat = sorted(name for name in kwargs if name in _FLAT_OPTIONS)
+
+        if flat:
+            warnings.warn('{} arguments are deprecated, pass them in pagination_options, sampling_options '
+                          'or client_options instead'.format(', '.join(flat)), DeprecationWarning, stacklevel=2)
+
+        grouped = {}
+
+        for name in flat:
+            argument, field = _FLAT_OPTIONS[name]
+            grouped.setdefault(argument, {})[field] = kwargs.pop(name)
+
+        for argument, fields in grouped.items():
+            # the fields passed separately override the ones of options passed too (values are validated again)
+            options = kwargs.get(argument) or _OPTIONS_CLASSES[argument]()
+            kwargs[argument] = _OPTIONS_CLASSES[argument](**dict(options._asdict(), **fields))
+
+        return init(self, *args, **kwargs)
+
+    return wrapper
+
+
+class BaseElasticsearchQuery(object):
+    """
+    Options and the time window of the query, extended by ElasticsearchQuery and AsyncElasticsearchQuery
+    with the requests sent using the blocking and the asyncio client respectively
+    """
+    # give 5 seconds for all log messages to reach logstash and be stored in elasticsearch
+    SHORT_DELAY = 5
+
+    # seconds in 24h used to get the es index for yesterday
+    DAY = 86400
+
+    # wildcard index will be queried when the time window spans more daily indices than this
+    MAX_INDICES = 31
+
+    # for how long (in seconds) the information about existing indices should be cached
+    INDICES_CACHE_TTL = 300
+
+    # the shards counters kept in every response to tell partial results from complete ones
+    SHARDS_FILTER_PATH = '_shards.total,_shards.successful,_shards.failed'
+
+    # JSON serializers that can be chosen by name, "auto" picks the first one that is installed
+    SERIALIZERS = OrderedDict([
+        ('orjson', OrjsonSerializer),
+        ('ujson', UjsonSerializer),
+        ('json', _create_json_serializer),
+    ])
+
+    # (es_host, index name) -> (exists, time of the check)
+    _indices_cache = {}
+    _indices_cache_lock = threading.Lock()
+
+    @_accepts_flat_options
+    def __init__(
+            self, es_host, since=None, period=900,
+            read_timeout=10, index_prefix='logstash-other', index_sep='-', batch_size=1000,
+            check_indices=False, to=None, cache=None, stats_callback=None,
+            pagination_options=None, sampling_options=None, client_options=None):
+        """
+        :type es_host str
+        :type since int
+        :type period int
+        :type read_timeout int
+        :type index_prefix str
+        :type index_sep str
+        :type batch_size int
+        :type check_indices bool
+        :type to int
+        :type cache ResultsCache
+        :type stats_callback callable or None
+        :type pagination_options PaginationOptions or None
+        :type sampling_options SamplingOptions or None
+        :type client_options ClientOptions or None
+
+        :arg es_host: Elasticsearch host(s) that should be used for querying
+        :arg since: UNIX timestamp data should be fetched since
+        :arg period: period (in seconds) before now() to be used when since is empty(defaults to last 15 minutes)
+        :arg read_timeout: customize Elasticsearch read timeout (defaults to 10 s)
+        :arg index_prefix name of the Elasticsearch index (defaults to 'logstash-other')
+        :arg batch_size size of the batch sent in every requests of the ELK scroll API (defaults to 1000)
+        :arg check_indices query only these indices from the time window that do exist (defaults to False)
+        :arg to: UNIX timestamp data should be fetched until (defaults to now() minus SHORT_DELAY)
+        :arg cache: results of queries for time windows that are already closed will be cached here
+        :arg stats_callback: called with QueryStats instance when each query is completed
+        :arg pagination_options: how rows are fetched - the pagination, its concurrency, retries and the projection
+        :arg sampling_options: how rows are sampled
+        :arg client_options: the Elasticsearch client to use or options of the one to create
+        """
+        self._options = _QueryOptions(
+            es_host=es_host,
+            read_timeout=read_timeout,
+            index_prefix=index_prefix,
+            index_sep=index_sep,
+            check_indices=check_indices,
+            batch_size=batch_size,
+            cache=cache,
+            stats_callback=stats_callback,
+            pagination=pagination_options or PaginationOptions(),
+            sampling=sampling_options or SamplingOptions(),
+            client=client_options or ClientOptions(),
+            to_exclusive=False,
+            # windows that end at the default "now" keep moving, so their results are never cached
+            cacheable=to is not None,
+        )
+
+        # the client is created on the first use (unless the existing one is provided)
+        self._client = self._options.client.client
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self._set_time_window(*self._get_time_window(since, period, to))
+
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info("Using %s indices", ','.join(self._indices))
+            self._logger.info("Querying for messages from between %s and %s",
+                              self.format_timestamp(self._since), self.format_timestamp(self._to))
+
+    def _get_time_window(self, since, period, to):
+        """
+        Returns the time window to query - the provided one or the last period seconds
+
+        :type since int or None
+        :type period int
+        :type to int or None
+        :rtype: tuple[int, int]
+        """
+        # if no timestamp provided, fallback to now() in UTC
+        now = int(time.time())
+
+        if since is None:
+            since = now - period
+        else:
+            since += 1
+            self._logger.info("Using provided %s timestamp as since (%d seconds ago)", since, now - since)
+
+        return since, to if to is not None else now - self.SHORT_DELAY  # give logs some time to reach Logstash
+
+    def _set_time_window(self, since, to):
+        """
+        Sets the time window to query and the indices it spans
+
+        :type since int
+        :type to int
+        """
+        self._since = since
+        self._to = to
+
+        # Elasticsearch indices to query - daily ones that the time window spans
+        self._indices = self.format_indices(prefix=self._options.index_prefix, since=since,
+                                            to=to - 1 if self._options.to_exclusive else to,
+                                            sep=self._options.index_sep)
+
+    def _create_serializer(self, serializer):
+        """
+        :type serializer str or JSONSerializer or None
+        :rtype: JSONSerializer
+        """
+        serializer = self.get_serializer(serializer)
+
+        if self._options.stats_callback is not None:
+            serializer = _InstrumentedSerializer(serializer)
+
+        return serializer
+
+    @classmethod
+    def get_serializer(cls, serializer=None):
+        """
+        :type serializer str or JSONSerializer or None
+        :rtype: JSONSerializer
+        """
+        if serializer is None:
+            serializer = 'json'
+
+        if not isinstance(serializer, str):
+            return serializer
+
+        if serializer == 'auto':
+            for serializer_class in cls.SERIALIZERS.values():
+                try:
+                    return serializer_class()
+                except ImportError:
+                    pass
+
+        if serializer not in cls.SERIALIZERS:
+            raise ElasticsearchQueryError('Unsupported serializer: {}'.format(serializer))
+
+        try:
+            return cls.SERIALIZERS[serializer]()
+        except ImportError as ex:
+            raise ElasticsearchQueryError('{} serializer is not available: {}'.format(serializer, ex))
+
+    @staticmethod
+    def format_index(prefix, timestamp, sep='-'):
+        """
+        :type prefix str
+        :type timestamp int
+        :type sep str
+        :rtype: str
+        """
+        # ex. logstash-other-2017.05.09
+        return "{prefix}{sep}{date}".format(
+            prefix=prefix, sep=sep, date=time.strftime('%Y.%m.%d', time.gmtime(timestamp)))
+
+    @classmethod
+    def format_indices(cls, prefix, since, to, sep='-'):
+        """
+        Returns the list of daily indices that the given time window spans
+
+        :type prefix str
+        :type since int
+        :type to int
+        :type sep str
+        :rtype: list[str]
+        """
+        indices = []
+        timestamp = since - since % cls.DAY  # the beginning of the UTC day
+
+        # ex. logstash-other-*
+        if (to - timestamp) // cls.DAY >= cls.MAX_INDICES:
+            return ['{prefix}{sep}*'.format(prefix=prefix, sep=sep)]
+
+        while timestamp <= to:
+            index = cls.format_index(prefix=prefix, timestamp=timestamp, sep=sep)
+
+            if index not in indices:
+                indices.append(index)
+
+            timestamp += cls.DAY
+
+        return indices
+
+    def _get_cached_index_exists(self, index):
+        """
+        :type index str
+        :rtype: bool or None
+        """
+        with self._indices_cache_lock:
+            cached = self._indices_cache.get((str(self._options.es_host), index))
+
+        if cached is not None and time.time() - cached[1] < self.INDICES_CACHE_TTL:
+            return cached[0]
+
+        return None
+
+    def _set_cached_index_exists(self, index, exists):
+        """
+        :type index str
+        :type exists bool
+        """
+        self._logger.debug("Index %s exists: %s", index, exists)
+
+        with self._indices_cache_lock:
+            self._indices_cache[(str(self._options.es_host), index)] = (exists, time.time())
+
+    @staticmethod
+    def format_timestamp(timestamp):
+        """
+        Format the UTC timestamp for Elasticsearch
+        eg. 2014-07-09T08:37:18.000Z
+
+        @see https://docs.python.org/2/library/time.html#time.strftime
+
+        :type timestamp int
+        :rtype: str
+        """
+        return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(timestamp))
+
+    def _get_timestamp_filer(self):
+        return {
+            "range": {
+                "@timestamp": {
+                    "gte": self.format_timestamp(self._since),
+                    # partitions (but the last one) do not include the beginning of the next one
+                    "lt" if self._options.to_exclusive else "lte": self.format_timestamp(self._to)
+                }
+            }
+        }
+
+    def _get_filter_path(self, filter_path):
+        """
+        Always keep the shards counters in responses, so that partial results can be detected.
+        Keep took and the entire _shards when stats are collected
+
+        :type filter_path str
+        :rtype: str
+        """
+        if self._options.stats_callback is not None:
+            return filter_path + ',took,_shards'
+
+        return filter_path + ',' + self.SHARDS_FILTER_PATH
+
+    def _get_count_body(self, query):
+        """
+        Build the body of the count request
+
+        :type query str
+        :rtype: dict
+        """
+        body = {
+            "query": {
+                "bool": {
+                    "must": [{
+                        "query_string": {
+                            "query": query,
+                        }
+                    }]
+                }
+            }
+        }
+
+        body['query']['bool']['must'].append(self._get_timestamp_filer())
+
+        return body
+
+    def get_to_timestamp(self):
+        """ Return the upper time boundary to returned data """
+        return self._to
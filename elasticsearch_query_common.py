@@ -0,0 +1,791 @@
+"""
+Building blocks of ElasticsearchQuery - errors, options, results caches, checkpoints, columnar results,
+JSON serializers and query stats.
+"""
+import importlib
+import json
+import math
+import os
+import threading
+import time
+
+from array import array
+from collections import OrderedDict, namedtuple
+
+
+class _LazyModule(object):  # pylint: disable=too-few-public-methods
+    """
+    Imports the module on the first access to its attributes
+    """
+    def __init__(self, name):
+        """
+        :type name str
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+
+# elasticsearch package (with urllib3 and numpy it imports) takes most of the import time of this module,
+# it's not needed by short-lived processes until the first query is run
+elasticsearch = _LazyModule('elasticsearch')
+
+
+def _import_numpy():
+    """
+    numpy is optional, it's used by ColumnarResult
+
+    :rtype: module or None
+    """
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+
+    return numpy
+
+
+class ElasticsearchQueryError(Exception):
+    """
+    Error that can be raised by ElasticsearchQuery class
+    """
+    pass
+
+
+class IncompleteResultsError(ElasticsearchQueryError):
+    """
+    Raised when fetching rows fails and retries did not help. Rows fetched so far are kept in rows
+    (by get_rows and query_by_string). Pass cursor to these methods to fetch the remaining rows.
+    """
+    def __init__(self, message, rows=None, cursor=None):
+        """
+        :type message str
+        :arg rows: rows fetched before the failure
+        :type rows list[dict] or ColumnarResult or None
+        :arg cursor: the position rows can be fetched from (None when fetching can not be resumed)
+        :type cursor dict or None
+        """
+        super(IncompleteResultsError, self).__init__(message)
+        self.rows = rows if rows is not None else []
+        self.cursor = cursor
+
+
+class ClientOptions(namedtuple('ClientOptions', ['client', 'serializer', 'maxsize', 'http_compress', 'share_client'])):
+    """
+    The Elasticsearch client used by ElasticsearchQuery or options of the one it creates
+
+    es_query = ElasticsearchQuery(es_host='es.prod', client_options=ClientOptions(serializer='orjson', maxsize=25))
+    """
+    __slots__ = ()
+
+    def __new__(cls, client=None, serializer=None, maxsize=10, http_compress=False, share_client=True):
+        """
+        :type client Elasticsearch or None
+        :type serializer str or JSONSerializer or None
+        :type maxsize int
+        :type http_compress bool
+        :type share_client bool
+
+        :arg client: use the existing Elasticsearch client (es_host and other client options are ignored then)
+        :arg serializer: JSON library used to encode requests and decode responses - 'json' (the default), 'orjson',
+                         'ujson', 'auto' (the fastest one installed) or elasticsearch-py serializer instance
+        :arg maxsize: the maximum number of connections kept open to each host (defaults to 10)
+        :arg http_compress: compress requests bodies and ask for compressed responses (defaults to False)
+        :arg share_client: use the client (and its pool of connections) shared by all instances with the same es_host
+                           and client options (defaults to True)
+        """
+        return super(ClientOptions, cls).__new__(cls, client, serializer, maxsize, http_compress, share_client)
+
+
+class PaginationOptions(namedtuple('PaginationOptions', [
+        'method', 'point_in_time', 'parallelism', 'partitions', 'ordered_partitions', 'max_retries', 'retry_backoff',
+        'projection'])):
+    """
+    How ElasticsearchQuery fetches rows - the pagination, its concurrency, retries of failed page requests
+    and the projection of fields
+
+    es_query = ElasticsearchQuery(es_host='es.prod', pagination_options=PaginationOptions(method='search_after'))
+    """
+    __slots__ = ()
+
+    def __new__(cls, method='scroll', point_in_time=False, parallelism=1, partitions=1, ordered_partitions=True,
+                max_retries=None, retry_backoff=None, projection='source'):
+        """
+        :type method str
+        :type point_in_time bool
+        :type parallelism int
+        :type partitions int
+        :type ordered_partitions bool
+        :type max_retries int or None
+        :type retry_backoff float or None
+        :type projection str
+
+        :arg method: how rows are fetched - 'scroll' (the default) or 'search_after'
+        :arg point_in_time: use point-in-time with search_after pagination when the cluster supports it
+        :arg parallelism: number of sliced scrolls to be fetched concurrently when querying for rows (defaults to 1)
+        :arg partitions: split the time window into sub-ranges and query up to this number of them concurrently
+                         when getting rows and counting them (defaults to 1, i.e. no partitioning)
+        :arg ordered_partitions: return rows from partitions in the time order (the default), otherwise rows are
+                                 returned as soon as they are received from any partition
+        :arg max_retries: how many times a failed page request should be retried (defaults to MAX_PAGE_RETRIES)
+        :arg retry_backoff: how long (in seconds) to wait before the first retry, the delay is doubled for each
+                            following one (defaults to RETRY_BACKOFF)
+        :arg projection: how fields passed to get_rows and query_by_string are fetched - "source" (filter _source,
+                         the default) or "docvalues" (read doc values or stored fields where the mapping allows it,
+                         filter _source for the remaining ones)
+        """
+        if method not in ('scroll', 'search_after'):
+            raise ElasticsearchQueryError('Unsupported pagination: {}'.format(method))
+
+        if projection not in ('source', 'docvalues'):
+            raise ElasticsearchQueryError('Unsupported projection: {}'.format(projection))
+
+        return super(PaginationOptions, cls).__new__(
+            cls, method, point_in_time, parallelism, partitions, ordered_partitions, max_retries, retry_backoff,
+            projection)
+
+
+class SamplingOptions(namedtuple('SamplingOptions', ['method', 'field'])):
+    """
+    How ElasticsearchQuery samples rows when the sampling percentage is passed to get_rows and query_by_string
+
+    es_query = ElasticsearchQuery(es_host='es.prod', sampling_options=SamplingOptions('hash_field', 'sampling_hash'))
+    """
+    __slots__ = ()
+
+    def __new__(cls, method='random_score', field=None):
+        """
+        :type method str
+        :type field str or None
+
+        :arg method: how rows are sampled - 'random_score' (the default), 'hash_field' or 'script'
+        :arg field: field random_score is computed from (defaults to _seq_no) or the one with a hash
+                    in [0, 100) range set at the ingest time (required by 'hash_field' method)
+        """
+        if method not in ('random_score', 'hash_field', 'script'):
+            raise ElasticsearchQueryError('Unsupported sampling method: {}'.format(method))
+
+        if method == 'hash_field' and field is None:
+            raise ElasticsearchQueryError('field needs to be provided for hash_field sampling')
+
+        return super(SamplingOptions, cls).__new__(cls, method, field)
+
+
+class ResultsCache(object):
+    """
+    Base class for the results cache, keeps track of hits and misses
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+        # the cache can be shared by instances used in different threads
+        self._counters_lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :type key str
+        :rtype: object or None
+        """
+        value = self._get(key)
+
+        with self._counters_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def set(self, key, value):
+        """
+        :type key str
+        :type value object
+        """
+        self._set(key, value)
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def _set(self, key, value):
+        raise NotImplementedError()
+
+
+class LRUCache(ResultsCache):
+    """
+    In-process cache that keeps up to max_size least recently used entries for up to ttl seconds
+
+    Results are stored pickled (and unpickled on each get), so that callers can modify them.
+    """
+    def __init__(self, max_size=1000, ttl=3600):
+        """
+        :type max_size int
+        :type ttl int or None
+        """
+        super(LRUCache, self).__init__()
+
+        self._max_size = max_size
+        self._ttl = ttl
+
+        # key -> (pickled value, time it was set)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        import pickle  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or (self._ttl is not None and time.time() - entry[1] > self._ttl):
+                return None
+
+            # mark as the most recently used one
+            self._entries[key] = entry
+
+        return pickle.loads(entry[0])
+
+    def _set(self, key, value):
+        import pickle  # pylint: disable=import-outside-toplevel
+
+        # immutable bytes are stored, so the entry can not be modified by the caller
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+
+class DiskCache(ResultsCache):
+    """
+    On-disk cache (one pickle file per entry) that survives process restarts
+    """
+    def __init__(self, directory, ttl=None):
+        """
+        :type directory str
+        :type ttl int or None
+        """
+        super(DiskCache, self).__init__()
+
+        self._directory = directory
+        self._ttl = ttl
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, '{}.pickle'.format(key))
+
+    def _get(self, key):
+        import pickle  # pylint: disable=import-outside-toplevel
+
+        path = self._get_path(key)
+
+        try:
+            if self._ttl is not None and time.time() - os.path.getmtime(path) > self._ttl:
+                os.remove(path)
+                return None
+
+            with open(path, 'rb') as handler:
+                return pickle.load(handler)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _set(self, key, value):
+        import pickle  # pylint: disable=import-outside-toplevel
+        import tempfile  # pylint: disable=import-outside-toplevel
+
+        # write to a temporary file first, so that concurrent readers never get a partial entry
+        handle, tmp_path = tempfile.mkstemp(dir=self._directory)
+
+        with os.fdopen(handle, 'wb') as handler:
+            pickle.dump(value, handler, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp_path, self._get_path(key))
+
+
+class Checkpoint(object):
+    """
+    Keeps the position of ElasticsearchQuery.follow in memory. Sub-class it to store it elsewhere.
+    """
+    def __init__(self, cursor=None):
+        """
+        :type cursor dict or None
+        """
+        self._cursor = cursor
+
+    def load(self):
+        """
+        :rtype: dict or None
+        """
+        return self._cursor
+
+    def save(self, cursor):
+        """
+        :type cursor dict
+        """
+        self._cursor = cursor
+
+
+class FileCheckpoint(Checkpoint):
+    """
+    Keeps the position of ElasticsearchQuery.follow in a JSON file, so that it can be resumed after the restart
+    """
+    def __init__(self, path):
+        """
+        :type path str
+        """
+        super(FileCheckpoint, self).__init__()
+        self._path = path
+
+    def load(self):
+        try:
+            with open(self._path, 'rt') as handler:
+                return json.load(handler)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, cursor):
+        tmp_path = self._path + '.tmp'
+
+        with open(tmp_path, 'wt') as handler:
+            json.dump(cursor, handler)
+
+        os.rename(tmp_path, self._path)
+
+
+class _Column(object):
+    """
+    Values of a single column, numeric ones are kept in a typed array until a value of a different type is added.
+
+    The array type is chosen using the first value that is not None. Missing values are NaN in float columns,
+    integer columns keep the mask of values that are set.
+    """
+    def __init__(self, size=0):
+        """
+        :arg size: number of preceding rows with no value for this column
+        """
+        self.values = None
+        self._missing = size  # leading missing values, until the column type is known
+        self._mask = None  # 1 for values that are set, 0 for missing ones (integer columns with gaps only)
+
+    def __len__(self):
+        return len(self.values) if self.values is not None else self._missing
+
+    @staticmethod
+    def _is_numeric(value):
+        """
+        :type value object
+        :rtype: bool
+        """
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    def _create(self, value):
+        """
+        Creates the storage for the type of the first value that is set
+
+        :type value object
+        """
+        if not self._is_numeric(value):
+            self.values = [None] * self._missing
+        elif isinstance(value, float):
+            self.values = array('d', [float('nan')]) * self._missing
+        else:
+            self.values = array('q', [0]) * self._missing
+            self._mask = array('b', [0]) * self._missing if self._missing else None
+
+    def _to_list(self):
+        """
+        :rtype: list
+        """
+        if self._mask is not None:
+            return [value if is_set else None for value, is_set in zip(self.values, self._mask)]
+
+        # NaN marks the missing value
+        return [None if math.isnan(value) else value for value in self.values]
+
+    def _append_missing(self):
+        """
+        Adds the missing value to the typed array
+        """
+        if self.values.typecode == 'd':
+            self.values.append(float('nan'))
+            return
+
+        if self._mask is None:
+            self._mask = array('b', [1]) * len(self.values)
+
+        self.values.append(0)
+        self._mask.append(0)
+
+    def append(self, value):
+        """
+        :type value object
+        """
+        if self.values is None:
+            if value is None:
+                self._missing += 1
+                return
+
+            self._create(value)
+
+        if isinstance(self.values, list):
+            self.values.append(value)
+        elif value is None:
+            self._append_missing()
+        elif not self._is_numeric(value):
+            self.values, self._mask = self._to_list(), None
+            self.values.append(value)
+        elif isinstance(value, float) and self.values.typecode == 'q':
+            # an integer column becomes a float one
+            self.values = array('d', [float('nan') if item is None else item for item in self._to_list()])
+            self._mask = None
+            self.values.append(value)
+        else:
+            try:
+                self.values.append(value)
+            except OverflowError:
+                self.values, self._mask = self._to_list(), None
+                self.values.append(value)
+                return
+
+            if self._mask is not None:
+                self._mask.append(1)
+
+    def get_values(self):
+        """
+        :rtype: list or array or numpy.ndarray
+        """
+        if not isinstance(self.values, array):
+            return self.values if self.values is not None else [None] * self._missing
+
+        numpy = _import_numpy()
+
+        if numpy is None:
+            # typed arrays can not hold missing values of integer columns
+            return self.values if self._mask is None else self._to_list()
+
+        # no copy is made here
+        values = numpy.frombuffer(self.values, dtype='int64' if self.values.typecode == 'q' else 'float64')
+
+        if self._mask is not None:
+            return numpy.ma.masked_array(values, mask=numpy.frombuffer(self._mask, dtype='int8') == 0)
+
+        return values
+
+
+class ColumnarResult(object):
+    """
+    Rows stored as columns - one list of values per field. Numeric values are kept in typed arrays
+    (or NumPy arrays when it's installed). Nested fields are flattened using dotted names (e.g. "context.time").
+
+    res = es_query.query_by_string('*', fields=['host', 'context.time'], limit=100000, columnar=True)
+    res['context.time'].mean()
+    """
+    def __init__(self, fields=None):
+        """
+        :arg fields: columns to build, all fields found in rows are used when not provided
+        :type fields list[str] or None
+        """
+        self._fields = fields
+        self._columns = OrderedDict((field, _Column()) for field in fields or [])
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, name):
+        """
+        :type name str
+        :rtype: list or array or numpy.ndarray
+        """
+        return self._columns[name].get_values()
+
+    def keys(self):
+        """
+        :rtype: list[str]
+        """
+        return list(self._columns.keys())
+
+    @property
+    def columns(self):
+        """
+        :rtype: OrderedDict
+        """
+        return OrderedDict((name, column.get_values()) for name, column in self._columns.items())
+
+    @staticmethod
+    def get_field(row, field):
+        """
+        :type row dict
+        :arg field: dotted path to the field (e.g. "context.time")
+        :type field str
+        """
+        value = row
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+
+        return value
+
+    @classmethod
+    def flatten(cls, row, prefix=''):
+        """
+        :type row dict
+        :type prefix str
+        :rtype: list[tuple[str, object]]
+        """
+        items = []
+
+        for key, value in row.items():
+            if isinstance(value, dict):
+                items.extend(cls.flatten(value, prefix=prefix + key + '.'))
+            else:
+                items.append((prefix + key, value))
+
+        return items
+
+    def add_rows(self, rows):
+        """
+        :type rows list[dict]
+        """
+        for row in rows:
+            if self._fields:
+                items = [(field, self.get_field(row, field)) for field in self._fields]
+            else:
+                items = self.flatten(row)
+
+            for name, value in items:
+                if name not in self._columns:
+                    self._columns[name] = _Column(size=self._rows)
+
+                self._columns[name].append(value)
+
+            self._rows += 1
+
+            # fill the missing values
+            for column in self._columns.values():
+                if len(column) < self._rows:
+                    column.append(None)
+
+
+class _Serializer(object):
+    """
+    Base class of serializers that can be defined without importing elasticsearch package
+    """
+    mimetype = 'application/json'
+
+    @staticmethod
+    def default(data):
+        """
+        Encodes dates, UUIDs, decimals and numpy types the way elasticsearch.serializer.JSONSerializer does
+
+        :type data object
+        :rtype: object
+        """
+        return elasticsearch.serializer.JSONSerializer().default(data)
+
+    def loads(self, s):
+        """
+        :type s str
+        :rtype: object
+        """
+        raise NotImplementedError()
+
+    def dumps(self, data):
+        """
+        :type data object
+        :rtype: str
+        """
+        raise NotImplementedError()
+
+
+def _create_json_serializer():
+    """
+    :rtype: elasticsearch.serializer.JSONSerializer
+    """
+    return elasticsearch.serializer.JSONSerializer()
+
+
+class OrjsonSerializer(_Serializer):
+    """
+    Encodes and decodes requests and responses bodies using orjson library (much faster than json module)
+
+    @see https://github.com/ijl/orjson
+    """
+    def __init__(self):
+        import orjson  # pylint: disable=import-outside-toplevel,import-error
+        self._orjson = orjson
+
+    def loads(self, s):
+        try:
+            return self._orjson.loads(s)
+        except (ValueError, TypeError) as ex:
+            raise elasticsearch.SerializationError(s, ex)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        try:
+            return self._orjson.dumps(data, default=self.default).decode('utf-8')
+        except (ValueError, TypeError) as ex:
+            raise elasticsearch.SerializationError(data, ex)
+
+
+class UjsonSerializer(_Serializer):
+    """
+    Encodes and decodes requests and responses bodies using ujson library
+
+    @see https://github.com/ultrajson/ultrajson
+    """
+    def __init__(self):
+        import ujson  # pylint: disable=import-outside-toplevel,import-error
+        self._ujson = ujson
+
+    def loads(self, s):
+        try:
+            return self._ujson.loads(s)
+        except (ValueError, TypeError) as ex:
+            raise elasticsearch.SerializationError(s, ex)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        try:
+            return self._ujson.dumps(data, ensure_ascii=False)
+        except (ValueError, TypeError, OverflowError) as ex:
+            raise elasticsearch.SerializationError(data, ex)
+
+
+class _InstrumentedSerializer(object):
+    """
+    Wraps the serializer and measures the size and decoding time of responses (per thread)
+    """
+    def __init__(self, serializer):
+        """
+        :type serializer JSONSerializer
+        """
+        self._serializer = serializer
+        self._local = threading.local()
+        self.mimetype = serializer.mimetype
+
+    def dumps(self, data):
+        """
+        :type data object
+        :rtype: str
+        """
+        return self._serializer.dumps(data)
+
+    def loads(self, s):
+        """
+        :type s str or bytes
+        :rtype: object
+        """
+        start = time.time()
+        data = self._serializer.loads(s)
+
+        # the transport passes responses decoded from UTF-8, count the bytes received
+        size, decode_time = getattr(self._local, 'stats', (0, 0.0))
+        size += len(s) if isinstance(s, bytes) else len(s.encode('utf-8', 'surrogatepass'))
+        self._local.stats = (size, decode_time + time.time() - start)
+
+        return data
+
+    def pop_stats(self):
+        """
+        Returns the size and decoding time of responses decoded by the current thread since the last call
+
+        :rtype: tuple[int, float]
+        """
+        stats = getattr(self._local, 'stats', (0, 0.0))
+        self._local.stats = (0, 0.0)
+        return stats
+
+
+class QueryStats(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Stats of a single query passed to stats_callback of ElasticsearchQuery
+    """
+    def __init__(self, method, index, body=None):
+        """
+        :arg method: what kind of query it is - "search", "count", "aggregations", "histogram" or "sql"
+        :type method str
+        :arg index: comma-separated list of indices queried
+        :type index str or None
+        :arg body: the request body
+        :type body dict or None
+        """
+        self.method = method
+        self.index = index
+        self.body = body
+
+        self.took = 0  # the time (in ms) reported by Elasticsearch, summed up for all pages
+        self.wall_time = 0.0  # in seconds, includes the time spent by the consumer of iter_* generators
+        self.pages = 0
+        self.rows = 0
+        self.bytes = 0  # the size of responses received
+        self.decode_time = 0.0  # in seconds
+        self.shards = OrderedDict([('total', 0), ('successful', 0), ('skipped', 0), ('failed', 0)])
+        self.error = None
+
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def add_response(self, resp, size=0, decode_time=0.0):
+        """
+        :type resp dict
+        :type size int
+        :type decode_time float
+        """
+        with self._lock:
+            self.pages += 1
+            self.took += resp.get('took', 0)
+            self.bytes += size
+            self.decode_time += decode_time
+
+            for key, value in resp.get('_shards', {}).items():
+                if key in self.shards:
+                    self.shards[key] += value
+
+    def finish(self):
+        """
+        Called when the query is completed
+        """
+        self.wall_time = time.time() - self._start
+
+    def as_dict(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'method': self.method,
+            'index': self.index,
+            'took': self.took,
+            'wall_time': self.wall_time,
+            'pages': self.pages,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'decode_time': self.decode_time,
+            'shards': dict(self.shards),
+            'error': repr(self.error) if self.error is not None else None,
+        }
+
+    def __repr__(self):
+        return '<QueryStats {}>'.format(self.as_dict())
@@ -0,0 +1,179 @@
+"""
+Querying several Elasticsearch clusters at once.
+"""
+import logging
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch_query import ElasticsearchQuery
+from elasticsearch_query_common import elasticsearch, ElasticsearchQueryError
+
+
+class FederatedQuery(object):
+    """
+    Runs queries against several clusters (e.g. regional ones, each with its own hosts and indices) concurrently
+    and merges their results - a query takes as long as the slowest cluster does.
+
+    federated = FederatedQuery(clusters=[
+        {'name': 'us', 'es_host': 'es.us.prod', 'index_prefix': 'logstash-my-app'},
+        {'name': 'eu', 'es_host': 'es.eu.prod', 'index_prefix': 'logstash_my_app', 'index_sep': '_'},
+    ], period=900)
+
+    federated.count('@message:"^PHP Fatal"')
+    federated.report  # {'us': {'latency': 0.123, 'error': None}, 'eu': {'latency': 0.456, 'error': None}}
+    """
+    def __init__(self, clusters, fail_on_error=False, **kwargs):
+        """
+        :type clusters list[dict]
+        :type fail_on_error bool
+
+        :arg clusters: ElasticsearchQuery arguments (es_host, index_prefix, index_sep, ...) for each cluster,
+                       "name" key is used in the report (defaults to es_host)
+        :arg fail_on_error: raise ElasticsearchQueryError when any cluster fails (by default results of the
+                            remaining ones are returned, the error is raised only when all clusters fail)
+        :arg kwargs: ElasticsearchQuery arguments shared by all clusters (e.g. since, period, batch_size)
+        """
+        if not clusters:
+            raise ElasticsearchQueryError('At least one cluster needs to be provided')
+
+        self._queries = OrderedDict()
+
+        for cluster in clusters:
+            cluster = dict(cluster)
+            name = cluster.pop('name', None) or str(cluster.get('es_host'))
+
+            if name in self._queries:
+                raise ElasticsearchQueryError('Duplicated cluster name: {}'.format(name))
+
+            self._queries[name] = ElasticsearchQuery(**dict(kwargs, **cluster))
+
+        self._fail_on_error = fail_on_error
+        self._report = OrderedDict()
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def report(self):
+        """
+        Latency (in seconds) and the error (or None) of each cluster for the last query
+
+        :rtype: OrderedDict
+        """
+        return self._report
+
+    def _run(self, func):
+        """
+        Calls func with ElasticsearchQuery instance of each cluster concurrently and returns results
+        of the clusters that did not fail
+
+        :type func callable
+        :rtype: OrderedDict
+        """
+        def call(name):
+            start = time.time()
+
+            try:
+                return func(self._queries[name]), None, time.time() - start
+            except (ElasticsearchQueryError, elasticsearch.TransportError) as ex:
+                return None, ex, time.time() - start
+
+        with ThreadPoolExecutor(max_workers=len(self._queries)) as executor:
+            results = list(executor.map(call, self._queries))
+
+        report = OrderedDict()
+        res = OrderedDict()
+
+        for name, (value, error, latency) in zip(self._queries, results):
+            report[name] = {'latency': latency, 'error': error}
+
+            if error is None:
+                res[name] = value
+            else:
+                self._logger.error("Query to %s cluster failed: %s", name, error)
+
+        self._report = report
+
+        failed = [name for name in report if report[name]['error'] is not None]
+
+        if failed and (self._fail_on_error or not res):
+            raise ElasticsearchQueryError('Query failed for {} cluster(s)'.format(', '.join(failed)))
+
+        return res
+
+    def count(self, query):
+        """
+        Returns number of matching entries in all clusters
+
+        :type query str
+        :rtype: int
+        """
+        return sum(self._run(lambda es_query: es_query.count(query)).values())
+
+    def query_by_string(self, query, fields=None, limit=10, sampling=None, interleave=False):
+        """
+        Returns raw rows that matches the given query string from all clusters, at most limit of them
+
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type interleave bool
+        :arg interleave: take rows from clusters in turns, by default rows of the first cluster go first
+        :rtype: list
+        """
+        res = list(self._run(lambda es_query: es_query.query_by_string(query, fields, limit, sampling)).values())
+
+        if not interleave:
+            return [row for rows in res for row in rows][:limit]
+
+        rows = []
+        for idx in range(max(len(cluster_rows) for cluster_rows in res)):
+            rows.extend(cluster_rows[idx] for cluster_rows in res if idx < len(cluster_rows))
+
+        return rows[:limit]
+
+    def get_aggregations(self, query, group_by, stats_field, percents=(50, 95, 99, 99.9), size=100):
+        """
+        Returns aggregations (rows count + percentile stats) for a given query from all clusters
+
+        Counts of the same group are summed, percentiles are approximated with the average of clusters'
+        percentiles weighted by their rows count. Each cluster returns its top size groups only,
+        hence counts of groups that are not in the top of every cluster can be lower than the real ones.
+
+        :type query str
+        :type group_by str
+        :type stats_field str
+        :type percents tuple[int]
+        :type size int
+        :rtype: dict
+        """
+        res = self._run(lambda es_query: es_query.get_aggregations(query, group_by, stats_field, percents, size))
+
+        totals = {}
+        weights = {}
+
+        for aggs in res.values():
+            for key, entry in aggs.items():
+                total = totals.setdefault(key, {'count': 0})
+                total['count'] += entry['count']
+
+                for percent, value in entry.items():
+                    if percent == 'count':
+                        continue
+
+                    if value is None:
+                        total.setdefault(percent, None)
+                        continue
+
+                    total[percent] = (total.get(percent) or 0) + value * entry['count']
+                    weights[(key, percent)] = weights.get((key, percent), 0) + entry['count']
+
+        for key, total in totals.items():
+            for percent in total:
+                if total[percent] is not None and percent != 'count':
+                    total[percent] /= float(weights[(key, percent)])
+
+        return dict(sorted(totals.items(), key=lambda item: -item[1]['count'])[:size])
@@ -0,0 +1,525 @@
+"""
+Fetching pages of hits for ElasticsearchQuery - plain, scroll and search_after requests, their retries
+and concurrency (sliced scrolls and time window partitions).
+"""
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch_query_common import elasticsearch, IncompleteResultsError
+
+try:
+    from queue import Queue, Full
+except ImportError:  # Python 2.7
+    from Queue import Queue, Full
+
+
+class PaginationPolicyMixin(object):  # pylint: disable=too-few-public-methods
+    """
+    Builds page requests and decides on their retries, shared by ElasticsearchQuery and AsyncElasticsearchQuery
+    """
+    # how long the scroll context should be kept alive between the requests for the next batch
+    SCROLL_TIMEOUT = '5m'
+
+    # how many times a failed page request should be retried (by default)
+    MAX_PAGE_RETRIES = 3
+
+    # how long (in seconds) to wait before the first retry (by default), the delay is doubled for the following ones
+    RETRY_BACKOFF = 0.5
+    MAX_RETRY_BACKOFF = 30
+
+    # HTTP status codes of Elasticsearch responses that are worth retrying
+    TRANSIENT_STATUS_CODES = (429, 502, 503, 504)
+
+    # only these parts of responses are sent back by Elasticsearch
+    SCROLL_FILTER_PATH = '_scroll_id,hits.hits._source,hits.hits.fields'
+    SEARCH_FILTER_PATH = 'hits.hits._source,hits.hits.fields'
+    SEARCH_AFTER_FILTER_PATH = 'pit_id,hits.hits._source,hits.hits.fields,hits.hits.sort'
+
+    def _get_single_page_body(self, body, limit, sampling):
+        """
+        Build the body of the plain search request that fetches up to the limit of hits at once
+
+        :type body dict
+        :type limit int
+        :type sampling int or None
+        :rtype: dict
+        """
+        body = dict(body, size=limit, sort=["_doc"], track_total_hits=False)
+
+        # only random_score sampling uses min_score which can not be combined with terminate_after,
+        # hash_field and script sampling are filters applied before the hits are collected
+        if sampling is None or self._options.sampling.method != 'random_score':
+            # let each shard stop collecting hits when the limit is reached
+            body['terminate_after'] = limit
+
+        return body
+
+    def _get_retry_delay(self, ex, attempt, retry_on=None):
+        """
+        Tells how long to wait before retrying the request that failed with a given error (with an exponential
+        backoff). The error is raised again when it is not worth retrying, IncompleteResultsError is raised
+        when retries do not help.
+
+        :type ex TransportError
+        :arg attempt: the number of the retry (starting from 1)
+        :type attempt int
+        :arg retry_on: tells which errors are worth retrying (defaults to the transient ones)
+        :type retry_on callable or None
+        :rtype: float
+        """
+        pagination = self._options.pagination
+
+        max_retries = pagination.max_retries if pagination.max_retries is not None else self.MAX_PAGE_RETRIES
+        retry_backoff = pagination.retry_backoff if pagination.retry_backoff is not None else self.RETRY_BACKOFF
+
+        if not (retry_on or self._is_transient_error)(ex):
+            raise ex
+
+        if attempt > max_retries:
+            raise IncompleteResultsError('Request failed after {:d} retries: {}'.format(max_retries, ex))
+
+        delay = min(retry_backoff * 2 ** (attempt - 1), self.MAX_RETRY_BACKOFF)
+
+        self._logger.warning("Retrying the request after %s in %.2f s (attempt #%d)", ex, delay, attempt)
+        return delay
+
+    @staticmethod
+    def _check_shards(resp):
+        """
+        Hits of the shards that failed are missing from the response, just like helpers.scan does
+        raise IncompleteResultsError then
+
+        :type resp dict
+        """
+        shards = resp.get('_shards', {})
+
+        if shards.get('successful', 0) < shards.get('total', 0):
+            raise IncompleteResultsError('{:d} of {:d} shards failed to return their hits'.format(
+                shards.get('failed', shards['total'] - shards['successful']), shards['total']))
+
+    @staticmethod
+    def _get_hits(resp):
+        """
+        Empty hits list is not included in responses trimmed using filter_path
+
+        :type resp dict
+        :rtype: list[dict]
+        """
+        return resp.get('hits', {}).get('hits', [])
+
+    def _is_transient_error(self, ex):
+        """
+        :type ex TransportError
+        :rtype: bool
+        """
+        return isinstance(ex, elasticsearch.ConnectionError) or ex.status_code in self.TRANSIENT_STATUS_CODES
+
+    @staticmethod
+    def _is_unprocessed_error(ex):
+        """
+        Tells whether the request surely was not processed - it was rejected (429 Too Many Requests)
+        or the connection could not be established. Only such requests can be retried when they are
+        not idempotent (e.g. the scroll one).
+
+        :type ex TransportError
+        :rtype: bool
+        """
+        import urllib3  # pylint: disable=import-outside-toplevel
+
+        if ex.status_code == 429:
+            return True
+
+        # NewConnectionError (e.g. connection refused) is a sub-class of ConnectTimeoutError
+        return isinstance(ex, elasticsearch.ConnectionError) and \
+            isinstance(ex.info, urllib3.exceptions.ConnectTimeoutError)
+
+
+class PaginationMixin(PaginationPolicyMixin):  # pylint: disable=too-few-public-methods
+    """
+    Requests pages of hits, mixed into ElasticsearchQuery
+    """
+    def _search_once(self, body, limit, sampling=None, stats=None):
+        """
+        Yield a single page of hits using a plain search request, no scroll context is created.
+        Used when the limit fits in a single page.
+
+        :type body dict
+        :type limit int
+        :type sampling int or None
+        :type stats QueryStats or None
+        :rtype: list[list[dict]]
+        """
+        body = self._get_single_page_body(body, limit, sampling)
+
+        resp = self._with_retries(lambda: self._es.search(
+            index=self._index, body=body, filter_path=self._get_filter_path(self.SEARCH_FILTER_PATH)))
+        self._record_response(stats, resp)
+        self._check_shards(resp)
+
+        if self._get_hits(resp):
+            yield self._get_hits(resp)
+
+    def _scroll(self, body, stats=None, scroll_id=None, resumable=True):
+        """
+        Yield pages of hits using the Scroll API. The scroll context is cleared
+        when the generator is exhausted or closed by the consumer.
+
+        Scroll requests are retried only when they were surely not processed by Elasticsearch (it could have
+        moved the scroll forward otherwise). When such retries do not help, IncompleteResultsError with
+        the cursor is raised and the scroll context is kept, so that the scroll can be resumed before
+        it expires. The scroll can not be resumed after any other failure (e.g. an expired scroll context,
+        a request that timed out or failed shards).
+
+        Use Scroll API to be able to fetch more than 10k results and prevent "search_phase_execution_exception":
+        "Result window is too large, from + size must be less than or equal to: [10000] but was [500000].
+        See the scroll api for a more efficient way to request large data sets."
+
+        @see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-scroll.html
+
+        :type body dict
+        :type stats QueryStats or None
+        :arg scroll_id: resume the scroll with this id (taken from the cursor)
+        :type scroll_id str or None
+        :arg resumable: keep the scroll context when the scroll can be resumed (e.g. not a slice of the scroll)
+        :type resumable bool
+        :rtype: list[list[dict]]
+        """
+        body = dict(body)
+        body['sort'] = ["_doc"]  # return the next batch of results from every shard that still has results to return.
+
+        filter_path = self._get_filter_path(self.SCROLL_FILTER_PATH)
+
+        resp = None if scroll_id is not None else self._with_retries(lambda: self._es.search(
+            index=self._index, body=body, scroll=self.SCROLL_TIMEOUT, size=self._options.batch_size,
+            filter_path=filter_path))
+
+        try:
+            while True:
+                if resp is None:
+                    resp = self._get_scroll_page(scroll_id, filter_path)
+
+                scroll_id = resp.get('_scroll_id', scroll_id)
+
+                self._record_response(stats, resp)
+                self._check_shards(resp)
+
+                if not self._get_hits(resp):
+                    break
+
+                yield self._get_hits(resp)
+
+                if scroll_id is None:
+                    break
+
+                resp = None
+        except IncompleteResultsError as ex:
+            if resumable and ex.cursor is not None:
+                # keep the scroll context, the scroll will be resumed from it
+                scroll_id = None
+            else:
+                ex.cursor = None
+            raise
+        finally:
+            if scroll_id is not None:
+                self._clear_scroll(scroll_id)
+
+    def _get_scroll_page(self, scroll_id, filter_path):
+        """
+        Request the next page of the scroll. Only the requests that were not processed are retried.
+
+        :type scroll_id str
+        :type filter_path str
+        :rtype: dict
+        """
+        try:
+            return self._with_retries(lambda: self._es.scroll(
+                scroll_id=scroll_id, scroll=self.SCROLL_TIMEOUT, filter_path=filter_path),
+                retry_on=self._is_unprocessed_error)
+        except IncompleteResultsError as ex:
+            # the scroll has not moved forward, the same page can be requested again
+            ex.cursor = {'scroll_id': scroll_id}
+            raise
+        except elasticsearch.TransportError as ex:
+            raise IncompleteResultsError('Scroll failed: {}'.format(ex))
+
+    def _search_after(self, body, sort, search_after=None, limit=None, pit_id=None, stats=None):
+        """
+        Yield pages of hits sorted by given fields using search_after parameter.
+
+        A failed page request is retried using the sort values of the last hit received, so that
+        the pagination does not need to start over. When retries do not help, IncompleteResultsError
+        with the cursor that the pagination can be resumed from is raised.
+
+        @see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-search-after.html
+
+        :type body dict
+        :type sort list
+        :type search_after list or None
+        :type limit int or None
+        :type pit_id str or None
+        :type stats QueryStats or None
+        :rtype: list[list[dict]]
+        """
+        body = dict(body, sort=sort)
+        fetched = 0
+
+        while limit is None or fetched < limit:
+            # do not ask for more than needed
+            body['size'] = self._options.batch_size if limit is None else min(self._options.batch_size, limit - fetched)
+
+            if search_after is not None:
+                body['search_after'] = search_after
+
+            if pit_id is not None:
+                body['pit'] = {'id': pit_id, 'keep_alive': self.SCROLL_TIMEOUT}
+
+            try:
+                resp = self._search_page(body, with_index=pit_id is None)
+            except IncompleteResultsError as ex:
+                # sort values of point-in-time requests can not be used with a new one
+                ex.cursor = {'search_after': search_after} if pit_id is None else None
+                raise
+
+            hits = self._get_hits(resp)
+            self._record_response(stats, resp)
+
+            # point-in-time id can change between requests
+            pit_id = resp.get('pit_id', pit_id)
+
+            if hits:
+                yield hits
+
+            if len(hits) < body['size']:
+                break
+
+            fetched += len(hits)
+            search_after = hits[-1]['sort']
+
+    def _search_page(self, body, with_index=True):
+        """
+        Run the search request, retry it when a transient error occurs
+
+        :type body dict
+        :type with_index bool
+        :rtype: dict
+        """
+        filter_path = self._get_filter_path(self.SEARCH_AFTER_FILTER_PATH)
+
+        if with_index:
+            resp = self._with_retries(lambda: self._es.search(index=self._index, body=body, filter_path=filter_path))
+        else:
+            # requests using point-in-time can not specify indices
+            resp = self._with_retries(lambda: self._es.search(body=body, filter_path=filter_path))
+
+        self._check_shards(resp)
+        return resp
+
+    def _with_retries(self, request, retry_on=None):
+        """
+        Run the request, retry it with an exponential backoff when a transient error occurs.
+        IncompleteResultsError is raised when retries do not help.
+
+        :type request callable
+        :arg retry_on: tells which errors are worth retrying (defaults to the transient ones)
+        :type retry_on callable or None
+        :rtype: dict
+        """
+        attempt = 0
+
+        while True:
+            try:
+                return request()
+            except elasticsearch.TransportError as ex:
+                attempt += 1
+                time.sleep(self._get_retry_delay(ex, attempt, retry_on))
+
+    def _paginate(self, body, limit, stats=None, search_after=None):
+        """
+        Yield pages of hits using search_after pagination, optionally with a point-in-time.
+        Rows are sorted by @timestamp (and _id to make the order stable).
+
+        @see https://www.elastic.co/guide/en/elasticsearch/reference/current/point-in-time-api.html
+
+        :type body dict
+        :type limit int
+        :type stats QueryStats or None
+        :arg search_after: sort values of the row to resume the pagination after
+        :type search_after list or None
+        :rtype: list[list[dict]]
+        """
+        # point-in-time is not needed when the limit fits in a single page (and can not be used when resuming)
+        use_pit = self._options.pagination.point_in_time and limit > self._options.batch_size and search_after is None
+        pit_id = self._open_point_in_time() if use_pit else None
+
+        if pit_id is None:
+            sort = [{"@timestamp": "asc"}, {"_id": "asc"}]
+        else:
+            # the implicit _shard_doc tiebreaker is added by Elasticsearch
+            sort = [{"@timestamp": "asc"}]
+
+        try:
+            for hits in self._search_after(body, sort, search_after=search_after, limit=limit, pit_id=pit_id,
+                                           stats=stats):
+                yield hits
+        finally:
+            if pit_id is not None:
+                self._close_point_in_time(pit_id)
+
+    def _open_point_in_time(self):
+        """
+        :rtype: str or None
+        """
+        try:
+            resp = self._es.transport.perform_request(
+                'POST', '/{}/_pit'.format(self._index), params={'keep_alive': self.SCROLL_TIMEOUT})
+        except elasticsearch.TransportError as ex:
+            if ex.status_code not in (400, 404, 405):
+                raise
+
+            self._logger.warning("Point-in-time is not supported by the cluster (%s)", ex)
+            return None
+
+        return resp['id']
+
+    def _close_point_in_time(self, pit_id):
+        """
+        :type pit_id str
+        """
+        self._es.transport.perform_request('DELETE', '/_pit', body={'id': pit_id}, params={'ignore': (403, 404)})
+
+    def _sliced_scroll(self, body, stats=None):
+        """
+        Yield pages of hits using the sliced Scroll API. Each slice is drained by a separate thread.
+        All scroll contexts are cleared when the generator is exhausted, closed or when any of the slices fails.
+
+        @see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-scroll.html#sliced-scroll
+
+        :type body dict
+        :type stats QueryStats or None
+        :rtype: list[list[dict]]
+        """
+        slices = self._options.pagination.parallelism
+
+        return self._merge_pages(
+            [
+                lambda slice_id=slice_id: self._scroll(
+                    dict(body, slice={'id': slice_id, 'max': slices}), stats, resumable=False)
+                for slice_id in range(slices)
+            ],
+            workers=slices
+        )
+
+    @staticmethod
+    def _merge_pages(producers, workers, ordered=False):
+        """
+        Yield pages of hits from generators returned by producers, each one is drained by a separate thread
+        (up to the given number of them at once). Pages are yielded in the order of producers when ordered
+        is set (the following ones are prefetched), otherwise as soon as they are received.
+
+        All generators are closed when this one is exhausted, closed or when any of them fails.
+
+        :type producers list[callable]
+        :type workers int
+        :type ordered bool
+        :rtype: list[list[dict]]
+        """
+        # keep at most two pages per producer in memory
+        if ordered:
+            queues = [Queue(maxsize=2) for _ in producers]
+        else:
+            queues = [Queue(maxsize=workers * 2)] * len(producers)
+
+        stop = threading.Event()
+
+        def put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def drain(idx):
+            if stop.is_set():
+                return
+
+            pages = None
+
+            try:
+                pages = producers[idx]()
+
+                for hits in pages:
+                    if not put(queues[idx], (hits, None)):
+                        break
+            except Exception as ex:  # pylint: disable=broad-except
+                put(queues[idx], (None, ex))
+            else:
+                put(queues[idx], (None, None))
+            finally:
+                if pages is not None:
+                    pages.close()
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        try:
+            for idx in range(len(producers)):
+                executor.submit(drain, idx)
+
+            # each producer's queue is read until it's done, or the shared one until all of them are done
+            for queue in (queues if ordered else queues[:1]):
+                finished = 0
+
+                while finished < (1 if ordered else len(producers)):
+                    hits, error = queue.get()
+
+                    if error is not None:
+                        raise error
+
+                    if hits is None:
+                        finished += 1
+                    else:
+                        yield hits
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def _clear_scroll(self, scroll_id):
+        """
+        Release the scroll context on the cluster
+
+        Some clusters respond with "403 Forbidden: You don't have access to this resource" here,
+        the context will then simply expire after SCROLL_TIMEOUT.
+
+        :type scroll_id str
+        """
+        self._es.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(403, 404))
+
+    def _get_pages(self, body, limit, sampling, stats, cursor=None, resumable=True):
+        """
+        Returns the generator of pages of hits, the way they're fetched depends on the limit and the pagination
+
+        :type body dict
+        :type limit int
+        :type sampling int or None
+        :type stats QueryStats or None
+        :type cursor dict or None
+        :arg resumable: the scroll can be resumed using the cursor (it is not a partition of the time window)
+        :type resumable bool
+        :rtype: list[list[dict]]
+        """
+        if self._options.pagination.method == 'search_after':
+            return self._paginate(body, limit, stats, search_after=cursor['search_after'] if cursor else None)
+
+        if cursor is not None:
+            return self._scroll(body, stats, scroll_id=cursor['scroll_id'])
+
+        if limit <= self._options.batch_size:
+            return self._search_once(body, limit, sampling, stats)
+
+        if self._options.pagination.parallelism > 1:
+            return self._sliced_scroll(body, stats)
+
+        return self._scroll(body, stats, resumable=resumable)
@@ -0,0 +1,794 @@
+"""
+Getting rows for ElasticsearchQuery - searches (with the projection of fields and sampling),
+following new rows, exporting them to files and SQL queries.
+"""
+import io
+import json
+import logging
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from elasticsearch_query_common import elasticsearch, Checkpoint, ColumnarResult, ElasticsearchQueryError, \
+    IncompleteResultsError
+
+
+class _CountingWriter(object):
+    """
+    Wraps the file object and counts bytes written to it
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.bytes = 0
+
+    def write(self, data):
+        """
+        :type data bytes
+        """
+        self.bytes += len(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        """
+        Flush the wrapped file object
+        """
+        self._fileobj.flush()
+
+
+class SearchBodyMixin(object):  # pylint: disable=too-few-public-methods
+    """
+    Builds search requests and reads rows from responses, shared by ElasticsearchQuery and AsyncElasticsearchQuery
+    """
+    # seed used by random_score sampling, the same documents are sampled every time
+    SAMPLING_SEED = 42
+
+    def _get_search_body(self, query, fields=None, sampling=None):
+        """
+        Build the body of the search request
+
+        :type query object
+        :type fields list[str] or None
+        :type sampling int or None
+        :rtype: dict
+        """
+        body = {
+            "query": {
+                "bool": {
+                    "must": [
+                        query
+                    ]
+                }
+            }
+        }
+
+        if fields:
+            self._add_projection(body, fields)
+
+        # add @timestamp range
+        # @see http://stackoverflow.com/questions/40996266/elasticsearch-5-1-unknown-key-for-a-start-object-in-filters
+        # @see https://discuss.elastic.co/t/elasticsearch-watcher-error-for-range-query/70347/2
+        body['query']['bool']['must'].append(self._get_timestamp_filer())
+
+        # sample the results if needed
+        if sampling is not None:
+            self._add_sampling(body, sampling)
+
+        return body
+
+    def _add_projection(self, body, fields):
+        """
+        Fetch only given fields. "docvalues" projection reads them from doc values (or stored fields)
+        where the mapping allows it, so that Elasticsearch does not need to load and parse whole documents.
+
+        @see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-source-filtering.html
+        @see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-docvalue-fields.html
+
+        :type body dict
+        :type fields list[str]
+        """
+        sources = self._get_fields_sources(fields) if self._options.pagination.projection == 'docvalues' else {}
+
+        source_fields = [field for field in fields if sources.get(field, '_source') == '_source']
+        docvalue_fields = [field for field in fields if sources.get(field) == 'docvalue_fields']
+        stored_fields = [field for field in fields if sources.get(field) == 'stored_fields']
+
+        body['_source'] = {"includes": source_fields} if source_fields else False
+
+        if docvalue_fields:
+            body['docvalue_fields'] = docvalue_fields
+
+        if stored_fields:
+            body['stored_fields'] = stored_fields
+
+    @staticmethod
+    def _get_row(hit):
+        """
+        Returns the row of a given hit - its _source with fields fetched from doc values or stored fields added
+        (nested using dotted names).
+
+        Doc values do not tell a single-element array from a scalar, so a single value is always unwrapped.
+        Rows can then differ from the ones read from _source (see "docvalues projection" in README).
+
+        :type hit dict
+        :rtype: dict
+        """
+        row = hit.get('_source', {})
+
+        for field, values in hit.get('fields', {}).items():
+            keys = field.split('.')
+            parent = row
+
+            for key in keys[:-1]:
+                parent = parent.setdefault(key, {})
+
+                # e.g. host.keyword sub-field of the host field
+                if not isinstance(parent, dict):
+                    break
+            else:
+                # values of fields are always returned as lists, assume that a single one is a scalar
+                parent[keys[-1]] = values[0] if len(values) == 1 else values
+
+        return row
+
+    def _add_sampling(self, body, sampling):
+        """
+        Modify the search request body to return only a given percentage of results
+
+        :type body dict
+        :type sampling int
+        """
+        if self._options.sampling.method == 'hash_field':
+            # the cheapest one - a cacheable range filter on the hash calculated at the ingest time
+            body['query']['bool']['must'].append({
+                'range': {
+                    self._options.sampling.field: {
+                        'lt': sampling
+                    }
+                }
+            })
+
+        elif self._options.sampling.method == 'script':
+            body['query']['bool']['must'].append({
+                'script': {
+                    'script': {
+                        'lang': 'painless',
+                        'source': "Math.abs(doc['_id'].value.hashCode()) % 100 < params.sampling",
+                        'params': {
+                            'sampling': sampling
+                        }
+                    }
+                }
+            })
+
+        else:
+            # random_score gives a reproducible score in [0, 1) range for a given seed and field value,
+            # only documents with the score above the threshold are returned
+            # @see https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-function-score-query.html
+            body['query'] = {
+                'function_score': {
+                    'query': body['query'],
+                    'random_score': {
+                        'seed': self.SAMPLING_SEED,
+                        'field': self._options.sampling.field or '_seq_no',
+                    },
+                    'boost_mode': 'replace',
+                    'min_score': 1 - sampling / 100.0,
+                }
+            }
+
+    @staticmethod
+    def _get_sql_result(pages, result_format):
+        """
+        :type pages list[tuple[list[str], list[list]]]
+        :type result_format str
+        :rtype: list[dict] or tuple[list[str], list[tuple]] or OrderedDict
+        """
+        if result_format == 'tuples':
+            columns, rows = None, []
+            for columns, page in pages:
+                rows.extend(tuple(row) for row in page)
+            return columns, rows
+
+        if result_format == 'columns':
+            res = None
+            for columns, page in pages:
+                if res is None:
+                    res = OrderedDict((column, []) for column in columns)
+
+                values = list(res.values())
+                for row in page:
+                    for idx, value in enumerate(row):
+                        values[idx].append(value)
+            return res
+
+        # build key-value dictionary for each row to match results returned by query_by_string
+        return [dict(zip(columns, row)) for columns, page in pages for row in page]
+
+
+class SearchMixin(SearchBodyMixin):
+    """
+    Returns rows matching queries, mixed into ElasticsearchQuery
+    """
+    # types of fields that "docvalues" projection reads from doc values - their values are the same as
+    # in _source (unlike e.g. float ones that lose precision, or dates that are formatted differently)
+    DOCVALUE_FIELD_TYPES = ('keyword', 'long', 'integer', 'short', 'byte', 'double', 'boolean', 'ip')
+
+    # (hosts, indices, fields) -> (where fields are fetched from, when it was checked)
+    _mappings_cache = {}
+    _mappings_cache_lock = threading.Lock()
+
+    def _get_fields_sources(self, fields):
+        """
+        Tells where each field should be fetched from - "docvalue_fields", "stored_fields" or "_source"
+        (the latter is used when the mapping differs between indices). Mappings of fields in the queried
+        indices are checked once per INDICES_CACHE_TTL seconds.
+
+        :type fields list[str]
+        :rtype: dict
+        """
+        index = self._index
+        key = (str(self._options.es_host), index, tuple(fields))
+
+        with self._mappings_cache_lock:
+            cached = self._mappings_cache.get(key)
+
+        if cached is not None and time.time() - cached[1] < self.INDICES_CACHE_TTL:
+            return cached[0]
+
+        # fields with wildcards are always fetched from _source
+        names = [field for field in fields if '*' not in field]
+
+        try:
+            resp = self._es.indices.get_field_mapping(
+                fields=','.join(names), index=index, ignore_unavailable='true') if names else {}
+        except elasticsearch.TransportError as ex:
+            self._logger.warning("Getting mappings of %s fields failed, using _source: %s", ','.join(names), ex)
+            return {}
+
+        sources = {}
+
+        for index_mappings in resp.values():
+            for field_mapping in self._iter_field_mappings(index_mappings.get('mappings', {})):
+                mapping = list(field_mapping['mapping'].values())[0] if field_mapping['mapping'] else {}
+                sources.setdefault(field_mapping['full_name'], set()).add(self._get_field_source(mapping))
+
+        sources = {field: list(values)[0] for field, values in sources.items() if len(values) == 1}
+        self._logger.debug("Fields sources: %s", sources)
+
+        with self._mappings_cache_lock:
+            self._mappings_cache[key] = (sources, time.time())
+
+        return sources
+
+    @classmethod
+    def _iter_field_mappings(cls, mappings):
+        """
+        Yields field mappings from the get field mapping API response (Elasticsearch 6.x nests them under types)
+
+        :type mappings dict
+        :rtype: list[dict]
+        """
+        for value in mappings.values():
+            if not isinstance(value, dict):
+                continue
+
+            if isinstance(value.get('full_name'), str) and 'mapping' in value:
+                yield value
+            else:
+                for field_mapping in cls._iter_field_mappings(value):
+                    yield field_mapping
+
+    @classmethod
+    def _get_field_source(cls, mapping):
+        """
+        :type mapping dict
+        :rtype: str
+        """
+        # doc values of keyword fields skip values longer than ignore_above and keep the normalized ones
+        normalized = mapping.get('type') == 'keyword' and ('ignore_above' in mapping or 'normalizer' in mapping)
+
+        if mapping.get('type') in cls.DOCVALUE_FIELD_TYPES and mapping.get('doc_values', True) and not normalized:
+            return 'docvalue_fields'
+
+        if mapping.get('store', False):
+            return 'stored_fields'
+
+        return '_source'
+
+    def _iter_search(self, query, fields=None, limit=50000, sampling=None, pages=False, cursor=None):
+        """
+        Perform the search and yield raw rows as soon as each scroll page is received
+
+        :type query object
+        :type fields list[str] or None
+        :type limit int
+        :type sampling int or None
+        :type pages bool
+        :type cursor dict or None
+
+        :arg sampling: Percentage of results to be returned (0,100)
+        :arg pages: yield lists of rows (one per scroll page) instead of single rows
+        :arg cursor: resume fetching rows from the position taken from IncompleteResultsError
+
+        :rtype: list[dict]
+        """
+        if cursor is not None and 'search_after' not in cursor and 'scroll_id' not in cursor:
+            raise ElasticsearchQueryError('Unknown cursor: {}'.format(cursor))
+
+        if cursor is not None and ('search_after' in cursor) != (self._options.pagination.method == 'search_after'):
+            raise ElasticsearchQueryError('The cursor can be used only with the pagination it was taken from')
+
+        if cursor is not None and 'scroll_id' in cursor and self._get_partitions():
+            raise ElasticsearchQueryError('The scroll of time window partitions can not be resumed')
+
+        # the limit of the call that failed applies
+        limit = cursor.get('remaining', limit) if cursor is not None else limit
+
+        rows_pages = self._iter_search_pages(query, fields, limit, sampling, cursor)
+
+        return rows_pages if pages else (row for page in rows_pages for row in page)
+
+    def _iter_search_pages(self, query, fields, limit, sampling, cursor):
+        """
+        Perform the search and yield lists of raw rows as soon as each scroll page is received
+
+        :type query object
+        :type fields list[str] or None
+        :type limit int
+        :type sampling int or None
+        :type cursor dict or None
+        :rtype: list[list[dict]]
+        """
+        body = self._get_search_body(query, fields, sampling)
+
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("Running %s query (limit set to %d)", json.dumps(body), limit)
+
+        remaining = limit
+
+        with self._query_stats('search', body) as stats:
+            partitions = self._get_partitions()
+
+            if partitions:
+                scroll = self._iter_partitions_pages(partitions, query, fields, limit, sampling, stats, cursor)
+            else:
+                scroll = self._get_pages(body, limit, sampling, stats, cursor)
+
+            try:
+                for hits in scroll:
+                    # get only requested amount of entries
+                    page = [self._get_row(entry) for entry in hits[:remaining]]  # get data
+                    remaining -= len(page)
+
+                    if stats is not None:
+                        stats.rows += len(page)
+
+                    yield page
+
+                    if remaining <= 0:
+                        break
+            except IncompleteResultsError as ex:
+                if ex.cursor is not None:
+                    ex.cursor = dict(ex.cursor, remaining=remaining)
+                raise
+            finally:
+                # release the scroll context right away
+                scroll.close()
+
+    def _iter_partitions_pages(self, partitions, query, fields, limit, sampling, stats, cursor):
+        """
+        Yield pages of hits from partitions of the time window, each one is queried with its own time range
+        and indices (up to the number of partitions set in the constructor at once)
+
+        :type partitions list[ElasticsearchQuery]
+        :type query object
+        :type fields list[str] or None
+        :type limit int
+        :type sampling int or None
+        :type stats QueryStats or None
+        :type cursor dict or None
+        :rtype: list[list[dict]]
+        """
+        # pylint: disable=protected-access
+        scroll = self._merge_pages(
+            [
+                lambda part=part: part._get_pages(part._get_search_body(query, fields, sampling),
+                                                  limit, sampling, stats, cursor, resumable=False)
+                for part in partitions
+            ],
+            workers=self._options.pagination.partitions,
+            ordered=self._options.pagination.ordered_partitions
+        )
+
+        try:
+            for hits in scroll:
+                yield hits
+        except IncompleteResultsError as ex:
+            # rows from partitions are not returned in order, hence the position can not be resumed from
+            if not self._options.pagination.ordered_partitions:
+                ex.cursor = None
+            raise
+        finally:
+            scroll.close()
+
+    def _search(self, query, fields=None, limit=50000, sampling=None, columnar=False, cursor=None):
+        """
+        Perform the search and return raw rows
+
+        :type query object
+        :type fields list[str] or None
+        :type limit int
+        :type sampling int or None
+        :type columnar bool
+        :type cursor dict or None
+
+        :arg sampling: Percentage of results to be returned (0,100)
+        :arg columnar: return ColumnarResult built as rows are received
+        :arg cursor: resume fetching rows from the position taken from IncompleteResultsError
+
+        :rtype: list or ColumnarResult
+        """
+        def fetch():
+            res = ColumnarResult(fields) if columnar else []
+
+            try:
+                for page in self._iter_search(query, fields, limit, sampling, pages=True, cursor=cursor):
+                    if columnar:
+                        res.add_rows(page)
+                    else:
+                        res.extend(page)
+            except IncompleteResultsError as ex:
+                ex.rows = res
+                raise
+
+            return res
+
+        rows = self._cached(
+            fetch, 'search', self._get_search_body(query, fields, sampling), limit=limit, columnar=columnar,
+            cursor=cursor)
+
+        self._logger.info("{:d} rows returned".format(len(rows)))
+        return rows
+
+    def get_rows(self, match, fields=None, limit=10, sampling=None, columnar=False, cursor=None):
+        """
+        Returns raw rows that matches given query
+
+        :arg match: query to be run against Kibana log messages (ex. {"@message": "Foo Bar DB queries"})
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type columnar bool
+        :arg columnar: return ColumnarResult instead of the list of rows
+        :type cursor dict or None
+        :arg cursor: fetch the remaining rows after IncompleteResultsError (taken from its cursor attribute)
+        """
+        query = {
+            "match": match,
+        }
+
+        return self._search(query, fields, limit, sampling, columnar, cursor)
+
+    def iter_rows(self, match, fields=None, limit=10, sampling=None, pages=False, cursor=None):
+        """
+        Yields raw rows that matches given query as they're fetched from Elasticsearch
+
+        :arg match: query to be run against Kibana log messages (ex. {"@message": "Foo Bar DB queries"})
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type pages bool
+        :arg pages: yield lists of rows (one per scroll page) instead of single rows
+        :type cursor dict or None
+        :arg cursor: fetch the remaining rows after IncompleteResultsError (taken from its cursor attribute)
+        """
+        query = {
+            "match": match,
+        }
+
+        return self._iter_search(query, fields, limit, sampling, pages, cursor)
+
+    def query_by_string(self, query, fields=None, limit=10, sampling=None, columnar=False, cursor=None):
+        """
+        Returns raw rows that matches the given query string
+
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type columnar bool
+        :arg columnar: return ColumnarResult instead of the list of rows
+        :type cursor dict or None
+        :arg cursor: fetch the remaining rows after IncompleteResultsError (taken from its cursor attribute)
+        """
+        query = {
+            "query_string": {
+                "query": query,
+            }
+        }
+
+        return self._search(query, fields, limit, sampling, columnar, cursor)
+
+    def iter_query_by_string(self, query, fields=None, limit=10, sampling=None, pages=False, cursor=None):
+        """
+        Yields raw rows that matches the given query string as they're fetched from Elasticsearch
+
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :type fields list[str] or None
+        :arg limit: the number of results (defaults to 10)
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :type pages bool
+        :arg pages: yield lists of rows (one per scroll page) instead of single rows
+        :type cursor dict or None
+        :arg cursor: fetch the remaining rows after IncompleteResultsError (taken from its cursor attribute)
+        """
+        query = {
+            "query_string": {
+                "query": query,
+            }
+        }
+
+        return self._iter_search(query, fields, limit, sampling, pages, cursor)
+
+    def follow(self, query, fields=None, poll_interval=60, checkpoint=None, tiebreaker='_id', max_polls=None):
+        """
+        Yields new rows that match the given query string as they arrive, starting from the time window's beginning.
+        The time window is moved forward on each poll (this instance's one is not modified).
+
+        Rows are sorted by @timestamp and the tiebreaker field and pages are requested using search_after
+        with the values of the last row, so that every row is returned once. The position is moved forward
+        with each row returned and saved in the checkpoint after each page and when the iteration is stopped.
+        Rows are delivered at least once - the ones returned since the last save are returned again
+        when the process is killed before the checkpoint is saved.
+
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :type fields list[str] or None
+        :arg poll_interval: how long to wait (in seconds) before checking for new rows
+        :type checkpoint Checkpoint or None
+        :arg tiebreaker: field with a unique value per document to sort rows with the same @timestamp
+        :arg max_polls: stop after given number of polls (runs forever by default)
+        """
+        import copy  # pylint: disable=import-outside-toplevel
+
+        checkpoint = checkpoint or Checkpoint()
+        cursor = checkpoint.load() or {'since': self._since, 'search_after': None}
+
+        self._logger.info("Following %s query (cursor: %s)", query, cursor)
+
+        query = {
+            "query_string": {
+                "query": query,
+            }
+        }
+
+        sort = [{"@timestamp": "asc"}, {tiebreaker: "asc"}]
+        polls = 0
+
+        # the time window is moved on a copy that shares the client
+        self._es  # pylint: disable=pointless-statement
+        window = copy.copy(self)
+
+        try:
+            # pylint: disable=protected-access
+            while True:
+                window._set_time_window(since=cursor['since'], to=int(time.time()) - self.SHORT_DELAY)
+                rows = 0
+
+                for hits in window._search_after(window._get_search_body(query, fields), sort,
+                                                 search_after=cursor['search_after']):
+                    for entry in hits:
+                        # the row is consumed once it is returned, @timestamp sort value is in milliseconds
+                        cursor = {'since': entry['sort'][0] // 1000, 'search_after': entry['sort']}
+                        yield self._get_row(entry)
+
+                    rows += len(hits)
+                    checkpoint.save(cursor)
+
+                # nothing new in this time window, do not check it again
+                if rows == 0 and window._to > cursor['since']:
+                    cursor = {'since': window._to, 'search_after': cursor['search_after']}
+                    checkpoint.save(cursor)
+
+                self._logger.info("{:d} new rows returned".format(rows))
+
+                polls += 1
+                if max_polls is not None and polls >= max_polls:
+                    break
+
+                time.sleep(poll_interval)
+        finally:
+            # e.g. the consumer breaks out of the loop in the middle of the page
+            checkpoint.save(cursor)
+
+    @staticmethod
+    def _format_ndjson(page):
+        """
+        :type page list[dict]
+        :rtype: str
+        """
+        return ''.join(json.dumps(row) + '\n' for row in page)
+
+    @staticmethod
+    def _format_csv(page, columns, header=False):
+        """
+        :type page list[dict]
+        :type columns list[str]
+        :arg header: start with the header row
+        :type header bool
+        :rtype: str
+        """
+        def format_value(value):
+            if value is None:
+                return ''
+            if isinstance(value, (dict, list)):
+                return json.dumps(value)
+            return value
+
+        import csv  # pylint: disable=import-outside-toplevel
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+
+        if header:
+            writer.writerow(columns)
+
+        for row in page:
+            writer.writerow([format_value(ColumnarResult.get_field(row, column)) for column in columns])
+
+        return buffer.getvalue()
+
+    @staticmethod
+    def _compress(writer, compress):
+        """
+        Returns the file object that compresses data written to a given writer (or the writer itself)
+
+        :type writer _CountingWriter
+        :type compress str or None
+        :rtype: _CountingWriter or gzip.GzipFile
+        """
+        if compress != 'gzip':
+            return writer
+
+        import gzip  # pylint: disable=import-outside-toplevel
+        return gzip.GzipFile(fileobj=writer, mode='wb')
+
+    def export(self, query, path_or_fileobj, fields=None, limit=None, sampling=None, format='ndjson', compress=None):
+        # pylint: disable=redefined-builtin
+        """
+        Writes rows that match the given query string to a file, page by page as they're fetched from Elasticsearch
+
+        :arg query: query string to be run against Kibana log messages (ex. @message:"^PHP Fatal").
+        :arg path_or_fileobj: path to the file or the file object opened in binary mode
+        :type fields list[str] or None
+        :arg limit: the number of rows to export (all rows are exported by default)
+        :type limit int or None
+        :type sampling int or None
+        :arg sampling: Percentage of results to be returned (0,100)
+        :arg format: either "ndjson" or "csv"
+        :type format str
+        :arg compress: either "gzip" or None
+        :type compress str or None
+        :rtype: dict
+        """
+        if format not in ('ndjson', 'csv'):
+            raise ElasticsearchQueryError('Unsupported export format: {}'.format(format))
+
+        if compress not in (None, 'gzip'):
+            raise ElasticsearchQueryError('Unsupported compression: {}'.format(compress))
+
+        if hasattr(path_or_fileobj, 'write'):
+            fileobj = path_or_fileobj
+        else:
+            fileobj = open(path_or_fileobj, 'wb')  # pylint: disable=consider-using-with
+
+        writer = _CountingWriter(fileobj)
+        out = self._compress(writer, compress)
+
+        columns = fields
+        rows = 0
+
+        try:
+            for page in self.iter_query_by_string(query, fields, limit or sys.maxsize, sampling, pages=True):
+                if not page:
+                    continue
+
+                if format == 'csv':
+                    # take columns from the first row when fields are not specified
+                    columns = columns or [name for name, _ in ColumnarResult.flatten(page[0])]
+                    data = self._format_csv(page, columns, header=rows == 0)
+                else:
+                    data = self._format_ndjson(page)
+
+                out.write(data.encode('utf-8'))
+                rows += len(page)
+        finally:
+            if out is not writer:
+                out.close()  # writes gzip trailer, the underlying file object is not closed
+
+            if fileobj is not path_or_fileobj:
+                fileobj.close()
+            else:
+                fileobj.flush()
+
+        self._logger.info("{:d} rows exported ({:d} bytes written)".format(rows, writer.bytes))
+
+        return {
+            'rows': rows,
+            'bytes': writer.bytes,
+        }
+
+    def _iter_sql_pages(self, sql, fetch_size):
+        """
+        Yields (columns, rows) tuple for each page of SQL query results. The cursor is followed
+        to fetch all the pages and is closed when the generator is closed by the consumer.
+
+        https://www.elastic.co/guide/en/elasticsearch/reference/current/sql-rest.html
+        https://www.elastic.co/guide/en/elasticsearch/reference/current/sql-syntax-select.html
+
+        :type sql str
+        :type fetch_size int
+        :rtype: tuple[list[str], list[list]]
+        """
+        body = {'query': sql, 'fetch_size': fetch_size}
+
+        with self._query_stats('sql', body) as stats:
+            resp = self._es.transport.perform_request('POST', '/_xpack/sql', params={'format': 'json'}, body=body)
+
+            # columns are returned with the first page only
+            columns = [column['name'] for column in resp.get('columns')]
+            cursor = resp.get('cursor')
+
+            try:
+                while True:
+                    self._record_response(stats, resp)
+
+                    if stats is not None:
+                        stats.rows += len(resp.get('rows', []))
+
+                    yield columns, resp.get('rows', [])
+
+                    if not cursor:
+                        break
+
+                    resp = self._es.transport.perform_request(
+                        'POST', '/_xpack/sql', params={'format': 'json'}, body={'cursor': cursor})
+                    cursor = resp.get('cursor')
+            finally:
+                if cursor:
+                    self._es.transport.perform_request('POST', '/_xpack/sql/close', body={'cursor': cursor})
+
+    def iter_query_by_sql(self, sql, fetch_size=1000):
+        """
+        Yields entries matching given SQL query, the next page of results is fetched when needed
+
+        :type sql str
+        :type fetch_size int
+        :rtype: list[dict]
+        """
+        for columns, rows in self._iter_sql_pages(sql, fetch_size):
+            for row in rows:
+                # build key-value dictionary for each row to match results returned by query_by_string
+                yield dict(zip(columns, row))
+
+    def query_by_sql(self, sql, fetch_size=1000, result_format='dicts'):
+        """
+        Returns entries matching given SQL query
+
+        :type sql str
+        :type fetch_size int
+        :arg result_format: 'dicts' - list of column-value dictionaries (the default),
+            'tuples' - list of columns names and list of rows tuples,
+            'columns' - ordered dict with list of values for each column
+        :type result_format str
+        :rtype: list[dict] or tuple[list[str], list[tuple]] or OrderedDict
+        """
+        if result_format not in ('dicts', 'tuples', 'columns'):
+            raise ElasticsearchQueryError('Unsupported SQL result format: {}'.format(result_format))
+
+        return self._get_sql_result(self._iter_sql_pages(sql, fetch_size), result_format)
@@ -18,10 +18,28 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url='https://github.com/macbre/elasticsearch-query',
-    py_modules=["elasticsearch_query"],
+    py_modules=[
+        "elasticsearch_query",
+        "elasticsearch_query_aggregations",
+        "elasticsearch_query_async",
+        "elasticsearch_query_base",
+        "elasticsearch_query_common",
+        "elasticsearch_query_federated",
+        "elasticsearch_query_pagination",
+        "elasticsearch_query_search",
+    ],
     extras_require={
+        'async': [
+            'aiohttp>=3.3.0; python_version >= "3.6"',
+        ],
+        'orjson': [
+            'orjson>=2.0.0; python_version >= "3.6"',
+        ],
         'dev': [
+            'aiohttp>=3.3.0; python_version >= "3.6"',
             'coverage==4.5.2',
+            'numpy',
+            'orjson>=2.0.0; python_version >= "3.6"',
             'pylint>=1.9.2, <=2.1.1',  # 2.x branch is for Python 3
             'pytest==4.0.0',
             'PyYAML==3.13',
@@ -30,6 +48,6 @@ setup(
     },
     install_requires=[
         "elasticsearch>=6.0.0,<7.0.0",
-        "python-dateutil==2.7.5",
+        'futures>=3.2.0; python_version < "3"',  # concurrent.futures backport
     ]
 )
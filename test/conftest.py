@@ -0,0 +1,56 @@
+"""
+pytest configuration
+"""
+import sys
+import time
+
+import pytest
+
+import elasticsearch_query
+import elasticsearch_query_aggregations
+import elasticsearch_query_base
+import elasticsearch_query_common
+import elasticsearch_query_pagination
+import elasticsearch_query_search
+
+# asynchronous generators are available since Python 3.6
+collect_ignore = [] if sys.version_info >= (3, 6) else ['test_AsyncElasticsearchQuery.py']
+
+
+class FakeTime(object):
+    """
+    Replaces time module in elasticsearch_query modules only - the fake Elasticsearch server
+    (and the rest of the process) keeps using the real clock
+    """
+    def __init__(self):
+        self.now = None  # the real time is used when not set
+        self.sleeps = []
+
+    def time(self):
+        """
+        :rtype: float
+        """
+        return self.now if self.now is not None else time.time()
+
+    def sleep(self, delay):
+        """
+        :type delay float
+        """
+        self.sleeps.append(delay)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    """
+    Set fake_time.now to freeze the clock, sleeps are recorded in fake_time.sleeps instead of waiting
+    """
+    clock = FakeTime()
+
+    for module in (elasticsearch_query, elasticsearch_query_aggregations, elasticsearch_query_base,
+                   elasticsearch_query_common, elasticsearch_query_pagination, elasticsearch_query_search):
+        monkeypatch.setattr(module, 'time', clock)
+
+    return clock
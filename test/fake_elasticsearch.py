@@ -0,0 +1,637 @@
+"""
+A tiny in-process HTTP stand-in for Elasticsearch.
+
+It speaks just enough of the REST API to let ElasticsearchQuery be unit-tested without a real cluster.
+Queries are not evaluated - every search matches all the documents the server was created with, only
+range filters are applied (documents without a given field match any range).
+"""
+import calendar
+import gzip
+import json
+import threading
+import time
+
+from uuid import uuid4
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:  # Python 2.7
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+
+class FakeElasticsearch(object):
+    """
+    Usage:
+
+    with FakeElasticsearch(documents=[{'foo': 'bar'}]) as server:
+        es_query = ElasticsearchQuery(es_host=server.host)
+    """
+    # return it from fail_request to close the connection without sending a response (e.g. a node restart)
+    DROP = 'drop'
+
+    def __init__(self, documents=None, fail_request=None, indices=None, latency=0, mappings=None, failed_shards=0):
+        """
+        :type documents list[dict]
+        :type fail_request callable
+        :type indices list[str] or None
+        :type latency float
+        :type mappings dict or None
+        :type failed_shards int
+
+        :arg indices: names of existing indices (all of them exist when not provided)
+        :arg latency: how long (in seconds) to wait before sending each response
+        :arg mappings: field name -> its mapping (e.g. {"type": "long"}), returned by the get field mapping API
+        :arg failed_shards: how many shards (besides the one holding all the documents) fail in each response
+
+        :arg fail_request: called with (method, path, params, body), returns HTTP status code the request
+                           should fail with, DROP or None
+        """
+        self.documents = documents or []
+        self.fail_request = fail_request
+        self.indices = indices
+        self.latency = latency
+        self.mappings = mappings or {}
+        self.failed_shards = failed_shards
+
+        # (method, path, params, body) tuples of all requests received
+        self.requests = []
+
+        # (received, responded) timestamps of all requests handled
+        self.request_times = []
+
+        # scroll_id -> (list of the remaining hits, page size)
+        self.scrolls = {}
+        self.cleared_scrolls = []
+
+        # SQL cursor -> the remaining rows
+        self.sql_cursors = {}
+        self.closed_sql_cursors = []
+
+        # point-in-time ids
+        self.pits = set()
+        self.closed_pits = []
+
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def host(self):
+        """
+        :rtype: str
+        """
+        return '127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get_requests(self, path_suffix):
+        """
+        :type path_suffix str
+        :rtype: list[tuple]
+        """
+        return [request for request in self.requests if request[1].endswith(path_suffix)]
+
+    def _sql_page(self, cursor, columns):
+        rows, fetch_size = self.sql_cursors[cursor]
+        resp = {'rows': rows[:fetch_size]}
+
+        # the first page
+        if columns is not None:
+            resp['columns'] = [{'name': column, 'type': 'keyword'} for column in columns]
+
+        if len(rows) > fetch_size:
+            self.sql_cursors[cursor] = (rows[fetch_size:], fetch_size)
+            resp['cursor'] = cursor
+        else:
+            del self.sql_cursors[cursor]
+
+        return resp
+
+    # parsed timestamps cache, documents usually share them
+    _timestamps = {}
+
+    @classmethod
+    def parse_timestamp(cls, value):
+        """
+        :type value str
+        :rtype: int
+        """
+        if value not in cls._timestamps:
+            # e.g. 2014-07-09T08:37:18.000Z -> UNIX timestamp in ms
+            seconds, millis = value.rstrip('Z').split('.')
+            cls._timestamps[value] = \
+                calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S')) * 1000 + int(millis)
+
+        return cls._timestamps[value]
+
+    @staticmethod
+    def parse_interval(interval):
+        """
+        :type interval str
+        :rtype: int interval in ms
+        """
+        units = {'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+
+        for unit in sorted(units, key=len, reverse=True):
+            if interval.endswith(unit):
+                return int(interval[:-len(unit)]) * units[unit]
+
+        return int(interval)
+
+    def _get_sort_value(self, hit, field):
+        if field == '_id':
+            return hit['_id']
+        if field == '_doc':
+            return hit['_doc']
+
+        value = self.get_field(hit['_source'], field)
+        return self.parse_timestamp(value) if field == '@timestamp' and value is not None else value
+
+    @classmethod
+    def _get_ranges(cls, query):
+        """
+        Yields (field, range) tuples of all range filters in the query
+        """
+        if isinstance(query, dict):
+            for key, value in query.items():
+                if key == 'range':
+                    for item in value.items():
+                        yield item
+                else:
+                    for item in cls._get_ranges(value):
+                        yield item
+        elif isinstance(query, list):
+            for value in query:
+                for item in cls._get_ranges(value):
+                    yield item
+
+    def _matches(self, document, ranges):
+        for field, conditions in ranges:
+            value = self.get_field(document, field)
+            if value is None:
+                continue
+
+            if field == '@timestamp':
+                value = self.parse_timestamp(value)
+                conditions = dict((key, self.parse_timestamp(bound) if isinstance(bound, str) else bound)
+                                  for key, bound in conditions.items())
+
+            if 'gte' in conditions and not value >= conditions['gte'] \
+                    or 'gt' in conditions and not value > conditions['gt'] \
+                    or 'lte' in conditions and not value <= conditions['lte'] \
+                    or 'lt' in conditions and not value < conditions['lt']:
+                return False
+
+        return True
+
+    def _hits(self, body=None):
+        body = body or {}
+        ranges = list(self._get_ranges(body.get('query', {})))
+
+        hits = [
+            {
+                '_index': 'fake-index',
+                '_type': 'log',
+                '_id': '{:06d}'.format(idx),
+                '_score': None,
+                '_source': document,
+                '_doc': idx,
+            }
+            for idx, document in enumerate(self.documents)
+            if self._matches(document, ranges)
+        ]
+
+        sort = [list(item.keys())[0] if isinstance(item, dict) else item for item in body.get('sort', ['_doc'])]
+
+        # requests using point-in-time get the implicit tiebreaker
+        if 'pit' in body:
+            sort.append('_doc')
+
+        for hit in hits:
+            hit['sort'] = [self._get_sort_value(hit, field) for field in sort]
+
+        hits = sorted(hits, key=lambda hit: hit['sort'])
+
+        if 'search_after' in body:
+            hits = [hit for hit in hits if hit['sort'] > body['search_after']]
+
+        for hit in hits:
+            del hit['_doc']
+
+        return hits
+
+    def _project(self, hit, body):
+        """
+        Filter _source and return docvalue_fields and stored_fields
+
+        :type hit dict
+        :type body dict
+        :rtype: dict
+        """
+        hit = dict(hit)
+        source = hit.pop('_source')
+
+        fields = {}
+        for field in body.get('docvalue_fields', []) + body.get('stored_fields', []):
+            value = self.get_field(source, field)
+            if value is not None:
+                fields[field] = sorted(value) if isinstance(value, list) else [value]
+
+        if fields:
+            hit['fields'] = fields
+
+        if body.get('_source') is False:
+            return hit
+
+        includes = body.get('_source', {}).get('includes')
+        hit['_source'] = _filter_response(source, [field.split('.') for field in includes]) or {} \
+            if includes else source
+
+        return hit
+
+    def handle(self, method, path, params, body):
+        """
+        :type method str
+        :type path str
+        :type params dict
+        :type body dict or None
+        :rtype: tuple[int, dict]
+        """
+        with self._lock:
+            self.requests.append((method, path, params, body))
+
+        body = body or {}
+
+        status = self.fail_request(method, path, params, body) if self.fail_request else None
+        if status is not None:
+            return status, {'error': 'injected failure', 'status': status}
+
+        if path.endswith('/_pit'):
+            if method == 'DELETE':
+                self.closed_pits.append(body['id'])
+                self.pits.discard(body['id'])
+                return 200, {'succeeded': True, 'num_freed': 1}
+
+            pit_id = uuid4().hex
+            self.pits.add(pit_id)
+            return 200, {'id': pit_id}
+
+        if path.endswith('/_search/scroll'):
+            if method == 'DELETE':
+                for scroll_id in body.get('scroll_id', []):
+                    self.cleared_scrolls.append(scroll_id)
+                    self.scrolls.pop(scroll_id, None)
+                return 200, {'succeeded': True, 'num_freed': 1}
+
+            return self._scroll_page(body['scroll_id'])
+
+        if path.endswith('/_search'):
+            hits = self._hits(body)
+
+            if 'aggregations' not in body:
+                hits = [self._project(hit, body) for hit in hits]
+
+            # sliced scroll - split hits using their position
+            if 'slice' in body:
+                hits = hits[body['slice']['id']::body['slice']['max']]
+            size = int(params.get('size', body.get('size', 10)))
+
+            if 'scroll' in params:
+                scroll_id = uuid4().hex
+                self.scrolls[scroll_id] = (hits, size)
+                return self._scroll_page(scroll_id)
+
+            resp = self._response(hits[:size], total=len(hits))
+
+            if 'pit' in body:
+                if body['pit']['id'] not in self.pits:
+                    return 404, {'error': 'search_context_missing_exception', 'status': 404}
+                resp['pit_id'] = body['pit']['id']
+
+            if 'aggregations' in body:
+                resp['aggregations'] = self._aggregate(body['aggregations'], [hit['_source'] for hit in hits])
+
+            return 200, resp
+
+        if '/_mapping/field/' in path:
+            fields = path.split('/_mapping/field/')[1].split(',')
+
+            # Elasticsearch 6.x style response, with the document type
+            return 200, {'fake-index': {'mappings': {'log': {
+                field: {'full_name': field, 'mapping': {field.split('.')[-1]: self.mappings[field]}}
+                for field in fields if field in self.mappings
+            }}}}
+
+        if method == 'HEAD' and path.count('/') == 1:
+            exists = self.indices is None or path.lstrip('/') in self.indices
+            return (200 if exists else 404), {}
+
+        if path.endswith('/_xpack/sql/close'):
+            self.closed_sql_cursors.append(body['cursor'])
+            self.sql_cursors.pop(body['cursor'], None)
+            return 200, {'succeeded': True}
+
+        if path.endswith('/_xpack/sql'):
+            if 'cursor' in body:
+                if body['cursor'] not in self.sql_cursors:
+                    return 404, {'error': 'search_context_missing_exception', 'status': 404}
+
+                return 200, self._sql_page(body['cursor'], columns=None)
+
+            columns = sorted(set(key for document in self.documents for key in document))
+            cursor = uuid4().hex
+
+            self.sql_cursors[cursor] = (
+                [[document.get(column) for column in columns] for document in self.documents],
+                body.get('fetch_size', 1000)
+            )
+
+            return 200, self._sql_page(cursor, columns)
+
+        if path.endswith('/_msearch'):
+            index = path[:-len('/_msearch')]
+            responses = []
+
+            # pairs of header and body lines
+            for header, search in zip(body[::2], body[1::2]):
+                status, resp = self.handle('GET', '{}/_search'.format(header.get('index', index)), {}, search)
+                resp['status'] = status
+                responses.append(resp)
+
+            return 200, {'took': 1, 'responses': responses}
+
+        if path.endswith('/_count'):
+            return 200, {'count': len(self._hits(body)), '_shards': self._shards()}
+
+        return 404, {'error': 'no handler found for uri [{}]'.format(path), 'status': 404}
+
+    def _scroll_page(self, scroll_id):
+        if scroll_id not in self.scrolls:
+            return 404, {'error': 'search_context_missing_exception', 'status': 404}
+
+        hits, size = self.scrolls[scroll_id]
+        page = hits[:size]
+        self.scrolls[scroll_id] = (hits[size:], size)
+
+        resp = self._response(page, total=len(self.documents))
+        resp['_scroll_id'] = scroll_id
+        return 200, resp
+
+    @staticmethod
+    def get_field(document, field):
+        """
+        :type document dict
+        :type field str
+        """
+        # aggregations are usually run on "keyword" sub-fields
+        if field.endswith('.keyword'):
+            field = field[:-len('.keyword')]
+
+        value = document
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+
+        return value
+
+    @staticmethod
+    def percentiles(values, percents):
+        """
+        :type values list[float]
+        :type percents list[float]
+        :rtype: dict
+        """
+        values = sorted(values)
+        res = {}
+
+        for percent in percents:
+            if not values:
+                res[str(float(percent))] = None
+                continue
+
+            # interpolate between the closest ranks
+            rank = min(max(percent / 100.0 * len(values) - 0.5, 0), len(values) - 1)
+            lower = int(rank)
+            upper = min(lower + 1, len(values) - 1)
+
+            res[str(float(percent))] = values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+        return res
+
+    def _aggregate(self, aggregations, documents):
+        """
+        :type aggregations dict
+        :type documents list[dict]
+        :rtype: dict
+        """
+        res = {}
+
+        for name, aggregation in aggregations.items():
+            if 'terms' in aggregation:
+                groups = {}
+                for document in documents:
+                    key = self.get_field(document, aggregation['terms']['field'])
+                    if key is not None:
+                        groups.setdefault(key, []).append(document)
+
+                keys = sorted(groups, key=lambda key: (-len(groups[key]), key))
+                keys = keys[:aggregation['terms'].get('size', 10)]
+
+                buckets = []
+                for key in keys:
+                    bucket = {'key': key, 'doc_count': len(groups[key])}
+                    bucket.update(self._aggregate(aggregation.get('aggregations', {}), groups[key]))
+                    buckets.append(bucket)
+
+                res[name] = {'doc_count_error_upper_bound': 0, 'sum_other_doc_count': 0, 'buckets': buckets}
+
+            elif 'composite' in aggregation:
+                sources = [list(source.items())[0] for source in aggregation['composite']['sources']]
+
+                groups = {}
+                for document in documents:
+                    key = tuple(self.get_field(document, source['terms']['field']) for _, source in sources)
+                    if None not in key:
+                        groups.setdefault(key, []).append(document)
+
+                keys = sorted(groups)
+
+                if 'after' in aggregation['composite']:
+                    after = tuple(aggregation['composite']['after'][name] for name, _ in sources)
+                    keys = [key for key in keys if key > after]
+
+                buckets = []
+                for key in keys[:aggregation['composite'].get('size', 10)]:
+                    bucket = {'key': dict(zip([name for name, _ in sources], key)), 'doc_count': len(groups[key])}
+                    bucket.update(self._aggregate(aggregation.get('aggregations', {}), groups[key]))
+                    buckets.append(bucket)
+
+                res[name] = {'buckets': buckets}
+                if buckets:
+                    res[name]['after_key'] = buckets[-1]['key']
+
+            elif 'date_histogram' in aggregation:
+                interval = self.parse_interval(aggregation['date_histogram']['interval'])
+                bounds = aggregation['date_histogram'].get('extended_bounds', {})
+
+                groups = {}
+                for document in documents:
+                    value = self.get_field(document, aggregation['date_histogram']['field'])
+                    if value is not None:
+                        key = self.parse_timestamp(value) // interval * interval
+                        groups.setdefault(key, []).append(document)
+
+                keys = list(groups)
+                if bounds:
+                    keys += [bounds['min'] // interval * interval, bounds['max'] // interval * interval]
+
+                buckets = []
+                if keys:
+                    for key in range(min(keys), max(keys) + 1, interval):
+                        bucket = {'key': key, 'doc_count': len(groups.get(key, []))}
+                        bucket.update(self._aggregate(aggregation.get('aggregations', {}), groups.get(key, [])))
+                        buckets.append(bucket)
+
+                res[name] = {'buckets': buckets}
+
+            elif 'percentiles' in aggregation:
+                values = [self.get_field(document, aggregation['percentiles']['field']) for document in documents]
+                values = [value for value in values if value is not None]
+
+                res[name] = {'values': self.percentiles(values, aggregation['percentiles']['percents'])}
+
+        return res
+
+    def _shards(self):
+        return {'total': 1 + self.failed_shards, 'successful': 1, 'skipped': 0, 'failed': self.failed_shards}
+
+    def _response(self, hits, total):
+        return {
+            'took': 1,
+            'timed_out': False,
+            '_shards': self._shards(),
+            'hits': {'total': total, 'max_score': None, 'hits': hits},
+        }
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _filter_response(value, paths):
+    """
+    Keep only given parts of the response, just like filter_path parameter does (empty objects and lists are dropped)
+
+    :type value object
+    :type paths list[list[str]]
+    :rtype: object
+    """
+    if any(not path for path in paths):
+        return value
+
+    if isinstance(value, list):
+        items = [_filter_response(item, paths) for item in value]
+        return [item for item in items if item is not None] or None
+
+    if isinstance(value, dict):
+        res = {}
+
+        for key, item in value.items():
+            item = _filter_response(item, [path[1:] for path in paths if path and path[0] == key])
+            if item is not None:
+                res[key] = item
+
+        return res or None
+
+    return None
+
+
+def _decode_body(raw):
+    """
+    :type raw bytes
+    :rtype: dict or list or None
+    """
+    if not raw:
+        return None
+
+    raw = raw.decode('utf-8')
+
+    try:
+        return json.loads(raw)
+    except ValueError:
+        # newline-delimited JSON (e.g. Multi Search API)
+        return [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+
+def _make_handler(fake):
+    """
+    :type fake FakeElasticsearch
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _handle(self):
+            received = time.time()
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+
+            # http_compress option of the client
+            if self.headers.get('Content-Encoding') == 'gzip':
+                raw = gzip.decompress(raw)
+
+            params = dict(parse_qsl(url.query))
+
+            status, resp = fake.handle(
+                method=self.command,
+                path=url.path,
+                params=params,
+                body=_decode_body(raw)
+            )
+
+            if status == fake.DROP:
+                self.close_connection = True
+                return
+
+            if status == 200 and 'filter_path' in params:
+                resp = _filter_response(resp, [path.split('.') for path in params['filter_path'].split(',')]) or {}
+
+            payload = json.dumps(resp).encode('utf-8')
+
+            if fake.latency:
+                time.sleep(fake.latency)
+
+            fake.request_times.append((received, time.time()))
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+
+            if self.command != 'HEAD':
+                self.wfile.write(payload)
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    return Handler
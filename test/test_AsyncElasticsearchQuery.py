@@ -0,0 +1,240 @@
+"""
+Set of unit tests for elasticsearch_query_async.py
+"""
+import asyncio
+import inspect
+import time
+
+from pytest import raises
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError
+
+from elasticsearch_query import ClientOptions, ElasticsearchQuery, IncompleteResultsError, LRUCache, PaginationOptions
+from elasticsearch_query_async import AsyncElasticsearchQuery, AsyncTransport
+from fake_elasticsearch import FakeElasticsearch
+
+
+def _get_fake_documents(count):
+    return [{'appname': 'foo', 'host': 'app{}.prod'.format(idx), 'time': idx} for idx in range(count)]
+
+
+def test_normalize_hosts():
+    assert AsyncTransport._normalize_hosts('foo') == ['http://foo:9200']
+    assert AsyncTransport._normalize_hosts('foo:9201,https://bar') == ['http://foo:9201', 'https://bar:9200']
+    assert AsyncTransport._normalize_hosts(['http://foo:80/']) == ['http://foo:80']
+
+
+def test_async_query():
+    async def run(host):
+        async with AsyncElasticsearchQuery(es_host=host, batch_size=10) as es_query:
+            assert await es_query.count('*') == 25
+            assert await es_query.query_by_string('*', limit=15) == _get_fake_documents(15)
+            assert await es_query.get_rows(match={'host': 'prod'}, limit=3) == _get_fake_documents(3)
+
+            pages = [page async for page in es_query.iter_query_by_string('*', limit=22, pages=True)]
+            assert [len(page) for page in pages] == [10, 10, 2]
+
+            assert await es_query.get_aggregations(query='*', stats_field='time', group_by='appname.keyword',
+                                                   percents=(50,)) == {'foo': {'count': 25, '50.0': 12.0}}
+
+            assert len(await es_query.query_by_sql('SELECT * FROM "app-logs"', fetch_size=10)) == 25
+            assert (await es_query.query_by_sql('SELECT * FROM "app-logs"', result_format='columns'))['time'] == \
+                list(range(25))
+
+            rows = es_query.iter_query_by_sql('SELECT * FROM "app-logs"', fetch_size=10)
+            assert (await rows.__anext__())['time'] == 0
+            await rows.aclose()
+
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        asyncio.run(run(server.host))
+        assert server.scrolls == {}, 'All scrolls are cleared'
+        assert server.sql_cursors == {}, 'All SQL cursors are closed'
+
+
+def test_async_failed_shards():
+    async def run(host):
+        async with AsyncElasticsearchQuery(es_host=host, batch_size=10) as es_query:
+            with raises(IncompleteResultsError):
+                await es_query.query_by_string('*', limit=100)
+
+    with FakeElasticsearch(documents=_get_fake_documents(25), failed_shards=1) as server:
+        asyncio.run(run(server.host))
+        assert server.scrolls == {}, 'The scroll is cleared'
+
+
+def test_async_iter_rows_clears_scroll_on_early_exit():
+    async def run(host, server):
+        async with AsyncElasticsearchQuery(es_host=host, batch_size=10) as es_query:
+            rows = es_query.iter_rows(match={'host': 'prod'}, limit=100)
+            assert await rows.__anext__() == _get_fake_documents(1)[0]
+
+            await rows.aclose()
+            assert server.scrolls == {}
+
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        asyncio.run(run(server.host, server))
+
+
+def test_async_shared_transport_and_check_indices():
+    now = int(time.time())
+    today = AsyncElasticsearchQuery.format_index(prefix='app-async', timestamp=now)
+
+    async def run(host):
+        transport = AsyncTransport(hosts=host)
+
+        queries = [
+            AsyncElasticsearchQuery(
+                es_host=None, transport=transport, index_prefix='app-async', since=now - 86400, check_indices=True)
+            for _ in range(10)
+        ]
+
+        assert await asyncio.gather(*[es_query.count('*') for es_query in queries]) == [3] * 10
+        assert await queries[0]._get_index() == today
+
+        await transport.close()
+
+    with FakeElasticsearch(documents=_get_fake_documents(3), indices=[today]) as server:
+        asyncio.run(run(server.host))
+
+
+def test_async_errors():
+    async def run(host):
+        async with AsyncElasticsearchQuery(es_host=host) as es_query:
+            with raises(NotFoundError):
+                await es_query._es.perform_request('GET', '/_foo')
+
+    with FakeElasticsearch() as server:
+        asyncio.run(run(server.host))
+
+
+def test_async_public_methods():
+    # synchronous helpers that do not query Elasticsearch
+    helpers = ['format_index', 'format_indices', 'format_timestamp', 'get_serializer', 'get_to_timestamp']
+    coroutines = ['close', 'count', 'count_many', 'get_aggregations', 'get_histogram', 'get_rows', 'query_by_sql',
+                  'query_by_string', 'search_many']
+    async_generators = ['iter_aggregations', 'iter_query_by_sql', 'iter_query_by_string', 'iter_rows']
+
+    public = sorted(name for name in dir(AsyncElasticsearchQuery)
+                    if not name.startswith('_') and callable(getattr(AsyncElasticsearchQuery, name)))
+    assert public == sorted(helpers + coroutines + async_generators)
+
+    for name in coroutines:
+        assert inspect.iscoroutinefunction(getattr(AsyncElasticsearchQuery, name)), name
+
+    es_query = AsyncElasticsearchQuery(es_host='foo')
+
+    for name in async_generators:
+        assert name in AsyncElasticsearchQuery.__dict__, name
+
+    assert inspect.isasyncgen(es_query.iter_rows(match={'host': 'prod'}))
+
+    # blocking methods of ElasticsearchQuery are not inherited
+    assert not isinstance(es_query, ElasticsearchQuery)
+    assert not hasattr(es_query, '_index')
+
+
+def test_async_aggregations():
+    since = 1546300800  # 2019-01-01 00:00:00
+    documents = [
+        {'@timestamp': AsyncElasticsearchQuery.format_timestamp(since + 30 + offset), 'host': host, 'time': offset}
+        for offset, host in [(0, 'app1'), (10, 'app2'), (70, 'app1'), (200, 'app1')]
+    ]
+
+    async def run(host):
+        async with AsyncElasticsearchQuery(es_host=host, since=since - 1, to=since + 299) as es_query:
+            assert await es_query.count_many(['*'] * 5, chunk_size=2, concurrency=2) == [4] * 5
+
+            res = await es_query.search_many([{'size': 1, 'query': {'match': {'host': 'app2'}}}])
+            assert len(res[0]['hits']['hits']) == 1
+
+            assert await es_query.get_histogram(query='*', interval=60) == {
+                'timestamps': [since, since + 60, since + 120, since + 180, since + 240],
+                'counts': [2, 1, 0, 1, 0],
+            }
+
+            res = await es_query.get_histogram(query='*', interval='1m', group_by='host.keyword')
+            assert res['app1']['counts'] == [1, 1, 0, 1, 0]
+
+            res = [group async for group in es_query.iter_aggregations(
+                query='*', group_by='host.keyword', stats_field='time', percents=(50,), page_size=1)]
+            assert res == [('app1', 3, {'50.0': 70.0}), ('app2', 1, {'50.0': 10.0})]
+
+    with FakeElasticsearch(documents=documents) as server:
+        asyncio.run(run(server.host))
+        assert len(server.get_requests('/_msearch')) == 3 + 1
+
+
+def test_async_unsupported_options():
+    unsupported = [
+        ('cache', {'cache': LRUCache()}),
+        ('stats_callback', {'stats_callback': print}),
+        ('partitions', {'pagination_options': PaginationOptions(partitions=4)}),
+        ('parallelism', {'pagination_options': PaginationOptions(parallelism=2)}),
+        ('search_after', {'pagination_options': PaginationOptions(method='search_after')}),
+        ('point_in_time', {'pagination_options': PaginationOptions(point_in_time=True)}),
+        ('docvalues', {'pagination_options': PaginationOptions(projection='docvalues')}),
+        ('AsyncTransport', {'client_options': ClientOptions(client=Elasticsearch(hosts='foo'))}),
+    ]
+
+    for option, kwargs in unsupported:
+        with raises(ValueError, match=option):
+            AsyncElasticsearchQuery(es_host='foo', **kwargs)
+
+    # AsyncTransport can be provided via client options too, it is not closed then
+    transport = AsyncTransport(hosts='foo')
+    es_query = AsyncElasticsearchQuery(es_host=None, client_options=ClientOptions(client=transport))
+    assert es_query._es is transport
+    assert es_query._owns_transport is False
+
+
+def test_async_small_limit():
+    async def run(host):
+        async with AsyncElasticsearchQuery(es_host=host, batch_size=10) as es_query:
+            assert await es_query.query_by_string('*', limit=5) == _get_fake_documents(5)
+
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        asyncio.run(run(server.host))
+
+        # the limit fits in a single page, no scroll context is created
+        assert server.get_requests('/_search/scroll') == []
+        assert server.get_requests('/_search')[-1][2].get('scroll') is None
+        assert server.get_requests('/_search')[-1][3]['terminate_after'] == 5
+
+
+def test_async_scroll_retries():
+    rejected = []
+
+    def fail_request(method, path, params, body):
+        # the second page request is rejected once
+        if path.endswith('/_search/scroll') and method != 'DELETE' and not rejected:
+            rejected.append(body['scroll_id'])
+            return 429
+        return None
+
+    async def run(host):
+        async with AsyncElasticsearchQuery(es_host=host, batch_size=10, pagination_options=PaginationOptions(
+                retry_backoff=0)) as es_query:
+            assert await es_query.query_by_string('*', limit=100) == _get_fake_documents(25)
+
+    with FakeElasticsearch(documents=_get_fake_documents(25), fail_request=fail_request) as server:
+        asyncio.run(run(server.host))
+        assert len(rejected) == 1
+        assert server.scrolls == {}, 'The scroll is cleared'
+
+
+def test_async_scroll_failure():
+    def fail_request(method, path, params, body):
+        # the scroll request could have been processed, hence it is not retried
+        return 500 if path.endswith('/_search/scroll') and method != 'DELETE' else None
+
+    async def run(host):
+        async with AsyncElasticsearchQuery(es_host=host, batch_size=10) as es_query:
+            with raises(IncompleteResultsError) as ex:
+                await es_query.query_by_string('*', limit=100)
+
+            assert ex.value.rows == _get_fake_documents(10)
+
+    with FakeElasticsearch(documents=_get_fake_documents(25), fail_request=fail_request) as server:
+        asyncio.run(run(server.host))
+        assert len([request for request in server.get_requests('/_search/scroll') if request[0] != 'DELETE']) == 1
+        assert server.scrolls == {}, 'The scroll is cleared'
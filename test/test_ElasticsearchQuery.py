@@ -1,9 +1,29 @@
 """
 Set of unit tests for elastic_search.py
 """
+import gzip
+import io
+import json
+import math
+import os
+import subprocess
+import sys
 import time
 
-from elasticsearch_query import ElasticsearchQuery
+import urllib3
+
+from pytest import raises, warns
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, ConnectionTimeout, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+import elasticsearch_query
+import elasticsearch_query_common
+from elasticsearch_query import ElasticsearchQuery, ElasticsearchQueryError, LRUCache, DiskCache, Checkpoint, \
+    FileCheckpoint, RollingWindow, ColumnarResult, OrjsonSerializer, IncompleteResultsError, ClientOptions, \
+    PaginationOptions, SamplingOptions
+from elasticsearch_query_federated import FederatedQuery
+from fake_elasticsearch import FakeElasticsearch
 
 
 def test_indexes():
@@ -17,7 +37,8 @@ def test_indexes_prefix():
 
 
 def test_indexes_prefix_with_separator():
-    es_query = ElasticsearchQuery(es_host='foo', index_prefix='syslog-ng', index_sep="_")
+    es_query = ElasticsearchQuery(
+        es_host='foo', index_prefix='syslog-ng', index_sep="_", since=int(time.time()) - ElasticsearchQuery.DAY)
     assert es_query._index.startswith('syslog-ng_')
     assert ',syslog-ng_' in es_query._index
 
@@ -29,6 +50,46 @@ def test_format_index():
     assert ElasticsearchQuery.format_index(prefix='syslog-ng', timestamp=1408450795, sep="_") == 'syslog-ng_2014.08.19'
 
 
+def test_format_indices():
+    assert ElasticsearchQuery.format_indices(prefix='logstash', since=1408450795, to=1408450795 + 600) == \
+        ['logstash-2014.08.19']
+    assert ElasticsearchQuery.format_indices(prefix='logstash', since=1408450795 - 86400, to=1408450795) == \
+        ['logstash-2014.08.18', 'logstash-2014.08.19']
+    assert ElasticsearchQuery.format_indices(prefix='logstash', since=1408406400, to=1408406400 + 86400) == \
+        ['logstash-2014.08.19', 'logstash-2014.08.20']
+    assert ElasticsearchQuery.format_indices(prefix='logstash', since=1408406399, to=1408406400, sep='_') == \
+        ['logstash_2014.08.18', 'logstash_2014.08.19']
+    assert len(ElasticsearchQuery.format_indices(prefix='logstash', since=1408450795 - 7 * 86400, to=1408450795)) == 8
+    assert ElasticsearchQuery.format_indices(prefix='logstash', since=1, to=1408450795) == ['logstash-*']
+
+
+def test_indexes_from_time_window():
+    now = int(time.time())
+
+    es_query = ElasticsearchQuery(es_host='foo', period=600)
+    assert es_query._index == ','.join(ElasticsearchQuery.format_indices('logstash-other', now - 600, now - 5))
+
+    es_query = ElasticsearchQuery(es_host='foo', since=now - 3 * ElasticsearchQuery.DAY)
+    assert len(es_query._index.split(',')) == 4
+
+
+def test_check_indices():
+    now = int(time.time())
+    since = now - 2 * ElasticsearchQuery.DAY
+    today = ElasticsearchQuery.format_index(prefix='app', timestamp=now)
+
+    with FakeElasticsearch(indices=[today]) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, index_prefix='app', since=since, check_indices=True)
+        assert es_query._index == today
+
+        # the result is cached
+        assert es_query._index == today
+        assert len(server.get_requests(today)) == 1
+
+        es_query = ElasticsearchQuery(es_host=server.host, index_prefix='app', since=since)
+        assert es_query._index.endswith(',' + today)
+
+
 def test_time():
     now = int(time.time())
 
@@ -69,3 +130,1110 @@ def test_get_timestamp_filer():
     assert res['range']['@timestamp'] is not None
     assert res['range']['@timestamp']['gte'] == '1970-01-02T10:17:37.000Z'
     assert res['range']['@timestamp']['lte'] is not None
+
+
+def _get_fake_documents(count):
+    return [{'host': 'app{}.prod'.format(idx), 'time': idx} for idx in range(count)]
+
+
+def test_iter_rows():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        rows = es_query.iter_query_by_string('*', limit=100)
+        assert not isinstance(rows, list)
+        assert next(rows) == {'host': 'app0.prod', 'time': 0}
+        assert len(list(rows)) == 24
+
+        assert es_query.get_rows(match={'host': 'prod'}, limit=15) == _get_fake_documents(15)
+        assert list(es_query.iter_rows(match={'host': 'prod'}, limit=15)) == _get_fake_documents(15)
+
+
+def test_iter_rows_pages():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        pages = list(es_query.iter_query_by_string('*', limit=22, pages=True))
+        assert [len(page) for page in pages] == [10, 10, 2]
+
+
+def test_iter_rows_clears_scroll_on_early_exit():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        rows = es_query.iter_query_by_string('*', limit=100)
+        next(rows)
+        assert server.cleared_scrolls == []
+
+        rows.close()
+        assert len(server.cleared_scrolls) == 1
+        assert server.scrolls == {}
+
+
+def test_parallel_sliced_scroll():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=4,
+                                      pagination_options=PaginationOptions(parallelism=3))
+
+        rows = es_query.query_by_string('*', limit=100)
+        assert sorted(rows, key=lambda row: row['time']) == _get_fake_documents(25)
+
+        slices = [request[3]['slice'] for request in server.get_requests('/_search')][:3]
+        assert sorted(item['id'] for item in slices) == [0, 1, 2]
+        assert all(item['max'] == 3 for item in slices)
+
+        assert len(es_query.query_by_string('*', limit=10)) == 10
+        assert len(list(es_query.iter_query_by_string('*', limit=7))) == 7
+
+        assert server.scrolls == {}, 'All slices are cleared'
+
+
+def test_parallel_sliced_scroll_failure():
+    def fail_request(method, path, params, body):
+        return 500 if body.get('slice', {}).get('id') == 1 else None
+
+    with FakeElasticsearch(documents=_get_fake_documents(25), fail_request=fail_request) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=2,
+                                      pagination_options=PaginationOptions(parallelism=3))
+
+        with raises(TransportError):
+            es_query.query_by_string('*', limit=100)
+
+        assert server.scrolls == {}, 'All slices are cleared'
+
+
+def test_count_and_aggregations():
+    documents = [
+        {'appname': 'foo', 'time': 320},
+        {'appname': 'foo', 'time': 210},
+        {'appname': 'foo', 'time': 120},
+        {'appname': 'bar', 'time': 100},
+    ]
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host)
+
+        assert es_query.count('*') == 4
+
+        res = es_query.get_aggregations(
+            query='*', stats_field='time', group_by='appname.keyword', percents=(25, 50, 75))
+        assert res == {
+            'foo': {'count': 3, '25.0': 142.5, '50.0': 210.0, '75.0': 292.5},
+            'bar': {'count': 1, '25.0': 100.0, '50.0': 100.0, '75.0': 100.0},
+        }
+
+        assert es_query.query_by_sql('SELECT * FROM "app-logs"') == documents
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2, ttl=60)
+
+    cache.set('foo', 1)
+    cache.set('bar', 2)
+    assert cache.get('foo') == 1
+
+    cache.set('test', 3)  # bar is evicted as the least recently used one
+    assert len(cache) == 2
+    assert cache.get('bar') is None
+    assert cache.get('test') == 3
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache = LRUCache(ttl=-1)
+    cache.set('foo', 1)
+    assert cache.get('foo') is None
+
+
+def test_disk_cache(tmpdir):
+    cache = DiskCache(directory=str(tmpdir))
+    cache.set('foo', {'bar': [1, 2]})
+
+    # a new instance (e.g. after the process restart)
+    cache = DiskCache(directory=str(tmpdir))
+    assert cache.get('foo') == {'bar': [1, 2]}
+    assert cache.get('bar') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    assert DiskCache(directory=str(tmpdir), ttl=-1).get('foo') is None
+
+
+def test_results_cache(fake_time):
+    now = fake_time.now = 1546300800
+    cache = LRUCache()
+
+    with FakeElasticsearch(documents=_get_fake_documents(5)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, since=now - 3600, to=now - 600, cache=cache)
+        assert es_query.get_to_timestamp() == now - 600
+
+        assert es_query.count('*') == 5
+        assert es_query.count('*') == 5
+        assert es_query.count('foo') == 5
+        assert len(server.get_requests('/_count')) == 2
+
+        rows = es_query.query_by_string('*', limit=2)
+        assert len(rows) == 2
+        rows.pop()  # cached results are copies
+        assert len(es_query.query_by_string('*', limit=2)) == 2
+        assert len(es_query.query_by_string('*', limit=3)) == 3
+        assert len(server.get_requests('/_search')) == 2
+
+        assert (cache.hits, cache.misses) == (2, 4)
+
+        # the window that ends at the default "now" is never cached (even when the clock moves on)
+        es_query = ElasticsearchQuery(es_host=server.host, since=now - 3600, cache=cache)
+        fake_time.now = now + 60
+        es_query.count('*')
+        es_query.count('*')
+        assert len(server.get_requests('/_count')) == 4
+
+        # neither is the window that ends in the future
+        es_query = ElasticsearchQuery(es_host=server.host, since=now - 3600, to=now + 3600, cache=cache)
+        es_query.count('*')
+        assert len(server.get_requests('/_count')) == 5
+        assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_results_cache_hosts(fake_time):
+    now = fake_time.now = 1546300800
+    cache = LRUCache()
+
+    # the same query sent to two clusters sharing the cache
+    with FakeElasticsearch(documents=_get_fake_documents(3)) as first, \
+            FakeElasticsearch(documents=_get_fake_documents(7)) as second:
+        assert ElasticsearchQuery(es_host=first.host, since=now - 3600, to=now - 600, cache=cache).count('*') == 3
+        assert ElasticsearchQuery(es_host=second.host, since=now - 3600, to=now - 600, cache=cache).count('*') == 7
+
+        assert ElasticsearchQuery(es_host=second.host, since=now - 3600, to=now - 600, cache=cache).count('*') == 7
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        # clusters of the federated query sharing the cache have their own entries
+        federated = FederatedQuery(clusters=[{'es_host': first.host}, {'es_host': second.host}],
+                                   since=now - 3600, to=now - 600, cache=cache)
+        assert federated.count('*') == 10
+
+
+def test_follow(tmpdir):
+    now = int(time.time())
+    checkpoint_file = str(tmpdir.join('checkpoint.json'))
+
+    def get_documents(timestamp, count, start=0):
+        return [
+            {'@timestamp': ElasticsearchQuery.format_timestamp(timestamp), 'idx': idx}
+            for idx in range(start, start + count)
+        ]
+
+    # three rows with the same timestamp do not fit into a single page
+    documents = get_documents(now - 120, 1) + get_documents(now - 60, 3, start=1)
+
+    with FakeElasticsearch(documents=documents) as server:
+        def follow(max_polls):
+            es_query = ElasticsearchQuery(es_host=server.host, batch_size=2, period=600)
+            return es_query.follow(
+                '*', poll_interval=0, checkpoint=FileCheckpoint(checkpoint_file), max_polls=max_polls)
+
+        rows = follow(max_polls=1)
+        assert [next(rows)['idx'] for _ in range(4)] == [0, 1, 2, 3]
+
+        # a new row arrives while the results are paginated
+        server.documents += get_documents(now - 60, 1, start=4)
+        assert [row['idx'] for row in rows] == [4]
+
+        search_after = [request[3].get('search_after') for request in server.get_requests('/_search')]
+        assert search_after[0] is None
+        assert search_after[1][0] == (now - 60) * 1000
+
+        # resume from the checkpoint
+        server.documents += get_documents(now - 30, 1, start=5) + get_documents(now - 20, 1, start=6)
+        assert [row['idx'] for row in follow(max_polls=1)] == [5, 6]
+
+        assert list(follow(max_polls=2)) == []
+        assert FileCheckpoint(checkpoint_file).load()['since'] >= now - 5, 'Empty time window is skipped'
+
+
+def test_follow_stopped_mid_page():
+    now = int(time.time())
+    documents = [{'@timestamp': ElasticsearchQuery.format_timestamp(now - 60 + idx), 'idx': idx} for idx in range(5)]
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10, period=600)
+        window = (es_query._since, es_query._to)
+        checkpoint = Checkpoint()
+
+        for row in es_query.follow('*', poll_interval=0, checkpoint=checkpoint):
+            if row['idx'] == 1:
+                break
+
+        # the position of the last row returned is saved when the consumer stops in the middle of the page
+        assert checkpoint.load()['since'] == now - 59
+        assert [row['idx'] for row in es_query.follow('*', checkpoint=checkpoint, max_polls=1)] == [2, 3, 4]
+
+        # the time window of the instance is not moved
+        assert (es_query._since, es_query._to) == window
+
+
+def _get_fake_log_documents(count):
+    now = int(time.time())
+    return [
+        {'@timestamp': ElasticsearchQuery.format_timestamp(now - 60 + idx % 7), 'idx': idx} for idx in range(count)
+    ]
+
+
+def test_search_after_pagination():
+    documents = _get_fake_log_documents(25)
+    expected = sorted(documents, key=lambda row: (row['@timestamp'], row['idx']))
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10,
+                                      pagination_options=PaginationOptions(method='search_after'))
+
+        assert es_query.query_by_string('*', limit=100) == expected
+        assert es_query.query_by_string('*', limit=12) == expected[:12]
+
+        # the last page request is trimmed to the remaining limit
+        assert [request[3]['size'] for request in server.get_requests('/_search')] == [10, 10, 10, 10, 2]
+        assert server.scrolls == {}, 'Scroll API is not used'
+
+        with raises(ElasticsearchQueryError):
+            PaginationOptions(method='foo')
+
+
+def test_search_after_point_in_time():
+    documents = _get_fake_log_documents(25)
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10, pagination_options=PaginationOptions(
+            method='search_after', point_in_time=True))
+
+        assert len(list(es_query.iter_query_by_string('*', limit=100))) == 25
+        assert len(server.closed_pits) == 1
+        assert server.pits == set()
+
+        requests = server.get_requests('/_search')
+        assert all(request[1] == '/_search' for request in requests), 'Indices are not specified'
+        assert all(request[3]['pit']['id'] == server.closed_pits[0] for request in requests)
+
+
+def test_search_after_resumes_on_failure():
+    documents = _get_fake_log_documents(25)
+    failures = []
+
+    def fail_request(method, path, params, body):
+        # the second page request fails twice
+        if body.get('search_after') and len(failures) < 2:
+            failures.append(body['search_after'])
+            return 429
+        return None
+
+    with FakeElasticsearch(documents=documents, fail_request=fail_request) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10, pagination_options=PaginationOptions(
+            method='search_after', retry_backoff=0))
+
+        assert len(es_query.query_by_string('*', limit=100)) == 25
+        assert failures[0] == failures[1]
+
+        search_after = [request[3].get('search_after') for request in server.get_requests('/_search')]
+        assert search_after[0] is None
+        assert search_after[1] == search_after[2] == search_after[3] == failures[0], 'Retried from the same position'
+
+
+def test_incomplete_results_resume():
+    documents = _get_fake_log_documents(25)
+    expected = sorted(documents, key=lambda row: (row['@timestamp'], row['idx']))
+    node_down = [True]
+
+    def fail_request(method, path, params, body):
+        # the node goes away after the first page is returned
+        return FakeElasticsearch.DROP if body.get('search_after') and node_down[0] else None
+
+    with FakeElasticsearch(documents=documents, fail_request=fail_request) as server:
+        # transport's own retries would wait for the connection marked as dead
+        es_query = ElasticsearchQuery(
+            es_host=server.host, batch_size=10,
+            pagination_options=PaginationOptions(method='search_after', max_retries=2, retry_backoff=0),
+            client_options=ClientOptions(client=Elasticsearch(hosts=server.host, max_retries=0)))
+
+        with raises(IncompleteResultsError) as ex:
+            es_query.query_by_string('*', limit=100)
+
+        assert ex.value.rows == expected[:10]
+        assert ex.value.cursor == {'search_after': server.requests[-1][3]['search_after'], 'remaining': 90}
+
+        # the node is back, fetch the remaining rows
+        node_down[0] = False
+        assert es_query.query_by_string('*', limit=100, cursor=ex.value.cursor) == expected[10:]
+        assert list(es_query.iter_query_by_string('*', limit=100, cursor=ex.value.cursor)) == expected[10:]
+
+        # the limit of the call that failed applies when resuming
+        node_down[0] = True
+        with raises(IncompleteResultsError) as ex:
+            es_query.query_by_string('*', limit=12)
+
+        node_down[0] = False
+        assert es_query.query_by_string('*', limit=12, cursor=ex.value.cursor) == expected[10:12]
+
+        # the cursor can only be used with the pagination it was taken from
+        with raises(ElasticsearchQueryError):
+            ElasticsearchQuery(es_host=server.host).query_by_string('*', cursor=ex.value.cursor)
+
+
+def test_incomplete_results_resume_scroll():
+    rejected = [True]
+
+    def fail_request(method, path, params, body):
+        # scroll requests are rejected after the first page is returned
+        return 429 if path.endswith('/_search/scroll') and method != 'DELETE' and rejected[0] else None
+
+    with FakeElasticsearch(documents=_get_fake_documents(25), fail_request=fail_request) as server:
+        es_query = ElasticsearchQuery(
+            es_host=server.host, batch_size=10,
+            pagination_options=PaginationOptions(max_retries=1, retry_backoff=0))
+
+        with raises(IncompleteResultsError) as ex:
+            es_query.query_by_string('*', limit=100)
+
+        # the rejected request was not processed, so the scroll can be resumed
+        assert ex.value.rows == _get_fake_documents(10)
+        assert ex.value.cursor == {'scroll_id': list(server.scrolls)[0], 'remaining': 90}
+        assert server.cleared_scrolls == [], 'The scroll context is kept'
+
+        with raises(ElasticsearchQueryError):
+            ElasticsearchQuery(es_host=server.host, pagination_options=PaginationOptions(
+                method='search_after')).query_by_string('*', cursor=ex.value.cursor)
+
+        rejected[0] = False
+        assert es_query.query_by_string('*', limit=100, cursor=ex.value.cursor) == _get_fake_documents(25)[10:]
+        assert server.scrolls == {}
+
+    # the scroll could have moved forward when the request failed in any other way
+    def fail_scroll(method, path, params, body):
+        return 500 if path.endswith('/_search/scroll') and method != 'DELETE' else None
+
+    with FakeElasticsearch(documents=_get_fake_documents(25), fail_request=fail_scroll) as server:
+        es_query = ElasticsearchQuery(
+            es_host=server.host, batch_size=10,
+            client_options=ClientOptions(client=Elasticsearch(hosts=server.host, max_retries=0)))
+
+        with raises(IncompleteResultsError) as ex:
+            es_query.query_by_string('*', limit=100)
+
+        assert ex.value.cursor is None
+        assert len([request for request in server.get_requests('/_search/scroll') if request[0] != 'DELETE']) == 1, \
+            'Not retried'
+        assert len(server.cleared_scrolls) == 1
+
+
+def test_is_unprocessed_error():
+    refused = urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+    dropped = urllib3.exceptions.ProtocolError('Connection aborted.')
+
+    assert ElasticsearchQuery._is_unprocessed_error(TransportError(429, 'too_many_requests'))
+    assert ElasticsearchQuery._is_unprocessed_error(ESConnectionError('N/A', str(refused), refused))
+
+    assert not ElasticsearchQuery._is_unprocessed_error(ESConnectionError('N/A', str(dropped), dropped))
+    assert not ElasticsearchQuery._is_unprocessed_error(ConnectionTimeout('TIMEOUT', 'Read timed out', None))
+    assert not ElasticsearchQuery._is_unprocessed_error(TransportError(503, 'unavailable'))
+
+
+def test_incomplete_results_expired_scroll():
+    def fail_request(method, path, params, body):
+        return 404 if path.endswith('/_search/scroll') and method != 'DELETE' else None
+
+    with FakeElasticsearch(documents=_get_fake_documents(25), fail_request=fail_request) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        with raises(IncompleteResultsError) as ex:
+            es_query.query_by_string('*', limit=100, columnar=True)
+
+        # rows received before the scroll context expired are kept, but the scroll can not be resumed
+        assert len(ex.value.rows) == 10
+        assert isinstance(ex.value.rows, ColumnarResult)
+        assert ex.value.cursor is None
+
+
+def test_incomplete_results_failed_shards():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+        rows = es_query.iter_query_by_string('*', limit=100)
+
+        assert [next(rows) for _ in range(10)] == _get_fake_documents(10)
+
+        # one of the shards fails while the scroll is in progress
+        server.failed_shards = 1
+
+        with raises(IncompleteResultsError) as ex:
+            next(rows)
+
+        assert '1 of 2 shards failed' in str(ex.value)
+        assert len(server.cleared_scrolls) == 1
+
+        # partial results of a single page are not returned either
+        with raises(IncompleteResultsError):
+            es_query.query_by_string('*', limit=5)
+
+        with raises(IncompleteResultsError):
+            es_query.query_by_string('*', limit=100)
+
+        assert len(server.cleared_scrolls) == 2
+
+
+def test_retry_backoff(fake_time):
+
+    with FakeElasticsearch(documents=_get_fake_documents(5), fail_request=lambda *args: 429) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, pagination_options=PaginationOptions(
+            max_retries=4, retry_backoff=0.5))
+
+        with raises(IncompleteResultsError) as ex:
+            es_query.query_by_string('*', limit=100)
+
+        assert ex.value.rows == []
+        assert fake_time.sleeps == [0.5, 1, 2, 4], 'The delay is doubled with each retry'
+        assert len(server.requests) == 5
+
+        # errors that are not transient are not retried
+        server.fail_request = lambda *args: 400
+        with raises(TransportError):
+            es_query.query_by_string('*', limit=10)
+
+        assert len(server.requests) == 6
+
+
+def test_sampling():
+    query = {'match': {'host': 'prod'}}
+
+    es_query = ElasticsearchQuery(es_host='foo')
+    assert 'function_score' not in es_query._get_search_body(query)['query']
+
+    body = es_query._get_search_body(query, sampling=10)
+    assert body['query']['function_score']['random_score'] == \
+        {'seed': ElasticsearchQuery.SAMPLING_SEED, 'field': '_seq_no'}
+    assert body['query']['function_score']['min_score'] == 0.9
+    assert body['query']['function_score']['query']['bool']['must'][0] == query
+
+    es_query = ElasticsearchQuery(es_host='foo', sampling_options=SamplingOptions('hash_field', 'sampling_hash'))
+    body = es_query._get_search_body(query, sampling=10)
+    assert body['query']['bool']['must'][-1] == {'range': {'sampling_hash': {'lt': 10}}}
+
+    es_query = ElasticsearchQuery(es_host='foo', sampling_options=SamplingOptions('script'))
+    body = es_query._get_search_body(query, sampling=10)
+    assert body['query']['bool']['must'][-1]['script']['script']['params'] == {'sampling': 10}
+
+    with raises(ElasticsearchQueryError):
+        SamplingOptions('foo')
+
+    with raises(ElasticsearchQueryError):
+        SamplingOptions('hash_field')
+
+
+def test_count_many():
+    def fail_request(method, path, params, body):
+        if isinstance(body, dict) and 'query_string' in json.dumps(body) and '"bad' in json.dumps(body):
+            return 400
+        return None
+
+    with FakeElasticsearch(documents=_get_fake_documents(5), fail_request=fail_request) as server:
+        es_query = ElasticsearchQuery(es_host=server.host)
+
+        res = es_query.count_many(['*', 'host: app1', 'bad query', 'foo'])
+        assert res[:2] == [5, 5]
+        assert isinstance(res[2], ElasticsearchQueryError)
+        assert res[3] == 5
+        assert len(server.get_requests('/_msearch')) == 1
+
+        res = es_query.count_many(['*'] * 7, chunk_size=2, concurrency=3)
+        assert res == [5] * 7
+        assert len(server.get_requests('/_msearch')) == 1 + 4
+
+
+def test_search_many():
+    with FakeElasticsearch(documents=_get_fake_documents(5)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host)
+
+        res = es_query.search_many([
+            {'size': 0, 'aggregations': {'max_time': {'percentiles': {'field': 'time', 'percents': [100]}}}},
+            {'size': 1, 'query': {'match': {'host': 'app1.prod'}}},
+        ])
+
+        assert res[0]['aggregations']['max_time']['values'] == {'100.0': 4}
+        assert len(res[1]['hits']['hits']) == 1
+
+        body = server.get_requests('/_msearch')[0][3][3]
+        assert body['query']['bool']['must'][0] == {'match': {'host': 'app1.prod'}}
+        assert 'range' in body['query']['bool']['must'][1], 'Time window filter is added'
+
+
+def test_iter_aggregations():
+    documents = [
+        {'host': 'app{}'.format(idx % 5), 'method': 'GET' if idx % 2 else 'POST', 'time': idx}
+        for idx in range(50)
+    ]
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host)
+
+        res = es_query.iter_aggregations(query='*', group_by='host.keyword', stats_field='time', percents=(50,),
+                                         page_size=2)
+        assert not isinstance(res, list)
+
+        res = list(res)
+        assert [key for key, _, _ in res] == ['app0', 'app1', 'app2', 'app3', 'app4']
+        assert res[0] == ('app0', 10, {'50.0': 22.5})
+        assert len(server.get_requests('/_search')) == 3
+
+        res = list(es_query.iter_aggregations(
+            query='*', group_by=['host.keyword', 'method.keyword'], stats_field='time', page_size=3))
+        assert len(res) == 5 * 2
+        assert res[0][:2] == (('app0', 'GET'), 5)
+        assert res[1][:2] == (('app0', 'POST'), 5)
+
+
+def test_get_histogram():
+    since = 1546300800  # 2019-01-01 00:00:00
+    documents = [
+        {'@timestamp': ElasticsearchQuery.format_timestamp(since + 30 + offset), 'host': host, 'time': offset}
+        for offset, host in [(0, 'app1'), (10, 'app2'), (70, 'app1'), (200, 'app1')]
+    ]
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, since=since - 1, to=since + 299)
+
+        assert es_query.get_histogram(query='*', interval=60) == {
+            'timestamps': [since, since + 60, since + 120, since + 180, since + 240],
+            'counts': [2, 1, 0, 1, 0],
+        }
+
+        res = es_query.get_histogram(query='*', interval='2m', stats_field='time', percents=(50,))
+        assert res['timestamps'] == [since, since + 120, since + 240]
+        assert res['counts'] == [3, 1, 0]
+        assert res['50.0'] == [10, 200, None]
+
+        res = es_query.get_histogram(query='*', interval='1m', group_by='host.keyword')
+        assert sorted(res.keys()) == ['app1', 'app2']
+        assert res['app1']['counts'] == [1, 1, 0, 1, 0]
+        assert res['app2']['counts'] == [1, 0, 0, 0, 0]
+
+
+def test_rolling_window(fake_time):
+    now = fake_time.now = 1546300800 + 3600  # 2019-01-01 01:00:00
+
+    def get_documents(timestamps):
+        return [
+            {'@timestamp': ElasticsearchQuery.format_timestamp(timestamp), 'host': 'app1', 'time': timestamp % 100}
+            for timestamp in timestamps
+        ]
+
+    # the window is 2019-01-01 00:50:00 - 00:59:55
+    with FakeElasticsearch(documents=get_documents([now - 1200, now - 600, now - 590, now - 30, now - 10])) as server:
+        rolling = RollingWindow(ElasticsearchQuery(es_host=server.host), query='*', window=600, bucket=60)
+
+        assert rolling.count() == 4
+        assert server.requests[-1][3]['query']['bool']['must'][1]['range']['@timestamp']['gte'] == \
+            '2019-01-01T00:50:00.000Z'
+
+        # only the last, not settled bucket is queried
+        server.documents += get_documents([now - 8])
+        assert rolling.count() == 5
+        assert server.requests[-1][3]['query']['bool']['must'][1]['range']['@timestamp']['gte'] == \
+            '2019-01-01T00:59:00.000Z'
+
+        # two minutes later - old buckets are evicted, new ones are queried
+        now = fake_time.now = now + 120
+        server.documents += get_documents([now - 60])
+        assert rolling.count() == 4
+        assert server.requests[-1][3]['query']['bool']['must'][1]['range']['@timestamp']['gte'] == \
+            '2019-01-01T00:59:00.000Z'
+        assert len(server.get_requests('/_search')) == 3
+
+
+def test_rolling_window_stats(fake_time):
+    now = fake_time.now = 1546300800 + 3600
+
+    documents = [
+        {'@timestamp': ElasticsearchQuery.format_timestamp(now - offset), 'host': host, 'time': value}
+        for offset, host, value in [(300, 'app1', 10), (290, 'app1', 20), (100, 'app1', 60), (100, 'app2', 5)]
+    ]
+
+    # rows with no stats field value in their bucket do not count towards the percentiles
+    documents.append({'@timestamp': ElasticsearchQuery.format_timestamp(now - 200), 'host': 'app1'})
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, since=now - 60, to=now)
+        rolling = RollingWindow(es_query, query='*', window=600,
+                                stats_field='time', percents=(50,), group_by='host.keyword')
+
+        assert rolling.get() == {
+            'app1': {'count': 4, '50.0': (15 * 2 + 60) / 3.0},
+            'app2': {'count': 1, '50.0': 5.0},
+        }
+        assert rolling.count() == 5
+
+        # the time window of the instance passed is not moved
+        assert (es_query._since, es_query._to) == (now - 59, now)
+
+
+def test_query_by_sql():
+    documents = _get_fake_documents(25)
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host)
+
+        assert es_query.query_by_sql('SELECT host, time FROM "app-logs"', fetch_size=10) == documents
+        requests = server.get_requests('/_xpack/sql')
+        assert len(requests) == 3
+        assert requests[0][3] == {'query': 'SELECT host, time FROM "app-logs"', 'fetch_size': 10}
+        assert list(requests[1][3].keys()) == ['cursor']
+
+        columns, rows = es_query.query_by_sql('SELECT host, time FROM "app-logs"', result_format='tuples')
+        assert columns == ['host', 'time']
+        assert rows[:2] == [('app0.prod', 0), ('app1.prod', 1)]
+
+        res = es_query.query_by_sql('SELECT host, time FROM "app-logs"', fetch_size=7, result_format='columns')
+        assert list(res.keys()) == ['host', 'time']
+        assert res['time'] == list(range(25))
+
+        with raises(ElasticsearchQueryError):
+            es_query.query_by_sql('SELECT 1', result_format='foo')
+
+        # the cursor is closed when the iteration stops early
+        rows = es_query.iter_query_by_sql('SELECT host, time FROM "app-logs"', fetch_size=10)
+        assert next(rows) == documents[0]
+        rows.close()
+
+        assert len(server.closed_sql_cursors) == 1
+        assert server.sql_cursors == {}
+
+
+def test_columnar_result(monkeypatch):
+    res = ColumnarResult()
+    res.add_rows([
+        {'host': 'app1', 'context': {'time': 1, 'ratio': 0.5}},
+        {'host': 'app2', 'context': {'time': 2, 'ratio': 1}, 'status': 200},
+        {'host': None, 'context': {'time': 3.5}},
+        {'host': 'app3', 'context': {'time': 4}, 'status': True},
+    ])
+
+    assert len(res) == 4
+    assert res.keys() == ['host', 'context.time', 'context.ratio', 'status']
+    assert res['host'] == ['app1', 'app2', None, 'app3']
+    assert list(res['context.time']) == [1.0, 2.0, 3.5, 4.0]
+    assert res['context.time'].dtype == 'float64'
+    assert res['status'] == [None, 200, None, True]
+
+    # missing values are NaN in float columns
+    assert res['context.ratio'].dtype == 'float64'
+    assert res['context.ratio'][:2].tolist() == [0.5, 1.0]
+    assert math.isnan(res['context.ratio'][2])
+
+    # and masked in integer columns, also when the first value is missing
+    res = ColumnarResult()
+    res.add_rows([{'host': 'app1'}, {'host': 'app2', 'status': 200}, {'host': 'app3'}, {'status': 500}])
+    assert res['status'].dtype == 'int64'
+    assert res['status'].tolist() == [None, 200, None, 500]
+    assert res['status'].sum() == 700
+
+    # typed arrays are returned when NumPy is not installed
+    monkeypatch.setattr(elasticsearch_query_common, '_import_numpy', lambda: None)
+
+    res = ColumnarResult(fields=['time', 'foo.bar'])
+    res.add_rows(_get_fake_documents(5))
+    assert res['time'].tolist() == [0, 1, 2, 3, 4]
+    assert res['time'].typecode == 'q'
+    assert res['foo.bar'] == [None] * 5
+
+    res = ColumnarResult()
+    res.add_rows([{'time': None}, {'time': 1.5}, {'time': 2}, {'time': None}])
+    assert res['time'][1:3].tolist() == [1.5, 2.0]
+    assert res['time'].typecode == 'd'
+
+    # typed arrays can not hold missing integers
+    res.add_rows([{'count': 1}, {'count': None}])
+    assert res['count'] == [None, None, None, None, 1, None]
+
+
+def test_query_by_string_columnar():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        res = es_query.query_by_string('*', fields=['host', 'time'], limit=22, columnar=True)
+        assert isinstance(res, ColumnarResult)
+        assert len(res) == 22
+        assert res['time'].sum() == sum(range(22))
+        assert res['host'][:2] == ['app0.prod', 'app1.prod']
+
+        res = es_query.get_rows(match={'host': 'prod'}, limit=5, columnar=True)
+        assert res.keys() == ['host', 'time']
+        assert res['time'].tolist() == [0, 1, 2, 3, 4]
+
+
+def test_export(tmpdir):
+    documents = [{'host': 'app{}.prod'.format(idx), 'context': {'time': idx}} for idx in range(25)]
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        path = str(tmpdir.join('export.ndjson'))
+        assert es_query.export('*', path) == {'rows': 25, 'bytes': os.path.getsize(path)}
+
+        with open(path) as handler:
+            assert [json.loads(line) for line in handler] == documents
+
+        path = str(tmpdir.join('export.csv.gz'))
+        stats = es_query.export('*', path, fields=['context.time', 'host'], limit=12, format='csv', compress='gzip')
+        assert stats == {'rows': 12, 'bytes': os.path.getsize(path)}
+
+        with gzip.open(path, 'rt') as handler:
+            lines = handler.read().splitlines()
+            assert len(lines) == 13
+            assert lines[:2] == ['context.time,host', '0,app0.prod']
+
+        # file objects are not closed
+        fileobj = io.BytesIO()
+        assert es_query.export('*', fileobj, limit=5, format='csv')['rows'] == 5
+        assert fileobj.getvalue().decode('utf-8').splitlines()[:2] == ['host,context.time', 'app0.prod,0']
+
+        with raises(ElasticsearchQueryError):
+            es_query.export('*', fileobj, format='xml')
+
+
+def test_filter_path():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        assert es_query.query_by_string('*', limit=100) == _get_fake_documents(25)
+        assert es_query.count('*') == 25
+
+        requests = server.get_requests('/_search') + server.get_requests('/_search/scroll')
+        assert {request[2]['filter_path'] for request in requests if request[0] != 'DELETE'} == \
+            {ElasticsearchQuery.SCROLL_FILTER_PATH + ',' + ElasticsearchQuery.SHARDS_FILTER_PATH}
+        assert server.get_requests('/_count')[0][2]['filter_path'] == \
+            'count,_shards.total,_shards.successful,_shards.failed'
+
+        # sort values of hits are kept for search_after pagination
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10,
+                                      pagination_options=PaginationOptions(method='search_after'))
+        assert len(es_query.query_by_string('*', limit=100)) == 25
+
+
+def test_serializer():
+    assert isinstance(ElasticsearchQuery.get_serializer(), JSONSerializer)
+    assert isinstance(ElasticsearchQuery.get_serializer('auto'), OrjsonSerializer)
+
+    with raises(ElasticsearchQueryError):
+        ElasticsearchQuery.get_serializer('foo')
+
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10,
+                                      client_options=ClientOptions(serializer='orjson'))
+
+        assert es_query.query_by_string('*', limit=100) == _get_fake_documents(25)
+        assert es_query.count_many(['*', 'foo']) == [25, 25]
+
+
+def test_instrumented_serializer():
+    serializer = elasticsearch_query_common._InstrumentedSerializer(JSONSerializer())
+
+    assert serializer.loads('{"host": "zażółć"}') == {'host': 'zażółć'}
+    assert serializer.loads(b'{}') == {}
+    assert serializer.pop_stats()[0] == len('{"host": "zażółć"}'.encode('utf-8')) + 2, 'Bytes are counted'
+    assert serializer.pop_stats() == (0, 0.0)
+
+
+def test_stats_callback():
+    stats = []
+
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10, stats_callback=stats.append)
+
+        assert len(es_query.query_by_string('*', limit=100)) == 25
+        assert es_query.count('*') == 25
+        assert len(es_query.query_by_sql('SELECT host FROM "app-logs"', fetch_size=20)) == 25
+
+        assert [entry.method for entry in stats] == ['search', 'count', 'sql']
+
+        search = stats[0].as_dict()
+        assert search['index'] == es_query._index
+        assert search['pages'] == 4  # the last one is empty
+        assert search['rows'] == 25
+        assert search['took'] == 4
+        assert search['shards'] == {'total': 4, 'successful': 4, 'skipped': 0, 'failed': 0}
+        assert search['bytes'] > 0
+        assert 0 < search['decode_time'] < search['wall_time']
+        assert search['error'] is None
+
+        assert stats[1].pages == 1
+        assert stats[2].pages == 2
+        assert stats[2].rows == 25
+
+        # failed queries are reported too
+        server.fail_request = lambda method, path, params, body: 400 if path.endswith('/_count') else None
+
+        with raises(TransportError):
+            es_query.count('foo')
+
+        assert stats[-1].method == 'count'
+        assert isinstance(stats[-1].error, TransportError)
+
+
+def test_shared_client():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, since=1546300800, to=1546304400)
+
+        # the client is shared by instances with the same host and options
+        assert ElasticsearchQuery(es_host=server.host, period=60)._es is es_query._es
+        assert ElasticsearchQuery(es_host=server.host, read_timeout=30)._es is not es_query._es
+        assert ElasticsearchQuery(
+            es_host=server.host, client_options=ClientOptions(share_client=False))._es is not es_query._es
+
+        client = Elasticsearch(hosts=server.host)
+        assert ElasticsearchQuery(es_host='foo', client_options=ClientOptions(client=client))._es is client
+
+        # serializer instances are compared by identity
+        serializer = JSONSerializer()
+        es_query = ElasticsearchQuery(es_host=server.host, client_options=ClientOptions(serializer=serializer))
+        assert es_query._es.transport.serializer is serializer
+        assert ElasticsearchQuery(
+            es_host=server.host, client_options=ClientOptions(serializer=serializer))._es is es_query._es
+        assert ElasticsearchQuery(
+            es_host=server.host, client_options=ClientOptions(serializer=JSONSerializer()))._es is not es_query._es
+
+        es_query = ElasticsearchQuery(
+            es_host=server.host, client_options=ClientOptions(maxsize=2, http_compress=True))
+        assert es_query._es.transport.kwargs['maxsize'] == 2
+        assert es_query.count('*') == 25
+
+        ElasticsearchQuery.close_shared_clients()
+        assert ElasticsearchQuery(
+            es_host=server.host, client_options=ClientOptions(maxsize=2, http_compress=True))._es is not es_query._es
+
+
+def test_flat_options():
+    with warns(DeprecationWarning, match='maxsize, pagination, parallelism, sampling_field, sampling_method arguments'):
+        es_query = ElasticsearchQuery(es_host='foo', parallelism=2, pagination='search_after', maxsize=2,
+                                      sampling_method='hash_field', sampling_field='hash')
+
+    assert es_query._options.pagination == PaginationOptions(method='search_after', parallelism=2)
+    assert es_query._options.sampling == SamplingOptions(method='hash_field', field='hash')
+    assert es_query._options.client == ClientOptions(maxsize=2)
+
+    # separate arguments are merged into the options passed
+    with warns(DeprecationWarning):
+        es_query = ElasticsearchQuery(es_host='foo', pagination_options=PaginationOptions(partitions=4), max_retries=1)
+
+    assert es_query._options.pagination == PaginationOptions(partitions=4, max_retries=1)
+
+    # and validated
+    with warns(DeprecationWarning), raises(ElasticsearchQueryError):
+        ElasticsearchQuery(es_host='foo', projection='foo')
+
+
+def test_small_limit_skips_scroll():
+    with FakeElasticsearch(documents=_get_fake_documents(25)) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10)
+
+        assert es_query.query_by_string('*', limit=5) == _get_fake_documents(5)
+        assert server.scrolls == {}
+
+        _, _, params, body = server.get_requests('/_search')[-1]
+        assert 'scroll' not in params
+        assert body['size'] == 5
+        assert body['terminate_after'] == 5
+        assert body['track_total_hits'] is False
+
+        # min_score based sampling can not be used with terminate_after
+        assert len(es_query.query_by_string('*', limit=10, sampling=50)) == 10
+        assert 'terminate_after' not in server.get_requests('/_search')[-1][3]
+
+        # script sampling is a filter, hence terminate_after can be used
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10, sampling_options=SamplingOptions('script'))
+        es_query.query_by_string('*', limit=10, sampling=50)
+        assert server.get_requests('/_search')[-1][3]['terminate_after'] == 10
+
+        # limits that do not fit in a single page are scrolled
+        assert len(es_query.query_by_string('*', limit=11)) == 11
+        assert len(server.cleared_scrolls) == 1
+
+        # no point-in-time is needed for a single page
+        es_query = ElasticsearchQuery(es_host=server.host, batch_size=10, pagination_options=PaginationOptions(
+            method='search_after', point_in_time=True))
+        assert len(es_query.query_by_string('*', limit=7)) == 7
+        assert server.get_requests('/_pit') == []
+
+
+def test_partitions():
+    since = 1546300800  # 2019-01-01 00:00:00
+
+    pagination_options = PaginationOptions(partitions=4)
+
+    es_query = ElasticsearchQuery(es_host='foo', since=since - 1, to=since + 600, pagination_options=pagination_options)
+    assert [(part._since, part._to) for part in es_query._get_partitions()] == \
+        [(since, since + 150), (since + 150, since + 300), (since + 300, since + 450), (since + 450, since + 600)]
+
+    # partitions are not shorter than a minute
+    assert len(ElasticsearchQuery(es_host='foo', since=since - 1, to=since + 100,
+                                  pagination_options=pagination_options)._get_partitions()) == 2
+    assert ElasticsearchQuery(es_host='foo', since=since - 1, to=since + 30,
+                              pagination_options=pagination_options)._get_partitions() == []
+
+    # and not longer than a day, aligned to midnight
+    es_query = ElasticsearchQuery(es_host='foo', since=since + 3600, to=since + 3 * 86400 - 1,
+                                  pagination_options=PaginationOptions(partitions=2))
+    partitions = es_query._get_partitions()
+    assert [part._indices for part in partitions] == \
+        [['logstash-other-2019.01.01'], ['logstash-other-2019.01.02'], ['logstash-other-2019.01.03']]
+
+    assert partitions[0]._get_timestamp_filer() == \
+        {'range': {'@timestamp': {'gte': '2019-01-01T01:00:01.000Z', 'lt': '2019-01-02T00:00:00.000Z'}}}
+    assert partitions[2]._get_timestamp_filer() == \
+        {'range': {'@timestamp': {'gte': '2019-01-03T00:00:00.000Z', 'lte': '2019-01-03T23:59:59.000Z'}}}
+
+
+def test_partitioned_queries():
+    since = 1546300800
+    documents = [
+        {'@timestamp': ElasticsearchQuery.format_timestamp(since + idx * 100), 'idx': idx} for idx in range(30)
+    ]
+
+    with FakeElasticsearch(documents=documents) as server:
+        es_query = ElasticsearchQuery(es_host=server.host, since=since - 1, to=since + 3000, batch_size=4,
+                                      pagination_options=PaginationOptions(partitions=3))
+
+        assert len(es_query._get_partitions()) == 3
+        assert es_query.query_by_string('*', limit=100) == documents
+        assert es_query.count('*') == 30
+
+        # partitions are cancelled when the limit is reached
+        assert es_query.query_by_string('*', limit=6) == documents[:6]
+        assert server.scrolls == {}
+
+        es_query = ElasticsearchQuery(es_host=server.host, since=since - 1, to=since + 3000, batch_size=4,
+                                      pagination_options=PaginationOptions(partitions=3, ordered_partitions=False))
+
+        rows = es_query.query_by_string('*', limit=100)
+        assert sorted(rows, key=lambda row: row['idx']) == documents
+
+
+def test_federated_query():
+    us_documents = [{'host': 'app1.us', 'time': 10}, {'host': 'app1.us', 'time': 30}, {'host': 'app2', 'time': 20}]
+    eu_documents = [{'host': 'app1.eu', 'time': 50}, {'host': 'app2', 'time': 60}]
+
+    with FakeElasticsearch(documents=us_documents, latency=0.3) as us_server, \
+            FakeElasticsearch(documents=eu_documents, latency=0.3) as eu_server:
+        federated = FederatedQuery(clusters=[
+            {'name': 'us', 'es_host': us_server.host, 'index_prefix': 'logstash-us'},
+            {'name': 'eu', 'es_host': eu_server.host, 'index_prefix': 'logstash_eu', 'index_sep': '_'},
+        ], period=900)
+
+        assert federated.count('*') == 5
+
+        # clusters are queried concurrently - requests handled by both servers overlap
+        (us_received, us_responded), (eu_received, eu_responded) = \
+            us_server.request_times[-1], eu_server.request_times[-1]
+        assert us_received < eu_responded and eu_received < us_responded
+
+        assert list(federated.report) == ['us', 'eu']
+        assert federated.report['us']['latency'] >= 0.3
+        assert federated.report['eu']['error'] is None
+
+        assert us_server.requests[-1][1].startswith('/logstash-us-')
+        assert eu_server.requests[-1][1].startswith('/logstash_eu_')
+
+        assert federated.query_by_string('*', limit=4) == us_documents + eu_documents[:1]
+        assert federated.query_by_string('*', limit=4, interleave=True) == \
+            [us_documents[0], eu_documents[0], us_documents[1], eu_documents[1]]
+
+        res = federated.get_aggregations(query='*', group_by='host', stats_field='time', percents=(50,), size=2)
+        assert res == {'app2': {'count': 2, '50.0': 40.0}, 'app1.us': {'count': 2, '50.0': 20.0}}
+
+        # results of the remaining clusters are returned when one of them fails
+        eu_server.fail_request = lambda *args: 400
+
+        assert federated.count('*') == 3
+        assert isinstance(federated.report['eu']['error'], TransportError)
+
+        with raises(ElasticsearchQueryError):
+            FederatedQuery(clusters=[{'es_host': us_server.host}, {'es_host': eu_server.host}],
+                           fail_on_error=True).count('*')
+
+        with raises(ElasticsearchQueryError):
+            FederatedQuery(clusters=[])
+
+        us_server.fail_request = lambda *args: 400
+
+        with raises(ElasticsearchQueryError):
+            federated.count('*')
+
+
+def test_lazy_imports():
+    # the elasticsearch package is not imported until the first query is run
+    code = 'import sys, elasticsearch_query\n' \
+           'es_query = elasticsearch_query.ElasticsearchQuery(es_host="foo")\n' \
+           'assert es_query._client is None\n' \
+           'assert "elasticsearch" not in sys.modules and "numpy" not in sys.modules, sorted(sys.modules)\n' \
+           'lazy = {"csv", "copy", "gzip", "hashlib", "pickle", "tempfile"}\n' \
+           'assert not lazy & set(sys.modules), sorted(lazy & set(sys.modules))'
+
+    subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(elasticsearch_query.__file__))
+
+    assert ElasticsearchQuery.format_timestamp(1408450795) == '2014-08-19T12:19:55.000Z'
+    assert ElasticsearchQuery.format_index(prefix='logstash', timestamp=1408450795.5) == 'logstash-2014.08.19'
+
+
+def test_docvalues_projection():
+    documents = [
+        {'host': 'app1', 'time': 12, 'ratio': 0.5, 'context': {'status': 200, 'url': '/foo'}, 'message': 'Foo',
+         'agent': 'curl'},
+        {'host': 'app2', 'time': 34, 'ratio': 0.25, 'context': {'status': 500}, 'message': 'Bar',
+         'agent': 'Mozilla/5.0 ' * 50},
+    ]
+    mappings = {
+        'host': {'type': 'keyword'},
+        'time': {'type': 'long'},
+        'ratio': {'type': 'float'},  # doc values of floats lose precision
+        'context.status': {'type': 'integer'},
+        'context.url': {'type': 'keyword', 'doc_values': False, 'store': True},
+        'message': {'type': 'text'},
+        'agent': {'type': 'keyword', 'ignore_above': 256},  # doc values skip longer values
+    }
+    fields = ['host', 'time', 'ratio', 'context.status', 'context.url', 'message', 'agent']
+
+    with raises(ElasticsearchQueryError):
+        PaginationOptions(projection='foo')
+
+    with FakeElasticsearch(documents=documents, mappings=mappings) as server:
+        es_query = ElasticsearchQuery(es_host=server.host,
+                                      pagination_options=PaginationOptions(projection='docvalues'))
+
+        # the same rows as when fields are read from _source
+        assert es_query.query_by_string('*', fields=fields) == documents
+        assert ElasticsearchQuery(es_host=server.host).query_by_string('*', fields=fields) == documents
+
+        body = server.get_requests('/_search')[-2][3]
+        assert body['docvalue_fields'] == ['host', 'time', 'context.status']
+        assert body['stored_fields'] == ['context.url']
+        assert body['_source'] == {'includes': ['ratio', 'message', 'agent']}
+
+        # _source is not needed at all
+        assert es_query.query_by_string('*', fields=['host', 'time'], limit=1) == [{'host': 'app1', 'time': 12}]
+        assert server.get_requests('/_search')[-1][3]['_source'] is False
+
+        es_query.query_by_string('*', fields=['host', 'time'], limit=2)
+        assert len([request for request in server.requests if '/_mapping/field/' in request[1]]) == 2, \
+            'Mappings are cached'
+
+        # _source is used when mappings can not be checked
+        server.fail_request = lambda method, path, params, body: 400 if '/_mapping/' in path else None
+
+        assert es_query.query_by_string('*', fields=['time']) == [{'time': 12}, {'time': 34}]
+        assert server.get_requests('/_search')[-1][3]['_source'] == {'includes': ['time']}
+
+
+def test_docvalues_projection_single_element_list():
+    documents = [{'tags': ['foo']}, {'tags': ['foo', 'bar']}, {'tags': 'foo'}]
+
+    with FakeElasticsearch(documents=documents, mappings={'tags': {'type': 'keyword'}}) as server:
+        # doc values do not tell a single-element list from a scalar
+        es_query = ElasticsearchQuery(es_host=server.host,
+                                      pagination_options=PaginationOptions(projection='docvalues'))
+        assert es_query.query_by_string('*', fields=['tags']) == \
+            [{'tags': 'foo'}, {'tags': ['bar', 'foo']}, {'tags': 'foo'}]
+
+        # _source keeps it as it was indexed
+        assert ElasticsearchQuery(es_host=server.host).query_by_string('*', fields=['tags']) == documents
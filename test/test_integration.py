@@ -136,6 +136,19 @@ class IntegrationTests(TestCase):
         res = es_query.query_by_string('host: "app2"', fields=['appname', 'host'])
         assert res == [{'appname': 'foo', 'host': 'app2.prod'}]
 
+    def test_query_with_sampling(self):
+        es_query = ElasticsearchQuery(es_host=self.es_test_host, index_prefix=self.APP_LOGS_INDEX_NAME)
+
+        assert len(es_query.query_by_string('*', sampling=100)) == 3
+        assert len(es_query.query_by_string('*', sampling=0)) == 0
+
+        es_query = ElasticsearchQuery(
+            es_host=self.es_test_host, index_prefix=self.APP_LOGS_INDEX_NAME,
+            sampling_options=elasticsearch_query.SamplingOptions('script'))
+
+        assert len(es_query.query_by_string('*', sampling=100)) == 3
+        assert len(es_query.query_by_string('*', sampling=0)) == 0
+
     def test_get_aggregations(self):
         es_query = ElasticsearchQuery(es_host=self.es_test_host, index_prefix=self.APP_LOGS_INDEX_NAME)
 